@@ -11,8 +11,8 @@
 import torch
 import torch.nn as nn
 from torch.nn import LayerNorm
-import torchaudio.compliance.kaldi as ta_kaldi
 
+from BEATs.fbank import batched_fbank
 from BEATs.backbone import (
     TransformerEncoder,
 )
@@ -140,18 +140,13 @@ class BEATs(nn.Module):
         fbank_mean: float = 15.41663,
         fbank_std: float = 6.55582,
     ) -> torch.Tensor:
-        fbanks = []
-        for waveform in source:
-            waveform = waveform.unsqueeze(0) * 2**15
-            fbank = ta_kaldi.fbank(
-                waveform,
-                num_mel_bins=128,
-                sample_frequency=16000,
-                frame_length=25,
-                frame_shift=10,
-            )
-            fbanks.append(fbank)
-        fbank = torch.stack(fbanks, dim=0)
+        fbank, _ = batched_fbank(
+            source * 2**15,
+            num_mel_bins=128,
+            sample_frequency=16000,
+            frame_length=25,
+            frame_shift=10,
+        )
         fbank = (fbank - fbank_mean) / (2 * fbank_std)
         return fbank
 
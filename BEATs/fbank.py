@@ -0,0 +1,174 @@
+from functools import lru_cache
+from typing import Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+import torchaudio.compliance.kaldi as ta_kaldi
+
+# Batched equivalent of ta_kaldi.fbank with its default options
+# (povey window, no dither, remove_dc_offset, preemphasis 0.97,
+# power spectrum, log mel energies, snip_edges).
+PREEMPHASIS_COEFFICIENT = 0.97
+LOW_FREQ = 20.0
+HIGH_FREQ = 0.0
+
+
+@lru_cache(maxsize=None)
+def get_fbank_kernels(
+    sample_frequency: float,
+    frame_length: float,
+    frame_shift: float,
+    num_mel_bins: int = 128,
+    device: torch.device = torch.device("cpu"),
+    dtype: torch.dtype = torch.float32,
+) -> Tuple[int, int, int, torch.Tensor, torch.Tensor]:
+    """Return the frame properties, window and mel filterbank
+
+    Built once per (sample_frequency, frame_length, frame_shift) instead of
+    on every call of ta_kaldi.fbank.
+
+    Returns:
+        window_shift, window_size and padded_window_size in samples, the
+        povey window (window_size,) and the transposed mel filterbank
+        (padded_window_size // 2 + 1, num_mel_bins)
+    """
+    window_shift = int(sample_frequency * frame_shift * 0.001)
+    window_size = int(sample_frequency * frame_length * 0.001)
+    assert window_size >= 2, "choose a window size {} that is >= 2".format(window_size)
+    assert window_shift > 0, "`window_shift` must be greater than 0"
+    padded_window_size = 2 ** (window_size - 1).bit_length()
+
+    window = torch.hann_window(
+        window_size, periodic=False, device=device, dtype=dtype
+    ).pow(0.85)
+    mel_banks, _ = ta_kaldi.get_mel_banks(
+        num_mel_bins,
+        padded_window_size,
+        float(sample_frequency),
+        LOW_FREQ,
+        HIGH_FREQ,
+        100.0,
+        -500.0,
+        1.0,
+    )
+    # pad right column with zeros, size (num_mel_bins, padded_window_size // 2 + 1)
+    mel_banks = F.pad(mel_banks, (0, 1), mode="constant", value=0)
+    mel_banks = mel_banks.T.contiguous().to(device=device, dtype=dtype)
+    return window_shift, window_size, padded_window_size, window, mel_banks
+
+
+def num_fbank_frames(
+    lengths: torch.Tensor, window_size: int, window_shift: int
+) -> torch.Tensor:
+    """Number of frames kaldi outputs for waveforms of the given lengths"""
+    return torch.where(
+        lengths >= window_size,
+        1 + torch.div(lengths - window_size, window_shift, rounding_mode="floor"),
+        torch.zeros_like(lengths),
+    )
+
+
+def batched_fbank(
+    waveforms: torch.Tensor,
+    lengths: Optional[torch.Tensor] = None,
+    num_mel_bins: int = 128,
+    sample_frequency: float = 16000,
+    frame_length: float = 25.0,
+    frame_shift: float = 10.0,
+    subtract_mean: bool = False,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Kaldi compatible log mel filterbanks for a padded batch of waveforms
+
+    Matches ta_kaldi.fbank applied to every waveform[:length] separately,
+    but frames, transforms and projects the whole batch at once.
+
+    Args:
+        waveforms: padded batch of waveforms, size (batch, samples)
+        lengths: number of valid samples of each waveform, size (batch,).
+            All waveforms are assumed to be unpadded if None.
+        subtract_mean: subtract the mean over the valid frames of each
+            waveform, as in ta_kaldi.fbank
+
+    Returns:
+        fbank of size (batch, frames, num_mel_bins), with frames beyond the
+        length of a waveform set to zero, and the number of valid frames of
+        each waveform, size (batch,)
+    """
+    device, dtype = waveforms.device, waveforms.dtype
+    kernels = get_fbank_kernels(
+        sample_frequency, frame_length, frame_shift, num_mel_bins, device, dtype
+    )
+    window_shift, window_size, padded_window_size, window, mel_banks = kernels
+    batch_size, num_samples = waveforms.shape
+    if lengths is None:
+        lengths = torch.full((batch_size,), num_samples, device=device)
+    num_frames = num_fbank_frames(lengths.to(device), window_size, window_shift)
+    max_frames = int(num_frames.max()) if batch_size > 0 else 0
+    if max_frames == 0:
+        return (
+            torch.zeros((batch_size, 0, num_mel_bins), device=device, dtype=dtype),
+            num_frames,
+        )
+
+    # size (batch, frames, window_size)
+    frames = waveforms[:, : (max_frames - 1) * window_shift + window_size].unfold(
+        1, window_size, window_shift
+    )
+    frames = frames - frames.mean(dim=2, keepdim=True)
+    # frames[b, f, j] -= preemphasis * frames[b, f, max(0, j - 1)]
+    emphasized = torch.empty_like(frames)
+    torch.sub(
+        frames[:, :, 1:],
+        frames[:, :, :-1],
+        alpha=PREEMPHASIS_COEFFICIENT,
+        out=emphasized[:, :, 1:],
+    )
+    emphasized[:, :, 0] = frames[:, :, 0] * (1 - PREEMPHASIS_COEFFICIENT)
+    emphasized *= window
+
+    # zero padding up to padded_window_size is done by the fft
+    spectrum = torch.view_as_real(torch.fft.rfft(emphasized, n=padded_window_size))
+    spectrum = spectrum.pow(2.0).sum(dim=3)
+    fbank = torch.matmul(spectrum, mel_banks)
+    fbank = torch.clamp_min_(fbank, torch.finfo(dtype).eps).log_()
+
+    invalid = torch.arange(max_frames, device=device)[None, :] >= num_frames[:, None]
+    has_padding = bool(invalid.any())
+    if has_padding:
+        fbank.masked_fill_(invalid.unsqueeze(2), 0.0)
+    if subtract_mean:
+        mean = fbank.sum(dim=1, keepdim=True) / num_frames.clamp_min(1)[:, None, None]
+        fbank -= mean
+        if has_padding:
+            fbank.masked_fill_(invalid.unsqueeze(2), 0.0)
+    return fbank, num_frames
+
+
+def batched_fbank_reference(
+    waveforms: torch.Tensor,
+    lengths: Optional[torch.Tensor] = None,
+    num_mel_bins: int = 128,
+    sample_frequency: float = 16000,
+    frame_length: float = 25.0,
+    frame_shift: float = 10.0,
+    subtract_mean: bool = False,
+) -> torch.Tensor:
+    """Per-waveform ta_kaldi.fbank loop, used to check batched_fbank"""
+    if lengths is None:
+        lengths = [waveforms.shape[1]] * waveforms.shape[0]
+    fbanks = []
+    for waveform, length in zip(waveforms, lengths):
+        fbanks.append(
+            ta_kaldi.fbank(
+                waveform[: int(length)].unsqueeze(0),
+                num_mel_bins=num_mel_bins,
+                sample_frequency=sample_frequency,
+                frame_length=frame_length,
+                frame_shift=frame_shift,
+                subtract_mean=subtract_mean,
+            )
+        )
+    max_frames = max([fbank.shape[0] for fbank in fbanks] + [0])
+    return torch.stack(
+        [F.pad(fbank, (0, 0, 0, max_frames - fbank.shape[0])) for fbank in fbanks]
+    )
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Time TaskSampler.episodic_collate_fn of data_utils/dataset.py against the
+earlier collate with a loop over the items (loop_collate below).
+
+Episodes are lists of random (feature, label) items, as returned by the
+datasets: features of size (bins, frames) as transposed views of a
+(frames, bins) buffer (RaggedDatasetDCASE) or contiguous (data frame
+datasets). Before timing, the outputs of both are checked to agree: the
+labels and class ids exactly, the windows as crops of the right items.
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from data_utils.dataset import TaskSampler
+
+
+class _LabelsOnly:
+    # enough labels for a task, only the collate function is used
+    def get_labels(self):
+        return np.repeat(np.arange(5), 15)
+
+
+def loop_collate(sampler, input_data):
+    """episodic_collate_fn before it was vectorized"""
+    true_class_ids = list({x[1] for x in input_data})
+    new_input = []
+    for x in input_data:
+        if x[0].shape[1] > sampler.tensor_length:
+            rand_start = torch.randint(0, x[0].shape[1] - sampler.tensor_length, (1,))
+            new_input.append(
+                (x[0][:, rand_start : rand_start + sampler.tensor_length], x[1])
+            )
+        else:
+            new_input.append(x)
+    all_images = torch.cat([x[0].unsqueeze(0) for x in new_input])
+    all_images = all_images.reshape(
+        (sampler.n_way, sampler.n_shot + sampler.n_query, *all_images.shape[1:])
+    )
+    all_labels = torch.tensor([true_class_ids.index(x[1]) for x in input_data]).reshape(
+        (sampler.n_way, sampler.n_shot + sampler.n_query)
+    )
+    support_images = all_images[:, : sampler.n_shot].reshape(
+        (-1, *all_images.shape[2:])
+    )
+    query_images = all_images[:, sampler.n_shot :].reshape((-1, *all_images.shape[2:]))
+    support_labels = all_labels[:, : sampler.n_shot].flatten()
+    query_labels = all_labels[:, sampler.n_shot :].flatten()
+    return (
+        support_images,
+        support_labels,
+        query_images,
+        query_labels,
+        true_class_ids,
+    )
+
+
+def random_episode(sampler, rng, min_length, max_length, layout):
+    input_data = []
+    for label in rng.choice(1000, sampler.n_way, replace=False):
+        for _ in range(sampler.n_shot + sampler.n_query):
+            length = int(rng.integers(min_length, max_length + 1))
+            feature = torch.from_numpy(
+                rng.standard_normal((length, 128), dtype=np.float32)
+            ).T
+            if layout == "contiguous":
+                feature = feature.contiguous()
+            input_data.append((feature, int(label)))
+    return input_data
+
+
+def check_crops(sampler, input_data, output):
+    """every window is a crop of its item"""
+    support_images, _, query_images, _, _ = output
+    images = torch.cat(
+        [
+            support_images.reshape(sampler.n_way, sampler.n_shot, 128, -1),
+            query_images.reshape(sampler.n_way, sampler.n_query, 128, -1),
+        ],
+        1,
+    ).flatten(0, 1)
+    items_per_class = sampler.n_shot + sampler.n_query
+    for i, (feature, _) in enumerate(input_data):
+        # item i is window i in the (n_way, n_shot + n_query) layout
+        window = images[(i // items_per_class) * items_per_class + i % items_per_class]
+        length = window.shape[1]
+        assert any(
+            torch.equal(feature[:, start : start + length], window)
+            for start in range(feature.shape[1] - length + 1)
+        ), "window {} is not a crop of its item".format(i)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--num_episodes",
+        help="Number of episodes to collate",
+        default=200,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--max_length",
+        help="Maximal number of frames of a feature",
+        default=512,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--tensor_length",
+        help="Number of frames of a window",
+        default=128,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--layout",
+        help="Memory layout of the features: 'transposed' or 'contiguous'",
+        default="transposed",
+        required=False,
+        type=str,
+    )
+
+    cli_args = parser.parse_args()
+
+    sampler = TaskSampler(
+        _LabelsOnly(),
+        n_way=5,
+        n_shot=5,
+        n_query=10,
+        n_tasks=cli_args.num_episodes,
+        tensor_length=cli_args.tensor_length,
+    )
+    rng = np.random.default_rng(42)
+    episodes = [
+        random_episode(
+            sampler, rng, cli_args.tensor_length, cli_args.max_length, cli_args.layout
+        )
+        for _ in range(cli_args.num_episodes)
+    ]
+
+    for input_data in episodes[:10]:
+        output = sampler.episodic_collate_fn(input_data)
+        reference = loop_collate(sampler, input_data)
+        for tensor, reference_tensor in zip(output[:4], reference[:4]):
+            assert tensor.shape == reference_tensor.shape
+        assert torch.equal(output[1], reference[1])
+        assert torch.equal(output[3], reference[3])
+        assert output[4] == reference[4]
+        check_crops(sampler, input_data, output)
+
+    print("{:>12} {:>12} {:>12}".format("", "episodes/s", "ms/episode"))
+    for name, collate in [
+        ("loop", lambda input_data: loop_collate(sampler, input_data)),
+        ("vectorized", sampler.episodic_collate_fn),
+    ]:
+        start = time.perf_counter()
+        for input_data in episodes:
+            collate(input_data)
+        elapsed = time.perf_counter() - start
+        print(
+            "{:>12} {:>12.1f} {:>12.2f}".format(
+                name,
+                cli_args.num_episodes / elapsed,
+                1000 * elapsed / cli_args.num_episodes,
+            )
+        )
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Compare the memory of DataLoader workers for the training features served
+from a pandas data frame (the AudioDatasetDCASE of the datamodules), from
+the memory-mapped RaggedFeatureStore and from a SharedFeatureArena.
+
+Random features are written to a temporary store. Every variant runs
+n_tasks episodes with persistent workers, after which the private memory
+(pages not shared with any other process) and the proportional set size
+of each worker are read from /proc (linux only).
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from data_utils.feature_store import (
+    RaggedFeatureStore,
+    SharedFeatureArena,
+    write_ragged_store,
+)
+from datamodules.DCASEDataModule import (
+    AudioDatasetDCASE,
+    RaggedDatasetDCASE,
+    few_shot_dataloader,
+)
+
+VARIANTS = ["dataframe", "memmap", "arena"]
+
+
+def worker_pids():
+    """pids of the child processes of this process"""
+    pids = []
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(os.path.join("/proc", pid, "stat")) as f:
+                # the command name in parentheses may contain spaces
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except OSError:
+            continue
+        if ppid == os.getpid():
+            pids.append(int(pid))
+    return pids
+
+
+def memory_mb(pid):
+    """private and proportional memory of a process in MB"""
+    memory = {}
+    with open(os.path.join("/proc", str(pid), "smaps_rollup")) as f:
+        for line in f:
+            fields = line.split()
+            if fields[0] in ["Pss:", "Private_Clean:", "Private_Dirty:"]:
+                memory[fields[0][:-1]] = int(fields[1]) / 1024
+    return memory["Private_Clean"] + memory["Private_Dirty"], memory["Pss"]
+
+
+def make_dataset(variant, store):
+    if variant == "dataframe":
+        return AudioDatasetDCASE(
+            pd.DataFrame(
+                {
+                    "feature": [store[i].numpy().copy() for i in range(len(store))],
+                    "category": store.classes[store.label_ids],
+                }
+            )
+        )
+    if variant == "arena":
+        store = SharedFeatureArena.from_store(store)
+    return RaggedDatasetDCASE(store, np.arange(len(store)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--num_features",
+        help="Number of training features",
+        default=20000,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--num_classes",
+        help="Number of classes of the features",
+        default=20,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--num_workers",
+        help="Number of DataLoader workers",
+        default=2,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--n_tasks",
+        help="Number of episodes to load",
+        default=200,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--variants",
+        help="Datasets to compare: " + ", ".join(VARIANTS),
+        default=VARIANTS,
+        nargs="+",
+        required=False,
+        type=str,
+    )
+
+    cli_args = parser.parse_args()
+    assert set(cli_args.variants) <= set(VARIANTS)
+
+    rng = np.random.default_rng(42)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_ragged_store(
+            tmp_dir,
+            [
+                rng.standard_normal((128, length), dtype=np.float32)
+                for length in rng.integers(128, 384, cli_args.num_features)
+            ],
+            rng.integers(0, cli_args.num_classes, cli_args.num_features),
+        )
+        store = RaggedFeatureStore(tmp_dir)
+        size = os.path.getsize(os.path.join(tmp_dir, "features.npy")) / 2**20
+        print("features: {:.0f} MB".format(size))
+        print(
+            "{:>10} {:>9} {:>18} {:>14}".format(
+                "variant", "time [s]", "worker priv. [MB]", "worker pss [MB]"
+            )
+        )
+        for variant in cli_args.variants:
+            dataset = make_dataset(variant, store)
+            loader = few_shot_dataloader(
+                dataset,
+                n_way=5,
+                n_shot=5,
+                n_query=10,
+                n_tasks=cli_args.n_tasks,
+                tensor_length=128,
+                num_workers=cli_args.num_workers,
+                persistent_workers=True,
+            )
+            start = time.perf_counter()
+            for batch in loader:
+                pass
+            elapsed = time.perf_counter() - start
+            # the persistent workers are still alive
+            memory = [memory_mb(pid) for pid in worker_pids()]
+            print(
+                "{:>10} {:>9.1f} {:>18} {:>14}".format(
+                    variant,
+                    elapsed,
+                    "/".join("{:.0f}".format(private) for private, _ in memory),
+                    "/".join("{:.0f}".format(pss) for _, pss in memory),
+                )
+            )
+            del loader, batch, dataset
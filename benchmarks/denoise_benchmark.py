@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Compare the batched spectral gating of data_utils/denoise.py with
+noisereduce.reduce_noise, as called by denoise_signal in DCASEfewshot.py.
+
+First checks that denoise_file equals reduce_noise on entire recordings
+(including recordings longer than a noisereduce chunk) within --atol, then
+times denoising many event segments of a recording: one reduce_noise call
+per segment against a single noise threshold and batched gating.
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from data_utils.DCASEfewshot import denoise_signal
+from data_utils.denoise import denoise_file, estimate_noise_threshold, spectral_gate
+
+
+def synthetic_recording(num_samples, sr, rng):
+    # noise with an intermittent tone
+    t = np.arange(num_samples) / sr
+    calls = np.sin(2 * np.pi * 2000 * t) * (np.sin(2 * np.pi * 0.5 * t) > 0.7)
+    return (0.05 * rng.standard_normal(num_samples) + calls).astype(np.float32)
+
+
+def check_parity(atol, seed=42):
+    rng = np.random.default_rng(seed)
+    for sr, num_samples in [(16000, 100000), (44100, 300001), (22050, 1500000)]:
+        y = synthetic_recording(num_samples, sr, rng)
+        max_error = np.abs(denoise_file(y, sr) - denoise_signal(y, sr)).max()
+        print(
+            "parity sr={} samples={}: max abs error {:.2e}".format(
+                sr, num_samples, max_error
+            )
+        )
+        assert max_error < atol
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--num_segments",
+        help="Number of event segments to denoise",
+        default=100,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--sr",
+        help="Sampling frequency of the segments",
+        default=22050,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--atol",
+        help="Maximum absolute difference allowed with noisereduce",
+        default=1e-5,
+        required=False,
+        type=float,
+    )
+
+    cli_args = parser.parse_args()
+
+    check_parity(cli_args.atol)
+
+    # segments of about 6 s, as cut around training events
+    rng = np.random.default_rng(0)
+    recording = synthetic_recording(60 * cli_args.sr, cli_args.sr, rng)
+    segments = []
+    for _ in range(cli_args.num_segments):
+        length = int(cli_args.sr * rng.uniform(6.1, 7.0))
+        start = rng.integers(0, len(recording) - length)
+        segments.append(recording[start : start + length])
+
+    start = time.perf_counter()
+    for segment in segments:
+        denoise_signal(segment, cli_args.sr)
+    print("noisereduce per segment: {:.2f} s".format(time.perf_counter() - start))
+    for dtype in [torch.float64, torch.float32]:
+        start = time.perf_counter()
+        noise_threshold = estimate_noise_threshold(recording, cli_args.sr, dtype)
+        spectral_gate(segments, cli_args.sr, noise_threshold, dtype=dtype)
+        print(
+            "batched, {}:      {:.2f} s".format(
+                str(dtype).split(".")[1], time.perf_counter() - start
+            )
+        )
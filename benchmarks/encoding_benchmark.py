@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Check the compact feature encodings of data_utils/feature_encoding.py.
+
+Prepares the Training_Set of a synthetic data set (data_utils/
+synthetic_dcase.py) once for every feature dtype and compares the decoded
+features with float32: the size of the store, the largest decoding error
+and the change of prototype distances in few-shot episodes. Prototypes
+are the mean of n_shot random tensor_length windows of a class, and
+distances are euclidean in mel space, as the embedding of a trained model
+is not available here.
+"""
+import argparse
+import os
+import tempfile
+
+import numpy as np
+import torch
+
+from data_utils.DCASEfewshot import prepare_training_val_data
+from data_utils.feature_encoding import FEATURE_DTYPES
+from data_utils.feature_store import FEATURES_FILE, RaggedFeatureStore
+from data_utils.synthetic_dcase import write_synthetic_set
+
+
+def random_window(feature, tensor_length, generator):
+    if feature.shape[1] <= tensor_length:
+        return feature
+    start = int(
+        torch.randint(0, feature.shape[1] - tensor_length, (1,), generator=generator)
+    )
+    return feature[:, start : start + tensor_length]
+
+
+def episode_distances(store, episodes, tensor_length):
+    """Query to prototype distances of the given episodes"""
+    distances = []
+    for support, query, seed in episodes:
+        generator = torch.Generator().manual_seed(seed)
+        prototypes = torch.stack(
+            [
+                torch.stack(
+                    [random_window(store[i], tensor_length, generator) for i in shots]
+                ).mean(dim=0)
+                for shots in support
+            ]
+        )
+        queries = torch.stack(
+            [random_window(store[i], tensor_length, generator) for i in query]
+        )
+        distances.append(
+            torch.cdist(queries.flatten(1)[None], prototypes.flatten(1)[None])[0]
+        )
+    return torch.cat(distances)
+
+
+def sample_episodes(label_ids, num_episodes, n_way, n_shot, n_query, seed=42):
+    rng = np.random.default_rng(seed)
+    classes = [c for c in np.unique(label_ids) if (label_ids == c).sum() > n_shot]
+    n_way = min(n_way, len(classes))
+    episodes = []
+    for episode in range(num_episodes):
+        support, query = [], []
+        for c in rng.choice(classes, n_way, replace=False):
+            indices = rng.permutation(np.flatnonzero(label_ids == c))
+            support.append(indices[:n_shot])
+            query.extend(indices[n_shot : n_shot + n_query])
+        episodes.append((support, query, episode))
+    return episodes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--num_files",
+        help="Number of recordings of the synthetic Training_Set",
+        default=4,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--duration",
+        help="Duration of every recording in seconds",
+        default=30.0,
+        required=False,
+        type=float,
+    )
+    parser.add_argument(
+        "--num_episodes",
+        help="Number of few-shot episodes to compare",
+        default=50,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--tensor_length",
+        help="Number of frames of a window",
+        default=128,
+        required=False,
+        type=int,
+    )
+
+    cli_args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root_dir = os.path.join(tmp_dir, "Development_Set")
+        write_synthetic_set(
+            root_dir,
+            "Training_Set",
+            num_files=cli_args.num_files,
+            duration=cli_args.duration,
+        )
+        stores = {}
+        for feature_dtype in FEATURE_DTYPES:
+            target_path = prepare_training_val_data(
+                "train",
+                "Training_Set",
+                overwrite=True,
+                tensor_length=cli_args.tensor_length,
+                waveform_cache_dir=os.path.join(tmp_dir, "waveform_cache"),
+                root_dir=root_dir,
+                target_root=os.path.join(tmp_dir, "prepared"),
+                feature_dtype=feature_dtype,
+            )
+            stores[feature_dtype] = RaggedFeatureStore(
+                os.path.join(target_path, "audio")
+            )
+
+        reference = stores["float32"]
+        episodes = sample_episodes(
+            reference.label_ids, cli_args.num_episodes, n_way=5, n_shot=5, n_query=10
+        )
+        reference_distances = episode_distances(
+            reference, episodes, cli_args.tensor_length
+        )
+        reference_size = os.path.getsize(os.path.join(reference.path, FEATURES_FILE))
+        print(
+            "{:>8} {:>10} {:>8} {:>10} {:>14} {:>12}".format(
+                "dtype",
+                "size [MB]",
+                "ratio",
+                "max error",
+                "max rel dist",
+                "argmin same",
+            )
+        )
+        for feature_dtype, store in stores.items():
+            size = os.path.getsize(os.path.join(store.path, FEATURES_FILE))
+            max_error = max(
+                float((store[i] - reference[i]).abs().max()) for i in range(len(store))
+            )
+            distances = episode_distances(store, episodes, cli_args.tensor_length)
+            relative_change = (
+                (distances - reference_distances).abs() / reference_distances
+            ).max()
+            same_argmin = (
+                (distances.argmin(dim=1) == reference_distances.argmin(dim=1))
+                .float()
+                .mean()
+            )
+            print(
+                "{:>8} {:>10.2f} {:>7.1f}x {:>10.2e} {:>14.2e} {:>11.1%}".format(
+                    feature_dtype,
+                    size / 2**20,
+                    reference_size / size,
+                    max_error,
+                    float(relative_change),
+                    float(same_argmin),
+                )
+            )
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Time the assembly of few-shot training episodes: few_shot_dataloader of
+DCASEDataModule.py (TaskSampler, __getitem__ per item and
+episodic_collate_fn) against the EpisodeGenerator of data_utils/episodes.py.
+
+Random features are written to a temporary ragged store. The episodes are
+only assembled, no model is run; a training step can be simulated with
+--step_time, to see how much of the assembly an EpisodePrefetcher hides.
+"""
+import argparse
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from data_utils.episodes import EpisodeGenerator, EpisodePrefetcher
+from data_utils.feature_store import RaggedFeatureStore, write_ragged_store
+from datamodules.DCASEDataModule import RaggedDatasetDCASE, few_shot_dataloader
+
+
+def time_episodes(episodes, device, step_time=0.0):
+    start = time.perf_counter()
+    for episode in episodes:
+        # a training step, which releases the GIL like the model would
+        time.sleep(step_time)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--num_features",
+        help="Number of training features",
+        default=5000,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--num_classes",
+        help="Number of classes of the features",
+        default=20,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--n_tasks",
+        help="Number of episodes to assemble",
+        default=200,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--feature_dtype",
+        help="Encoding of the stored features",
+        default="float32",
+        required=False,
+        type=str,
+    )
+    parser.add_argument(
+        "--step_time",
+        help="Simulated time of a training step in seconds",
+        default=0.0,
+        required=False,
+        type=float,
+    )
+    parser.add_argument(
+        "--num_prefetch",
+        help="Number of episodes the EpisodePrefetcher builds ahead",
+        default=4,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--device",
+        help="Device of the episode generator",
+        default="cuda" if torch.cuda.is_available() else "cpu",
+        required=False,
+        type=str,
+    )
+
+    cli_args = parser.parse_args()
+    device = torch.device(cli_args.device)
+
+    rng = np.random.default_rng(42)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_ragged_store(
+            tmp_dir,
+            [
+                rng.standard_normal((128, length), dtype=np.float32)
+                for length in rng.integers(128, 384, cli_args.num_features)
+            ],
+            rng.integers(0, cli_args.num_classes, cli_args.num_features),
+            feature_dtype=cli_args.feature_dtype,
+        )
+        store = RaggedFeatureStore(tmp_dir)
+        dataset = RaggedDatasetDCASE(store, np.arange(len(store)))
+        loader = few_shot_dataloader(
+            dataset,
+            n_way=5,
+            n_shot=5,
+            n_query=10,
+            n_tasks=cli_args.n_tasks,
+            tensor_length=128,
+        )
+        start = time.perf_counter()
+        generator = EpisodeGenerator(
+            store,
+            dataset.indices,
+            n_way=5,
+            n_shot=5,
+            n_query=10,
+            n_tasks=cli_args.n_tasks,
+            tensor_length=128,
+            device=device,
+        )
+        setup_time = time.perf_counter() - start
+
+        cpu = torch.device("cpu")
+        loader_time = time_episodes(loader, cpu, cli_args.step_time)
+        generator_time = time_episodes(generator, device, cli_args.step_time)
+        prefetcher = EpisodePrefetcher(loader, cli_args.num_prefetch)
+        prefetcher_time = time_episodes(prefetcher, cpu, cli_args.step_time)
+        print("{:>27} {:>14} {:>10}".format("", "episodes/s", "setup [s]"))
+        print(
+            "{:>27} {:>14.1f} {:>10}".format(
+                "DataLoader", cli_args.n_tasks / loader_time, "-"
+            )
+        )
+        print(
+            "{:>27} {:>14.1f} {:>10.2f}".format(
+                "EpisodeGenerator (" + device.type + ")",
+                cli_args.n_tasks / generator_time,
+                setup_time,
+            )
+        )
+        print(
+            "{:>27} {:>14.1f} {:>10}".format(
+                "DataLoader + prefetcher", cli_args.n_tasks / prefetcher_time, "-"
+            )
+        )
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Compare the batched fbank (BEATs/fbank.py) with the per-waveform
+ta_kaldi.fbank loop.
+
+First checks that both give the same features within --atol, then times
+both for a range of batch sizes.
+"""
+import argparse
+import time
+
+import torch
+
+from BEATs.fbank import batched_fbank, batched_fbank_reference
+
+
+def check_parity(atol, seed=42):
+    generator = torch.Generator().manual_seed(seed)
+    for sample_frequency, frame_shift in [(16000, 10), (22050, 3), (44100, 1)]:
+        waveforms = torch.randn((8, sample_frequency), generator=generator) * 2**12
+        lengths = torch.randint(
+            sample_frequency // 10, sample_frequency + 1, (8,), generator=generator
+        )
+        for subtract_mean in [False, True]:
+            kwargs = dict(
+                sample_frequency=sample_frequency,
+                frame_shift=frame_shift,
+                subtract_mean=subtract_mean,
+            )
+            fbank, _ = batched_fbank(waveforms, lengths, **kwargs)
+            reference = batched_fbank_reference(waveforms, lengths, **kwargs)
+            max_error = (fbank - reference).abs().max().item()
+            print(
+                "parity fs={} frame_shift={} subtract_mean={}: max abs error {:.2e}".format(
+                    sample_frequency, frame_shift, subtract_mean, max_error
+                )
+            )
+            assert fbank.shape == reference.shape
+            assert max_error < atol
+
+
+def time_function(function, repeats):
+    function()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    return (time.perf_counter() - start) / repeats
+
+
+def benchmark(batch_sizes, duration, sample_frequency, frame_shift, repeats):
+    print(
+        "{:>6} {:>12} {:>12} {:>8}".format(
+            "batch", "kaldi [ms]", "batched [ms]", "speedup"
+        )
+    )
+    for batch_size in batch_sizes:
+        waveforms = torch.randn((batch_size, int(duration * sample_frequency)))
+        kwargs = dict(sample_frequency=sample_frequency, frame_shift=frame_shift)
+        t_reference = time_function(
+            lambda: batched_fbank_reference(waveforms, **kwargs), repeats
+        )
+        t_batched = time_function(lambda: batched_fbank(waveforms, **kwargs), repeats)
+        print(
+            "{:>6} {:>12.2f} {:>12.2f} {:>7.1f}x".format(
+                batch_size,
+                t_reference * 1000,
+                t_batched * 1000,
+                t_reference / t_batched,
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--batch_sizes",
+        help="Batch sizes to time",
+        default=[1, 4, 16, 64, 256],
+        nargs="+",
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--duration",
+        help="Duration of each waveform in seconds",
+        default=1.0,
+        required=False,
+        type=float,
+    )
+    parser.add_argument(
+        "--sample_frequency",
+        help="Sampling frequency of the waveforms",
+        default=16000,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--frame_shift",
+        help="Frame shift in ms",
+        default=10.0,
+        required=False,
+        type=float,
+    )
+    parser.add_argument(
+        "--repeats",
+        help="Number of timed repetitions per batch size",
+        default=5,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--atol",
+        help="Maximum absolute difference allowed with ta_kaldi.fbank",
+        default=1e-3,
+        required=False,
+        type=float,
+    )
+
+    cli_args = parser.parse_args()
+
+    check_parity(cli_args.atol)
+    benchmark(
+        cli_args.batch_sizes,
+        cli_args.duration,
+        cli_args.sample_frequency,
+        cli_args.frame_shift,
+        cli_args.repeats,
+    )
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Time prepare_training_val_data of DCASEfewshot.py on a synthetic data set
+(data_utils/synthetic_dcase.py), for every status and preprocessing variant.
+
+Each preparation runs in a separate process, which reports its peak memory
+(including that of its worker processes), and the throughput is given in
+annotation files and POS events per second.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+from data_utils.DCASEfewshot import prepare_training_val_data
+from data_utils.synthetic_dcase import SET_TYPES, write_synthetic_set
+
+VARIANTS = {
+    "plain": {},
+    "resample": {"resample": True},
+    "normalize": {"normalize": True},
+    "denoise": {"denoise": True},
+    "all": {"resample": True, "normalize": True, "denoise": True},
+}
+
+
+def count_events(csv_files):
+    return sum(
+        int(pd.read_csv(csv_file).isin(["POS"]).any(axis=1).sum())
+        for csv_file in csv_files
+    )
+
+
+def run_preparation(status, variant, root_dir, target_root, workers):
+    start = time.perf_counter()
+    prepare_training_val_data(
+        status,
+        SET_TYPES[status],
+        overwrite=True,
+        workers=workers,
+        waveform_cache_dir=None,
+        root_dir=root_dir,
+        target_root=target_root,
+        **VARIANTS[variant]
+    )
+    # ru_maxrss is in kB on linux
+    peak_rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return {"time": time.perf_counter() - start, "peak_rss": peak_rss / 1024}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--status",
+        help="Sets to prepare: 'train', 'validate' and/or 'test'",
+        default=["train", "validate", "test"],
+        nargs="+",
+        required=False,
+        type=str,
+    )
+    parser.add_argument(
+        "--variants",
+        help="Preprocessing variants: " + ", ".join(VARIANTS),
+        default=list(VARIANTS),
+        nargs="+",
+        required=False,
+        type=str,
+    )
+    parser.add_argument(
+        "--num_files",
+        help="Number of recordings per set",
+        default=4,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--duration",
+        help="Duration of every recording in seconds",
+        default=60.0,
+        required=False,
+        type=float,
+    )
+    parser.add_argument(
+        "--sample_rates",
+        help="Sampling frequencies, assigned to the recordings in turn",
+        default=[16000, 22050, 44100],
+        nargs="+",
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--workers",
+        help="Number of worker processes of the preparation",
+        default=1,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--root_dir",
+        help="Use an existing synthetic data set instead of a temporary one",
+        default=None,
+        required=False,
+        type=str,
+    )
+    parser.add_argument(
+        "--run",
+        help="Internal: run a single preparation, given as status:variant",
+        default=None,
+        required=False,
+        type=str,
+    )
+    parser.add_argument("--target_root", default=None, required=False, type=str)
+
+    cli_args = parser.parse_args()
+    assert set(cli_args.variants) <= set(VARIANTS)
+
+    if cli_args.run is not None:
+        status, variant = cli_args.run.split(":")
+        # the preparation prints progress, the result goes to the last line
+        result = run_preparation(
+            status, variant, cli_args.root_dir, cli_args.target_root, cli_args.workers
+        )
+        print(json.dumps(result))
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root_dir = cli_args.root_dir
+        if root_dir is None:
+            root_dir = os.path.join(tmp_dir, "Development_Set")
+            for set_ind, status in enumerate(cli_args.status):
+                write_synthetic_set(
+                    root_dir,
+                    SET_TYPES[status],
+                    num_files=cli_args.num_files,
+                    duration=cli_args.duration,
+                    sample_rates=cli_args.sample_rates,
+                    seed=42 + set_ind,
+                )
+
+        print(
+            "{:>9} {:>10} {:>6} {:>7} {:>9} {:>8} {:>9} {:>10}".format(
+                "status",
+                "variant",
+                "files",
+                "events",
+                "time [s]",
+                "files/s",
+                "events/s",
+                "peak [MB]",
+            )
+        )
+        for status in cli_args.status:
+            csv_files = [
+                os.path.join(path_dir, file)
+                for path_dir, _, files in os.walk(
+                    os.path.join(root_dir, SET_TYPES[status])
+                )
+                for file in files
+                if file.endswith(".csv")
+            ]
+            num_events = count_events(csv_files)
+            for variant in cli_args.variants:
+                output = subprocess.run(
+                    [
+                        sys.executable,
+                        __file__,
+                        "--run",
+                        status + ":" + variant,
+                        "--root_dir",
+                        root_dir,
+                        "--target_root",
+                        os.path.join(tmp_dir, "prepared"),
+                        "--workers",
+                        str(cli_args.workers),
+                    ],
+                    check=True,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                    text=True,
+                ).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                print(
+                    "{:>9} {:>10} {:>6} {:>7} {:>9.1f} {:>8.2f} {:>9.1f} {:>10.0f}".format(
+                        status,
+                        variant,
+                        len(csv_files),
+                        num_events,
+                        result["time"],
+                        len(csv_files) / result["time"],
+                        num_events / result["time"],
+                        result["peak_rss"],
+                    )
+                )
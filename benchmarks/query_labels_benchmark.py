@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Compare the query window labeling of DCASEfewshot.py with the former loop
+over pd.Interval windows, on a synthetic file with many events.
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from data_utils.DCASEfewshot import query_windows, query_window_labels
+
+
+def interval_loop_labels(num_frames, tensor_length, segment_hop, starts, ends):
+    """Former implementation: one IntervalArray.overlaps call per window"""
+    interval_array = pd.arrays.IntervalArray.from_arrays(starts, ends)
+    labels = []
+    segment_ind = 0
+    segment_end_ind = 0
+    while segment_end_ind < num_frames:
+        segment_start_ind = segment_ind * segment_hop
+        segment_end_ind = segment_start_ind + tensor_length
+        segment_interval = pd.Interval(segment_start_ind / 1000, segment_end_ind / 1000)
+        is_included = np.any(interval_array.overlaps(segment_interval))
+        labels.append("POS" if is_included else "NEG")
+        segment_ind += 1
+    return np.asarray(labels)
+
+
+def synthetic_events(num_events, duration, seed):
+    rng = np.random.default_rng(seed)
+    starts = np.sort(rng.uniform(0, duration, num_events))
+    ends = starts + rng.uniform(0.01, 0.5, num_events)
+    return starts, ends
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--num_events",
+        help="Number of events in the synthetic file",
+        default=10000,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--num_frames",
+        help="Number of mel frames of the synthetic file",
+        default=3600000,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--tensor_length",
+        help="Length of the query windows",
+        default=128,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--seed",
+        help="Seed of the synthetic events",
+        default=42,
+        required=False,
+        type=int,
+    )
+
+    cli_args = parser.parse_args()
+
+    segment_hop = int(round(cli_args.tensor_length * 0.5))
+    # window indices are compared to event times as index / 1000
+    starts, ends = synthetic_events(
+        cli_args.num_events, cli_args.num_frames / 1000, cli_args.seed
+    )
+
+    start = time.perf_counter()
+    reference = interval_loop_labels(
+        cli_args.num_frames, cli_args.tensor_length, segment_hop, starts, ends
+    )
+    t_reference = time.perf_counter() - start
+
+    start = time.perf_counter()
+    segment_starts, segment_ends = query_windows(
+        cli_args.num_frames, cli_args.tensor_length, segment_hop
+    )
+    labels = query_window_labels(
+        segment_starts / 1000, segment_ends / 1000, starts, ends
+    )
+    t_vectorized = time.perf_counter() - start
+
+    assert np.array_equal(reference, labels)
+    print(
+        "{} windows, {} events, {} POS".format(
+            len(labels), cli_args.num_events, np.sum(labels == "POS")
+        )
+    )
+    print("interval loop: {:.3f} s".format(t_reference))
+    print("searchsorted:  {:.4f} s".format(t_vectorized))
+    print("speedup:       {:.0f}x".format(t_reference / t_vectorized))
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Compare the resamplers of data_utils/waveform_cache.py with librosa's
+default (kaiser_best), and time a load from the waveform cache against decoding
+and resampling the file again.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import soundfile as sf
+
+from data_utils.waveform_cache import (
+    DEFAULT_RESAMPLER,
+    WaveformCache,
+    resample_waveform,
+)
+
+
+def synthetic_recording(duration, sample_frequency, seed=42):
+    # tones below the nyquist frequency of the target rate, with little noise
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * sample_frequency)) / sample_frequency
+    y = 0.001 * rng.standard_normal(len(t))
+    for frequency in [440, 1000, 3000, 6000]:
+        y += 0.2 * np.sin(2 * np.pi * frequency * t + rng.uniform(0, 2 * np.pi))
+    return y.astype(np.float32)
+
+
+def snr(reference, estimate):
+    length = min(len(reference), len(estimate))
+    error = reference[:length] - estimate[:length]
+    return 10 * np.log10(np.sum(reference[:length] ** 2) / np.sum(error**2))
+
+
+def time_function(function, repeats):
+    function()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        result = function()
+    return (time.perf_counter() - start) / repeats, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--duration",
+        help="Duration of the synthetic recording in seconds",
+        default=300.0,
+        required=False,
+        type=float,
+    )
+    parser.add_argument(
+        "--sample_frequencies",
+        help="Sampling frequencies of the synthetic recordings",
+        default=[22050, 44100, 48000],
+        nargs="+",
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--target_fs",
+        help="Sampling frequency to resample to",
+        default=16000,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--resamplers",
+        help="Resamplers to compare with kaiser_best",
+        default=["polyphase", "kaiser_fast"],
+        nargs="+",
+        required=False,
+        type=str,
+    )
+    parser.add_argument(
+        "--repeats",
+        help="Number of timed repetitions",
+        default=3,
+        required=False,
+        type=int,
+    )
+
+    cli_args = parser.parse_args()
+
+    print(
+        "{:>8} {:>10} {:>10} {:>8} {:>9}".format(
+            "fs", "resampler", "time [s]", "speedup", "SNR [dB]"
+        )
+    )
+    for sample_frequency in cli_args.sample_frequencies:
+        y = synthetic_recording(cli_args.duration, sample_frequency)
+        t_reference, reference = time_function(
+            lambda: resample_waveform(y, sample_frequency, cli_args.target_fs),
+            cli_args.repeats,
+        )
+        print(
+            "{:>8} {:>10} {:>10.3f} {:>7.1f}x {:>9}".format(
+                sample_frequency, DEFAULT_RESAMPLER, t_reference, 1.0, "-"
+            )
+        )
+        for resampler in cli_args.resamplers:
+            t_resampler, resampled = time_function(
+                lambda: resample_waveform(
+                    y, sample_frequency, cli_args.target_fs, resampler
+                ),
+                cli_args.repeats,
+            )
+            print(
+                "{:>8} {:>10} {:>10.3f} {:>7.1f}x {:>9.1f}".format(
+                    sample_frequency,
+                    resampler,
+                    t_resampler,
+                    t_reference / t_resampler,
+                    snr(reference, resampled),
+                )
+            )
+
+    # cached load against decoding and resampling again
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        audio_path = os.path.join(tmp_dir, "recording.wav")
+        sample_frequency = cli_args.sample_frequencies[-1]
+        sf.write(
+            audio_path,
+            synthetic_recording(cli_args.duration, sample_frequency),
+            sample_frequency,
+            subtype="PCM_16",
+        )
+        no_cache = WaveformCache(None)
+        cache = WaveformCache(os.path.join(tmp_dir, "cache"))
+        t_decode, _ = time_function(
+            lambda: no_cache.load(audio_path, cli_args.target_fs), cli_args.repeats
+        )
+        # np.sum reads every page of the memmap
+        t_cached, _ = time_function(
+            lambda: np.sum(cache.load(audio_path, cli_args.target_fs)[0]),
+            cli_args.repeats,
+        )
+        print("decode and resample: {:.3f} s".format(t_decode))
+        print("cached load:         {:.3f} s".format(t_cached))
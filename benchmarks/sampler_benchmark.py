@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Time the construction and the task draws of the TaskSampler of
+data_utils/dataset.py against the earlier sampler with a dict of python
+lists and random.sample per task (DictTaskSampler below), for random
+integer labels. The tasks of the TaskSampler are checked to hold distinct
+items of n_way distinct classes.
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+from data_utils.dataset import TaskSampler
+
+
+class _Labels:
+    def __init__(self, labels):
+        self.labels = labels
+
+    def get_labels(self):
+        return self.labels
+
+
+class DictTaskSampler:
+    """item index and draws of the TaskSampler before it was vectorized"""
+
+    def __init__(self, dataset, n_way, n_shot, n_query, n_tasks):
+        self.n_way = n_way
+        self.n_shot = n_shot
+        self.n_query = n_query
+        self.n_tasks = n_tasks
+        self.items_per_label = {}
+        for item, label in enumerate(dataset.get_labels()):
+            if label in self.items_per_label.keys():
+                self.items_per_label[label].append(item)
+            else:
+                self.items_per_label[label] = [item]
+        # random.sample needs a sequence since python 3.11, and classes
+        # with too few items can not be drawn
+        self.labels = [
+            label
+            for label, items in self.items_per_label.items()
+            if len(items) >= n_shot + n_query
+        ]
+
+    def __iter__(self):
+        for _ in range(self.n_tasks):
+            yield [
+                item
+                for label in random.sample(self.labels, self.n_way)
+                for item in random.sample(
+                    self.items_per_label[label], self.n_shot + self.n_query
+                )
+            ]
+
+
+def time_sampler(sampler_class, dataset, n_tasks, **kwargs):
+    start = time.perf_counter()
+    sampler = sampler_class(
+        dataset, n_way=5, n_shot=5, n_query=10, n_tasks=n_tasks, **kwargs
+    )
+    construction_time = time.perf_counter() - start
+    start = time.perf_counter()
+    tasks = list(sampler)
+    return construction_time, time.perf_counter() - start, tasks
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--num_items",
+        help="Number of items of the dataset",
+        default=1000000,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--num_classes",
+        help="Number of classes of the items",
+        default=20000,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--n_tasks",
+        help="Number of tasks to draw",
+        default=10000,
+        required=False,
+        type=int,
+    )
+
+    cli_args = parser.parse_args()
+
+    labels = np.random.default_rng(42).integers(
+        0, cli_args.num_classes, cli_args.num_items
+    )
+    dataset = _Labels(labels)
+    print("{:>10} {:>16} {:>10}".format("", "construction [s]", "tasks/s"))
+    for name, sampler_class, kwargs in [
+        ("dict", DictTaskSampler, {}),
+        ("vectorized", TaskSampler, {"seed": 42}),
+    ]:
+        construction_time, draw_time, tasks = time_sampler(
+            sampler_class, dataset, cli_args.n_tasks, **kwargs
+        )
+        task_labels = labels[np.array(tasks)].reshape(cli_args.n_tasks, 5, 15)
+        assert (task_labels == task_labels[:, :, :1]).all()
+        assert all(len(set(task)) == 5 * 15 for task in tasks)
+        assert all(len(set(task[:, 0])) == 5 for task in task_labels)
+        print(
+            "{:>10} {:>16.3f} {:>10.0f}".format(
+                name, construction_time, cli_args.n_tasks / draw_time
+            )
+        )
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Compare the streaming query mel of DCASEfewshot.py (--stream) with the
+in-memory preprocess of the entire file, on a long synthetic recording.
+
+Each variant runs in a separate process, which reports its peak memory, and
+the resulting mels are checked to match within --atol.
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import soundfile as sf
+import torch
+
+from data_utils.DCASEfewshot import preprocess, stream_preprocess
+
+
+def read_mono(audio_path, start=0, stop=None):
+    """Read samples [start, stop) of an audio file as float32 mono
+
+    Gives the same samples as librosa.load(audio_path, sr=None, mono=True).
+    """
+    samples, _ = sf.read(
+        audio_path, start=start, stop=stop, dtype="float32", always_2d=True
+    )
+    return samples.mean(axis=1, dtype=np.float32)
+
+
+def write_recording(audio_path, duration, sample_frequency, seed=42):
+    # write in blocks, so that the recording itself is never in memory
+    rng = np.random.default_rng(seed)
+    block_size = 60 * sample_frequency
+    num_samples = int(duration * sample_frequency)
+    with sf.SoundFile(
+        audio_path, "w", samplerate=sample_frequency, channels=1, subtype="PCM_16"
+    ) as f:
+        for start in range(0, num_samples, block_size):
+            size = min(block_size, num_samples - start)
+            f.write(0.1 * rng.standard_normal(size).astype(np.float32))
+
+
+def run_variant(mode, audio_path, output_path, frame_shift):
+    start = time.perf_counter()
+    if mode == "stream":
+        info = sf.info(audio_path)
+        window_shift = int(info.samplerate * frame_shift * 0.001)
+        window_size = int(info.samplerate * 25.0 * 0.001)
+        num_frames = 1 + (info.frames - window_size) // window_shift
+        query_mel = np.lib.format.open_memmap(
+            output_path, mode="w+", dtype=np.float32, shape=(num_frames, 128)
+        )
+        stream_preprocess(audio_path, query_mel, frame_shift=frame_shift)
+        query_mel.flush()
+    else:
+        y = read_mono(audio_path)
+        fbank = preprocess(
+            None,
+            torch.Tensor(y[None, :]),
+            sample_frequency=sf.info(audio_path).samplerate,
+            frame_shift=frame_shift,
+        )
+        np.save(output_path, fbank[0].numpy())
+    # ru_maxrss is in kB on linux
+    print(
+        "{:>8} {:>10.1f} {:>10.0f}".format(
+            mode,
+            time.perf_counter() - start,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--duration",
+        help="Duration of the synthetic recording in seconds",
+        default=300.0,
+        required=False,
+        type=float,
+    )
+    parser.add_argument(
+        "--sample_frequency",
+        help="Sampling frequency of the synthetic recording",
+        default=22050,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--frame_shift",
+        help="Frame shift in ms",
+        default=2.0,
+        required=False,
+        type=float,
+    )
+    parser.add_argument(
+        "--atol",
+        help="Maximum absolute difference allowed between both mels",
+        default=1e-4,
+        required=False,
+        type=float,
+    )
+    parser.add_argument(
+        "--mode",
+        help="Internal: run a single variant ('memory' or 'stream')",
+        default=None,
+        required=False,
+        type=str,
+    )
+    parser.add_argument("--audio_path", default=None, required=False, type=str)
+    parser.add_argument("--output_path", default=None, required=False, type=str)
+
+    cli_args = parser.parse_args()
+
+    if cli_args.mode is not None:
+        run_variant(
+            cli_args.mode,
+            cli_args.audio_path,
+            cli_args.output_path,
+            cli_args.frame_shift,
+        )
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        audio_path = os.path.join(tmp_dir, "recording.wav")
+        write_recording(audio_path, cli_args.duration, cli_args.sample_frequency)
+        print("{:>8} {:>10} {:>10}".format("mode", "time [s]", "peak [MB]"))
+        for mode in ["memory", "stream"]:
+            subprocess.run(
+                [
+                    sys.executable,
+                    __file__,
+                    "--mode",
+                    mode,
+                    "--audio_path",
+                    audio_path,
+                    "--output_path",
+                    os.path.join(tmp_dir, mode + ".npy"),
+                    "--frame_shift",
+                    str(cli_args.frame_shift),
+                ],
+                check=True,
+            )
+        max_error = np.abs(
+            np.load(os.path.join(tmp_dir, "memory.npy"), mmap_mode="r")
+            - np.load(os.path.join(tmp_dir, "stream.npy"), mmap_mode="r")
+        ).max()
+        print("max abs error {:.2e}".format(max_error))
+        assert max_error < cli_args.atol
@@ -3,7 +3,7 @@ Single use script to prepare developmentset for episodical training.
 
 Based on adapted code from DL baseline system.
 
-WARNING: script deletes earlier prepared data.
+WARNING: with --overwrite the script deletes earlier prepared data.
 
 Issues & Questions:
 - TODO: Add denoising support
@@ -20,19 +20,54 @@ import shutil
 import torch
 import pandas as pd
 import numpy as np
-import librosa
 import soundfile as sf
-import torchaudio.compliance.kaldi as ta_kaldi
+from BEATs.fbank import batched_fbank
+from data_utils.waveform_cache import (
+    DEFAULT_CACHE_DIR,
+    DEFAULT_RESAMPLER,
+    WaveformCache,
+    resample_waveform,
+)
+from data_utils.denoise import denoise_file, estimate_noise_threshold, spectral_gate
+from data_utils.feature_encoding import (
+    FEATURE_DTYPES,
+    decode_features,
+    encode_features,
+    save_encoded_npy,
+)
+from data_utils.feature_manifest import npy_data_offset, write_feature_manifest
+from data_utils.feature_store import (
+    CLASSES_FILE,
+    FEATURES_FILE,
+    LABEL_IDS_FILE,
+    OFFSETS_FILE,
+    SCALES_FILE,
+    ragged_store_exists,
+    write_ragged_store,
+)
+from data_utils.plotting import PlotRenderer
+from data_utils.profiling import StageProfiler
+from data_utils.manifest import (
+    SourceManifest,
+    atomic_replace,
+    atomic_save,
+    atomic_savez,
+)
 import hashlib
 import json
-import csv
-import matplotlib.pyplot as plt
+import time
+from functools import partial
+from multiprocessing import Pool
 from copy import copy
 import noisereduce as nr
 
 PLOT = False
 PLOT_TOO_SHORT_SAMPLES = False
 PLOT_SUPPORT = False
+# number of mel frames computed at once with --stream
+STREAM_BLOCK_FRAMES = 4096
+# number of event segments denoised at once with --batched_denoise
+DENOISE_BLOCK_SIZE = 64
 
 
 def normalize_mono(samples):
@@ -64,83 +99,290 @@ def preprocess(
     frame_shift: float = 10.0,
     subtract_mean: bool = True,
 ) -> torch.Tensor:
-    fbanks = []
-    for waveform in source:
-        waveform = waveform.unsqueeze(0) * 2**15
-        fbank = ta_kaldi.fbank(
-            waveform,
-            num_mel_bins=128,
-            sample_frequency=sample_frequency,
+    fbank, _ = batched_fbank(
+        source * 2**15,
+        num_mel_bins=128,
+        sample_frequency=sample_frequency,
+        frame_length=frame_length,
+        frame_shift=frame_shift,
+        subtract_mean=subtract_mean,
+    )
+    fbank = (fbank - fbank_mean) / (2 * fbank_std)
+    return fbank
+
+
+def stream_max_amplitude(audio_path, block_size=2**20):
+    current_max = np.float32(0)
+    for block in sf.blocks(
+        audio_path, blocksize=block_size, dtype="float32", always_2d=True
+    ):
+        block = block.mean(axis=1, dtype=np.float32)
+        current_max = max(current_max, np.amax(block), -np.amin(block))
+    return current_max
+
+
+def stream_preprocess(
+    audio_path,
+    query_mel,
+    scale=None,
+    fbank_mean: float = 15.41663,
+    fbank_std: float = 6.55582,
+    frame_length: float = 25.0,
+    frame_shift: float = 10.0,
+    block_frames=STREAM_BLOCK_FRAMES,
+):
+    """Streaming equivalent of preprocess for an entire audio file
+
+    The file is read in blocks of block_frames frames. Samples of the last,
+    incomplete frame of a block are carried over to the next block, so that
+    the frames are identical to those of the entire file. The log mel
+    energies are written to query_mel (frames, bins), e.g. a memmap of at
+    least as many frames as the file has. The mean over the file is
+    subtracted in a second pass over query_mel.
+
+    scale multiplies the waveform, as normalize_mono does with the scale of
+    the entire file.
+    """
+    fs = sf.info(audio_path).samplerate
+    window_shift = int(fs * frame_shift * 0.001)
+    carry = np.zeros(0, dtype=np.float32)
+    fbank_sum = torch.zeros(query_mel.shape[1], dtype=torch.float64)
+    num_frames = 0
+    for block in sf.blocks(
+        audio_path,
+        blocksize=block_frames * window_shift,
+        dtype="float32",
+        always_2d=True,
+    ):
+        block = block.mean(axis=1, dtype=np.float32)
+        if scale is not None:
+            block = np.multiply(block, scale)
+        samples = np.concatenate((carry, block))
+        fbank, block_num_frames = batched_fbank(
+            torch.from_numpy(samples)[None, :] * 2**15,
+            num_mel_bins=query_mel.shape[1],
+            sample_frequency=fs,
             frame_length=frame_length,
             frame_shift=frame_shift,
-            subtract_mean=subtract_mean,
         )
-        fbanks.append(fbank)
-    fbank = torch.stack(fbanks, dim=0)
-    fbank = (fbank - fbank_mean) / (2 * fbank_std)
-    return fbank
+        block_num_frames = int(block_num_frames[0])
+        query_mel[num_frames : num_frames + block_num_frames] = fbank[0].numpy()
+        fbank_sum += fbank[0].sum(dim=0, dtype=torch.float64)
+        num_frames += block_num_frames
+        carry = samples[block_num_frames * window_shift :]
 
+    # subtract the mean of the entire file and normalize
+    mean = (fbank_sum / max(num_frames, 1)).float()
+    for start in range(0, num_frames, block_frames):
+        end = min(start + block_frames, num_frames)
+        fbank = torch.from_numpy(np.asarray(query_mel[start:end])) - mean
+        query_mel[start:end] = ((fbank - fbank_mean) / (2 * fbank_std)).numpy()
+    return num_frames
 
-def prepare_training_val_data(
+
+def query_windows(num_frames, tensor_length, segment_hop):
+    """Start and end frame indices of the query windows of a file
+
+    A window of tensor_length frames starts every segment_hop frames, until
+    a window reaches the end of the file. The last window may extend beyond
+    num_frames and has to be padded.
+    """
+    num_windows = 1 + max(0, -(-(num_frames - tensor_length) // segment_hop))
+    segment_starts = np.arange(num_windows) * segment_hop
+    return segment_starts, segment_starts + tensor_length
+
+
+def query_window_labels(window_starts, window_ends, event_starts, event_ends):
+    """Label a window POS if it overlaps with any event, NEG otherwise
+
+    Windows and events are right-closed intervals, as with
+    pd.IntervalArray.overlaps. With the events sorted by start time, the
+    events starting before the end of a window are found with a single
+    np.searchsorted, and the window overlaps one of them if the largest end
+    time among them lies after the window start.
+    """
+    order = np.argsort(event_starts, kind="stable")
+    sorted_starts = np.asarray(event_starts)[order]
+    running_max_ends = np.maximum.accumulate(np.asarray(event_ends)[order])
+    num_candidates = np.searchsorted(sorted_starts, window_ends, side="left")
+    has_candidates = num_candidates > 0
+    overlaps = np.zeros(len(window_starts), dtype=bool)
+    overlaps[has_candidates] = (
+        running_max_ends[num_candidates[has_candidates] - 1]
+        > np.asarray(window_starts)[has_candidates]
+    )
+    return np.where(overlaps, "POS", "NEG")
+
+
+def process_file(
+    file,
     status,
     set_type,
-    overwrite,
+    target_path,
     tensor_length=128,
     frame_length=25.0,
     denoise=False,
     normalize=False,
     resample=False,
     target_fs=16000,
+    file_fbank=False,
+    stream=False,
+    resampler=DEFAULT_RESAMPLER,
+    waveform_cache_dir=DEFAULT_CACHE_DIR,
+    batched_denoise=False,
+    plot_every=1,
+    profile=False,
+    feature_dtype="float32",
 ):
-    """Prepare the Training_Set
+    """Extract the features of a single annotation file and its audio
 
-    Training set is used for training *and* validating the encoder.
+    For validate/test the query and support sets of the file are saved
+    directly into target_path. The returned features and labels are only
+    used for the Training_Set, which is saved as a whole once all files are
+    processed. record describes the file for the feature manifest (see
+    data_utils/feature_manifest.py), outputs are the paths of the saved
+    files, relative to target_path, and stats are the stage times and
+    counters of the file (see data_utils/profiling.py), None without
+    profile.
 
-    All positive samples are converted into mel features from which
-    a random tensor_length long window can be selected. If PLOT=True,
-    pngs are saved to separate folder showing the selected features.
+    The query set of a file is saved as a single mel of size (frames, bins),
+    zero padded to the end of the last window. Query window i covers frames
+    [i * segment_hop, i * segment_hop + tensor_length) and can be taken as
+    a view with unfold(0, tensor_length, segment_hop).
 
-    All input feature tensors and their labels are saved into a single
-    pickle. Separate directories are created for different params, so
-    that they can be found again during training.
+    With file_fbank the training events are sliced from a mel of the
+    entire (resampled, normalized, denoised) file, computed once per
+    frame_shift, instead of preprocessing a segment around every event.
+
+    With stream the audio of validate/test files is never loaded as a whole:
+    the query mel is computed block by block into a memmap on disk (see
+    stream_preprocess).
+
+    The validate/test support features are sliced from the query mel of the
+    file (before padding, decoded from the saved mel with stream), so that
+    they are preprocessed exactly like the query windows they are compared
+    with and no audio is read or transformed again per event.
+
+    Otherwise decoded and resampled waveforms are read from the waveform
+    cache in waveform_cache_dir (data_utils/waveform_cache.py), shared by
+    all preprocessing variants. Segments around training events are still
+    resampled separately, from the cached waveform at the native rate.
+
+    With batched_denoise the noise threshold is estimated once per file and
+    the training event segments are denoised in blocks of
+    DENOISE_BLOCK_SIZE with data_utils/denoise.py, instead of one
+    noisereduce call (with its own noise estimate) per segment.
+
+    The query mel and the training features are saved encoded as
+    feature_dtype (data_utils/feature_encoding.py). The support sets, of
+    only a few features, are always saved as float32.
+
+    Diagnostic plots (PLOT, PLOT_TOO_SHORT_SAMPLES, PLOT_SUPPORT) are
+    rendered in background threads (data_utils/plotting.py), only every
+    plot_every-th of them.
+
+    Only depends on its arguments, so that files can be processed in
+    separate worker processes.
     """
+    labels = []
+    input_features = []
+    outputs = []
+    file_mels = {}
+    # offset and scale of a uint8 file mel
+    file_mel_affine = None
+    denoised = {}
+    profiler = StageProfiler(enabled=profile)
+    renderer = None
+    if PLOT or PLOT_TOO_SHORT_SAMPLES or PLOT_SUPPORT:
+        renderer = PlotRenderer(plot_every=plot_every)
 
-    def preprocess_df(df):
-        # for each tagged sample
-        for ind, _ in df.iterrows():
-            temp_plot = False
-            # obtain class label for current sample
-            label = cls_list[ind]
-            # ensure there were enough positives of the class
-            if label not in min_segment_lengths:
-                continue
-            # obtain a segment with large margins around event
-            extra_time = 3
-            frame_shift = np.round(min_segment_lengths[label] / tensor_length * 1000)
-            frame_shift = 1 if frame_shift < 1 else frame_shift
-            start_waveform = int((df["Starttime"][ind] - extra_time) * fs)
-
-            end_waveform = int((df["Endtime"][ind] + extra_time) * fs)
-            end_waveform = len(y) if len(y) < end_waveform else end_waveform
-            if start_waveform < 0:
-                extra_time = (extra_time * fs + start_waveform) / fs
-                start_waveform = 0
-            current_segment = y[start_waveform:end_waveform]
-            if resample:
-                current_segment = librosa.resample(
-                    current_segment, orig_sr=fs, target_sr=target_fs
+    def save_output(output_name, data):
+        # atomic write into the audio directory, recorded for the manifest
+        output = os.path.join("audio", output_name)
+        with profiler.stage("save"):
+            if output_name.endswith(".npz"):
+                atomic_savez(os.path.join(target_path, output), *data)
+            else:
+                atomic_save(os.path.join(target_path, output), data)
+        if profile:
+            profiler.count(
+                "bytes_written", os.path.getsize(os.path.join(target_path, output))
+            )
+        outputs.append(output)
+        return output
+
+    def segment_waveform(start_time, end_time):
+        # obtain a segment with large margins around event
+        extra_time = 3
+        start_waveform = int((start_time - extra_time) * fs)
+
+        end_waveform = int((end_time + extra_time) * fs)
+        end_waveform = num_samples if num_samples < end_waveform else end_waveform
+        if start_waveform < 0:
+            extra_time = (extra_time * fs + start_waveform) / fs
+            start_waveform = 0
+        current_segment = y[start_waveform:end_waveform]
+        if resample:
+            with profiler.stage("resample"):
+                current_segment = resample_waveform(
+                    current_segment, fs, target_fs, resampler
                 )
-                # only resampling segment, so overall fs doesn't change
+            # only resampling segment, so overall fs doesn't change
+        return current_segment, extra_time
 
+    def denoise_segments(df, rows):
+        # normalize the segments of the events in rows and denoise them at
+        # once, with the noise threshold of the entire file
+        segments = []
+        extra_times = []
+        db_offsets = []
+        for ind in rows:
+            current_segment, extra_time = segment_waveform(
+                df["Starttime"][ind], df["Endtime"][ind]
+            )
+            db_offset = 0.0
+            if normalize:
+                with profiler.stage("normalize"):
+                    # the threshold shifts with the gain of normalize_mono
+                    current_max = max(
+                        np.amax(current_segment), -np.amin(current_segment)
+                    )
+                    db_offset = 20 * np.log10(0.99 / current_max)
+                    current_segment = normalize_mono(current_segment)
+            segments.append(current_segment)
+            extra_times.append(extra_time)
+            db_offsets.append(db_offset)
+        if fs == target_fs:
+            noise = y
+        else:
+            with profiler.stage("resample"):
+                noise, _ = waveform_cache.load(audio_path, target_fs)
+        with profiler.stage("denoise"):
+            segments = spectral_gate(
+                segments,
+                target_fs,
+                estimate_noise_threshold(noise, target_fs),
+                db_offsets,
+            )
+        return dict(zip(rows, zip(segments, extra_times)))
+
+    def segment_mel(ind, start_time, end_time, frame_shift, extra_margin):
+        if ind in denoised:
+            current_segment, extra_time = denoised[ind]
+        else:
+            current_segment, extra_time = segment_waveform(start_time, end_time)
             # normalize
             if normalize:
-                current_segment = normalize_mono(current_segment)
+                with profiler.stage("normalize"):
+                    current_segment = normalize_mono(current_segment)
 
             # denoise
             if denoise:
-                current_segment = denoise_signal(current_segment, target_fs)
+                with profiler.stage("denoise"):
+                    current_segment = denoise_signal(current_segment, target_fs)
 
-            # obtain mel bins
+        # obtain mel bins
+        with profiler.stage("fbank"):
             fbank = preprocess(
                 None,
                 torch.Tensor(current_segment[None, :]),
@@ -148,28 +390,78 @@ def prepare_training_val_data(
                 frame_length=frame_length,
                 frame_shift=frame_shift,
             )
-            data = fbank.data[0].T
+        data = fbank.data[0].T
+        x_start = int(np.round((extra_time - extra_margin) / frame_shift * 1000))
+        x_end = int(
+            np.round(
+                (end_time - start_time + extra_time + extra_margin) / frame_shift * 1000
+            )
+        )
+        return data, x_start, x_end
+
+    def get_file_mel(frame_shift):
+        # mel of the entire file, computed once per frame_shift
+        if frame_shift not in file_mels:
+            with profiler.stage("fbank"):
+                fbank = preprocess(
+                    None,
+                    torch.Tensor(y[None, :]),
+                    sample_frequency=target_fs,
+                    frame_length=frame_length,
+                    frame_shift=frame_shift,
+                )
+            file_mels[frame_shift] = fbank.data[0].T
+        return file_mels[frame_shift]
+
+    def preprocess_df(df):
+        rows = [ind for ind in df.index if cls_list[ind] in min_segment_lengths]
+        # for each tagged sample
+        for ind, _ in df.iterrows():
+            temp_plot = False
+            # obtain class label for current sample
+            label = cls_list[ind]
+            # ensure there were enough positives of the class
+            if label not in min_segment_lengths:
+                continue
+            frame_shift = np.round(min_segment_lengths[label] / tensor_length * 1000)
+            frame_shift = 1 if frame_shift < 1 else frame_shift
             # select the relevant segment (without the large margins)
             if status == "validate" or status == "test":
                 extra_margin = 0
             else:
                 extra_margin = min_segment_lengths[label] / 3
-            x_start = int(np.round((extra_time - extra_margin) / frame_shift * 1000))
-            x_start = 0 if x_start < 0 else x_start
-            x_end = int(
-                np.round(
-                    (
-                        df["Endtime"][ind]
-                        - df["Starttime"][ind]
-                        + extra_time
-                        + extra_margin
+            if status != "train" or file_fbank:
+                # slice the event out of the mel of the entire file
+                data = get_file_mel(frame_shift)
+                x_start = int(
+                    np.round((df["Starttime"][ind] - extra_margin) / frame_shift * 1000)
+                )
+                x_end = int(
+                    np.round((df["Endtime"][ind] + extra_margin) / frame_shift * 1000)
+                )
+            else:
+                if batched_denoise and denoise and ind not in denoised:
+                    # denoise the next block of events at once
+                    denoised.clear()
+                    block_start = rows.index(ind)
+                    denoised.update(
+                        denoise_segments(
+                            df, rows[block_start : block_start + DENOISE_BLOCK_SIZE]
+                        )
                     )
-                    / frame_shift
-                    * 1000
+                data, x_start, x_end = segment_mel(
+                    ind,
+                    df["Starttime"][ind],
+                    df["Endtime"][ind],
+                    frame_shift,
+                    extra_margin,
                 )
-            )
+            x_start = 0 if x_start < 0 else x_start
             x_end = data.shape[1] if x_end > data.shape[1] else x_end
-            input_feature = data[:, x_start:x_end]
+            # copy, so that the mel of the entire file can be released
+            input_feature = decode_features(
+                data[:, x_start:x_end], file_mel_affine
+            ).clone()
             # ensure minimal length equals tensor length
             if x_end - x_start < tensor_length:
                 print(
@@ -206,216 +498,268 @@ def prepare_training_val_data(
             # store feature
             input_features.append(input_feature.numpy())
             labels.append(label)
+            profiler.count("events")
+            profiler.count("frames", input_feature.shape[1])
             # plot feature
             if PLOT or temp_plot or (status != "train" and PLOT_SUPPORT):
-                plt.imshow(input_feature, cmap="hot", interpolation="nearest")
-                plt.title(label)
-                plt.savefig(
-                    os.path.join(
-                        target_path,
-                        "plots",
-                        "_".join(
-                            [
-                                glob_cls_name,
-                                os.path.splitext(file_name)[0],
-                                label,
-                                str(df["Starttime"][ind]),
-                            ],
-                        )
-                        + ".png",
+                with profiler.stage("plot"):
+                    renderer.submit(
+                        input_feature,
+                        label,
+                        os.path.join(
+                            target_path,
+                            "plots",
+                            "_".join(
+                                [
+                                    glob_cls_name,
+                                    os.path.splitext(file_name)[0],
+                                    label,
+                                    str(df["Starttime"][ind]),
+                                ],
+                            )
+                            + ".png",
+                        ),
                     )
-                )
             if status == "validate" and len(labels) == len(df):
-                np.savez(
-                    os.path.join(
-                        target_path,
-                        "audio",
-                        "support_data_" + os.path.splitext(file_name)[0],
-                    ),
-                    *input_features
+                record["support_data"] = save_output(
+                    "support_data_" + os.path.splitext(file_name)[0] + ".npz",
+                    input_features,
                 )
-                np.save(
-                    os.path.join(
-                        target_path,
-                        "audio",
-                        "support_labels_" + os.path.splitext(file_name)[0],
-                    ),
+                record["support_labels"] = save_output(
+                    "support_labels_" + os.path.splitext(file_name)[0] + ".npy",
                     np.asarray(labels),
                 )
                 break
 
-    # Root directory of data to be processed
-    root_dir = "/data/DCASE/Development_Set"
+    # read csv file into df
+    split_list = file.split("/")
+    glob_cls_name = split_list[split_list.index(set_type) + 1]
+    file_name = split_list[split_list.index(set_type) + 2]
+    with profiler.stage("read_csv"):
+        df = pd.read_csv(file, header=0, index_col=False)
 
-    # Create directories for saving
-    my_hash_dict = {
-        "resample": resample,
-        "denoise": denoise,
-        "normalize": normalize,
-        "frame_length": frame_length,
-        "tensor_length": tensor_length,
-        "set_type": set_type,
+    # read audio file into y
+    waveform_cache = WaveformCache(waveform_cache_dir, resampler)
+    audio_path = file.replace("csv", "wav")
+    print("Processing file name {}".format(audio_path))
+    with profiler.stage("load"):
+        if stream and status != "train":
+            assert not (resample or denoise), "--stream does not support these"
+            y = None
+            fs = sf.info(audio_path).samplerate
+            num_samples = sf.info(audio_path).frames
+        else:
+            y, fs = waveform_cache.load(audio_path)
+            num_samples = len(y)
+    scale = None
+    if not resample:
+        target_fs = fs
+    record = {
+        "filename": os.path.splitext(file_name)[0],
+        "class": glob_cls_name,
+        "sample_rate": int(target_fs),
+        "duration": num_samples / fs,
     }
-    if resample:
-        my_hash_dict["tartget_fs"] = target_fs
-    hash_dir_name = hashlib.sha1(
-        json.dumps(my_hash_dict, sort_keys=True).encode()
-    ).hexdigest()
-    target_path = os.path.join("/data/DCASEfewshot", status, hash_dir_name)
-    if overwrite:
-        if os.path.exists(target_path):
-            shutil.rmtree(target_path)
+    df = df[(df == "POS").any(axis=1)]
+    df = df.reset_index()
 
-    if not os.path.exists(os.path.join(target_path, "audio")):
-        os.makedirs(os.path.join(target_path, "audio"))
+    # For csv files with a column name Call, pick up the global class name
+    if "CALL" in df.columns:
+        cls_list = [glob_cls_name] * len(df)
+    elif "Q" in df.columns:
+        cls_list = ["POS"] * len(df)
+    else:
+        cls_list = [
+            df.columns[(df == "POS").loc[index]].values for index, row in df.iterrows()
+        ]
+        cls_list = list(chain.from_iterable(cls_list))
 
-    if not os.path.exists(os.path.join(target_path, "plots")):
-        os.makedirs(os.path.join(target_path, "plots"))
-
-    print("=== Processing data ===")
-    # collect all meta files, one for each audio file
-    all_csv_files = [
-        file
-        for path_dir, _, _ in os.walk(os.path.join(root_dir, set_type))
-        for file in glob(os.path.join(path_dir, "*.csv"))
-    ]
-
-    # loop through all meta files
-    labels = []
-    input_features = []  # list of tuples (input tensor,label)
-    save_temp_ind = 0
-    for file in tqdm(all_csv_files):
-        if status == "validate":
-            input_features = []
-            labels = []
-        # read csv file into df
-        split_list = file.split("/")
-        glob_cls_name = split_list[split_list.index(set_type) + 1]
-        file_name = split_list[split_list.index(set_type) + 2]
-        df = pd.read_csv(file, header=0, index_col=False)
-
-        # read audio file into y
-        audio_path = file.replace("csv", "wav")
-        print("Processing file name {}".format(audio_path))
-        y, fs = librosa.load(audio_path, sr=None, mono=True)
-        if not resample:
-            target_fs = fs
-        df = df[(df == "POS").any(axis=1)]
-        df = df.reset_index()
-
-        # For csv files with a column name Call, pick up the global class name
-        if "CALL" in df.columns:
-            cls_list = [glob_cls_name] * len(df)
-        elif "Q" in df.columns:
-            cls_list = ["POS"] * len(df)
+    # get average/min segment length for first five positives
+    average_segment_lengths = {}
+    min_segment_lengths = {}
+    for class_column in df:
+        # get label
+        if class_column in ["Audiofilename", "Starttime", "Endtime", "index"]:
+            continue
+        if class_column == "CALL":
+            label = glob_cls_name
+        elif class_column == "Q":
+            label = "POS"
         else:
-            cls_list = [
-                df.columns[(df == "POS").loc[index]].values
-                for index, row in df.iterrows()
-            ]
-            cls_list = list(chain.from_iterable(cls_list))
-
-        # get average/min segment length for first five positives
-        average_segment_lengths = {}
-        min_segment_lengths = {}
-        for class_column in df:
-            # get label
-            if class_column in ["Audiofilename", "Starttime", "Endtime", "index"]:
+            label = class_column
+        # get first five positives
+        first_5_pos_ind = df.index[df[class_column] == "POS"].tolist()[0:5]
+        if len(first_5_pos_ind) < 5:
+            if status == "train":
                 continue
-            if class_column == "CALL":
-                label = glob_cls_name
-            elif class_column == "Q":
-                label = "POS"
             else:
-                label = class_column
-            # get first five positives
-            first_5_pos_ind = df.index[df[class_column] == "POS"].tolist()[0:5]
-            if len(first_5_pos_ind) < 5:
-                if status == "train":
-                    continue
+                assert 1 == 0
+        average_segment_lengths[label] = np.average(
+            df["Endtime"][first_5_pos_ind] - df["Starttime"][first_5_pos_ind]
+        )
+        min_segment_lengths[label] = np.min(
+            df["Endtime"][first_5_pos_ind] - df["Starttime"][first_5_pos_ind]
+        )
+    if y is None:
+        if normalize:
+            with profiler.stage("normalize"):
+                scale = 0.99 / stream_max_amplitude(audio_path)
+    elif status == "validate" or status == "test" or file_fbank:
+        if resample:
+            with profiler.stage("resample"):
+                y, fs = waveform_cache.load(audio_path, target_fs)
+
+        if normalize:
+            with profiler.stage("normalize"):
+                y = normalize_mono(y)
+
+        if denoise:
+            with profiler.stage("denoise"):
+                if batched_denoise:
+                    y = denoise_file(y, target_fs)
                 else:
-                    assert 1 == 0
-            average_segment_lengths[label] = np.average(
-                df["Endtime"][first_5_pos_ind] - df["Starttime"][first_5_pos_ind]
+                    y = denoise_signal(y, target_fs)
+
+    if status == "validate" or status == "test":
+        # CREATE QUERY SETS
+        # obtain file specific frame_shift for the feature manifest
+        frame_shift = np.round(min_segment_lengths["POS"] / tensor_length * 1000)
+        frame_shift = 1 if frame_shift < 1 else frame_shift
+        segment_overlap = 0.5
+        segment_hop = int(round(tensor_length * segment_overlap))
+        query_mel_name = "query_mel_" + os.path.splitext(file_name)[0] + ".npy"
+        if y is None:
+            # number of frames of the entire file, as computed by kaldi
+            window_shift = int(fs * frame_shift * 0.001)
+            window_size = int(fs * frame_length * 0.001)
+            num_frames = (
+                1 + (num_samples - window_size) // window_shift
+                if num_samples >= window_size
+                else 0
             )
-            min_segment_lengths[label] = np.min(
-                df["Endtime"][first_5_pos_ind] - df["Starttime"][first_5_pos_ind]
+            segment_starts, segment_ends = query_windows(
+                num_frames, tensor_length, segment_hop
             )
-        if status == "validate" or status == "test":
-            if resample:
-                y = librosa.resample(y, orig_sr=fs, target_sr=target_fs)
-                fs = target_fs
 
-            if normalize:
-                y = normalize_mono(y)
+            # offset and scale of a uint8 mel
+            mel_affine = [None, None]
 
-            if denoise:
-                y = denoise_signal(y, target_fs)
+            def write_query_mel(tmp_path):
+                # a compact encoding is written from a float32 mel
+                mel_path = tmp_path
+                if feature_dtype != "float32":
+                    mel_path = tmp_path + ".float32"
+                try:
+                    # a new memmap is zero, which pads the last window
+                    query_mel = np.lib.format.open_memmap(
+                        mel_path,
+                        mode="w+",
+                        dtype=np.float32,
+                        shape=(int(segment_ends[-1]), 128),
+                    )
+                    stream_preprocess(
+                        audio_path,
+                        query_mel,
+                        scale=scale,
+                        frame_length=frame_length,
+                        frame_shift=frame_shift,
+                    )
+                    query_mel.flush()
+                    if feature_dtype != "float32":
+                        mel_affine[:] = save_encoded_npy(
+                            tmp_path, query_mel, feature_dtype
+                        )
+                finally:
+                    if mel_path != tmp_path and os.path.exists(mel_path):
+                        os.remove(mel_path)
 
-            # CREATE QUERY SETS
-            # obtain file specific frame_shift and save to meta.csv
-            frame_shift = np.round(min_segment_lengths["POS"] / tensor_length * 1000)
-            frame_shift = 1 if frame_shift < 1 else frame_shift
-            with open(
-                os.path.join(target_path, "audio", "meta.csv"),
-                "a",
-                newline="",
-                encoding="utf-8",
-            ) as my_file:
-                wr = csv.writer(my_file, delimiter=",")
-                wr.writerow([frame_shift, os.path.splitext(file_name)[0]])
+            # NOTE: includes reading the file and writing the mel
+            with profiler.stage("fbank"):
+                atomic_replace(
+                    os.path.join(target_path, "audio", query_mel_name),
+                    write_query_mel,
+                )
+            if profile:
+                profiler.count(
+                    "bytes_written",
+                    os.path.getsize(os.path.join(target_path, "audio", query_mel_name)),
+                )
+            outputs.append(os.path.join("audio", query_mel_name))
+            # only read back for plotting
+            query_mel = None
+            # the support features are sliced from the saved mel
+            file_mels[frame_shift] = torch.from_numpy(
+                np.load(
+                    os.path.join(target_path, "audio", query_mel_name), mmap_mode="c"
+                )[:num_frames]
+            ).T
+            file_mel_affine = mel_affine
+        else:
             # get mel for entire file
-            fbank = preprocess(
-                None,
-                torch.Tensor(y[None, :]),
-                sample_frequency=target_fs,
-                frame_length=frame_length,
-                frame_shift=frame_shift,
-            )
+            with profiler.stage("fbank"):
+                fbank = preprocess(
+                    None,
+                    torch.Tensor(y[None, :]),
+                    sample_frequency=target_fs,
+                    frame_length=frame_length,
+                    frame_shift=frame_shift,
+                )
             data = fbank.data[0].T
-            # obtain windows and their labels
-            segment_overlap = 0.5
-            segment_hop = int(round(tensor_length * segment_overlap))
-            segment_ind = 0
-            input_features = []
-            labels = []
-            interval_array = pd.arrays.IntervalArray.from_arrays(
-                df["Starttime"].values, df["Endtime"].values
+            # obtain windows
+            segment_starts, segment_ends = query_windows(
+                data.shape[1], tensor_length, segment_hop
             )
-            segment_end_ind = 0
-            while segment_end_ind < data.shape[1]:
-                # add feature
-                segment_start_ind = segment_ind * segment_hop
-                segment_end_ind = segment_start_ind + tensor_length
-                input_feature = data[:, segment_start_ind:segment_end_ind]
-                # pad too short features (at end of file) with zeros
-                if not input_feature.shape[1] == tensor_length:
-                    input_feature = torch.cat(
-                        (
-                            input_feature,
-                            torch.zeros(
-                                (
-                                    input_feature.shape[0],
-                                    tensor_length - input_feature.shape[1],
-                                )
-                            ),
-                        ),
-                        1,
-                    )
-                input_features.append(input_feature.numpy())
-                # check if included in df
-                segment_interval = pd.Interval(
-                    segment_start_ind / 1000, segment_end_ind / 1000
+            # pad too short features (at end of file) with zeros, and store the
+            # mel as (frames, bins) so that every window is a contiguous block
+            query_mel = torch.nn.functional.pad(
+                data, (0, segment_ends[-1] - data.shape[1])
+            ).T.contiguous()
+            encoded, *mel_affine = encode_features(query_mel.numpy(), feature_dtype)
+            save_output(query_mel_name, encoded)
+            num_frames = data.shape[1]
+            # the support features are sliced from the same mel
+            file_mels[frame_shift] = data
+        query_mel_output = os.path.join("audio", query_mel_name)
+        record.update(
+            frame_shift=float(frame_shift),
+            segment_hop=segment_hop,
+            num_windows=len(segment_starts),
+            num_frames=int(num_frames),
+            query_mel=query_mel_output,
+            query_mel_offset=npy_data_offset(
+                os.path.join(target_path, query_mel_output)
+            ),
+            support_data=None,
+            support_labels=None,
+            feature_dtype=feature_dtype,
+            query_mel_affine=mel_affine if feature_dtype == "uint8" else None,
+        )
+        # label the windows
+        # NOTE: window frame indices are compared to the event times in
+        # seconds as index / 1000
+        with profiler.stage("label_windows"):
+            labels = query_window_labels(
+                segment_starts / 1000,
+                segment_ends / 1000,
+                df["Starttime"].values,
+                df["Endtime"].values,
+            )
+        profiler.count("windows", len(labels))
+        profiler.count("frames", num_frames)
+        if PLOT:
+            if query_mel is None:
+                query_mel = decode_features(
+                    np.load(os.path.join(target_path, query_mel_output), mmap_mode="c"),
+                    mel_affine,
                 )
-                is_included = np.any(interval_array.overlaps(segment_interval))
-                # add label
-                label = "POS" if is_included else "NEG"
-                labels.append(label)
-                segment_ind += 1
-                if PLOT:
-                    plt.imshow(input_feature, cmap="hot", interpolation="nearest")
-                    plt.title(label)
-                    plt.savefig(
+            windows = query_mel.unfold(0, tensor_length, segment_hop)
+            for input_feature, label, segment_start_ind in zip(
+                windows, labels, segment_starts
+            ):
+                with profiler.stage("plot"):
+                    renderer.submit(
+                        input_feature,
+                        label,
                         os.path.join(
                             target_path,
                             "plots",
@@ -429,99 +773,374 @@ def prepare_training_val_data(
                                 ],
                             )
                             + ".png",
-                        )
+                        ),
                     )
 
-            np.savez(
-                os.path.join(
-                    target_path, "audio", "query_data_" + os.path.splitext(file_name)[0]
-                ),
-                *input_features
-            )
-            np.save(
-                os.path.join(
-                    target_path,
-                    "audio",
-                    "query_labels_" + os.path.splitext(file_name)[0],
-                ),
-                np.asarray(labels),
+        record["query_labels"] = save_output(
+            "query_labels_" + os.path.splitext(file_name)[0] + ".npy",
+            np.asarray(labels),
+        )
+        labels = []
+        # CREATE SUPPORT SETS
+        # reduce df to 5 lines and class list
+        df = df.head(5)
+        neg_starttimes = []
+        neg_endtimes = []
+        last_pos_end_time = 0.0
+        q_labels = []
+        first_pos_starts_at_zero = False
+        for sample_ind, row in df.iterrows():
+            if row["Starttime"] == 0:
+                first_pos_starts_at_zero = True
+            # get endtime for negative sample
+            new_neg_endtime = row["Starttime"] - 0.1
+            # ensure neg sample has starts before it ends
+            if new_neg_endtime <= last_pos_end_time:
+                # if not select 2ms centered segment to be repeated later
+                end_neg = row["Starttime"]
+                if sample_ind == 0:
+                    start_neg = 0
+                else:
+                    start_neg = df["Endtime"][sample_ind - 1]
+                last_pos_end_time = start_neg + (end_neg - start_neg) / 2 - 0.01
+                new_neg_endtime = last_pos_end_time + 0.02
+            # append neg segment
+            neg_starttimes.append(last_pos_end_time)
+            neg_endtimes.append(new_neg_endtime)
+            q_labels.append("NEG")
+            # select new starttime for next negative
+            last_pos_end_time = row["Endtime"] + 0.1
+            # ensure neg starttime doesn't start after onset new pos
+            if sample_ind < 4:
+                last_pos_end_time = (
+                    row["Endtime"]
+                    if last_pos_end_time > df["Starttime"][sample_ind + 1]
+                    else last_pos_end_time
+                )
+            # append pos segment
+            duration = row["Endtime"] - row["Starttime"]
+            margin = min_segment_lengths["POS"] / 3
+            if duration + 2 * margin < tensor_length * frame_shift / 1000:
+                margin = tensor_length * frame_shift / 1000 - duration
+
+            pos_start_time = (
+                0 if row["Starttime"] - margin < 0 else row["Starttime"] - margin
             )
-            input_features = []
-            labels = []
-            # CREATE SUPPORT SETS
-            # reduce df to 5 lines and class list
-            df = df.head(5)
-            neg_starttimes = []
-            neg_endtimes = []
-            last_pos_end_time = 0.0
-            q_labels = []
-            first_pos_starts_at_zero = False
-            for sample_ind, row in df.iterrows():
-                if row["Starttime"] == 0:
-                    first_pos_starts_at_zero = True
-                # get endtime for negative sample
-                new_neg_endtime = row["Starttime"] - 0.1
-                # ensure neg sample has starts before it ends
-                if new_neg_endtime <= last_pos_end_time:
-                    # if not select 2ms centered segment to be repeated later
-                    end_neg = row["Starttime"]
-                    if sample_ind == 0:
-                        start_neg = 0
-                    else:
-                        start_neg = df["Endtime"][sample_ind - 1]
-                    last_pos_end_time = start_neg + (end_neg - start_neg) / 2 - 0.01
-                    new_neg_endtime = last_pos_end_time + 0.02
-                # append neg segment
-                neg_starttimes.append(last_pos_end_time)
-                neg_endtimes.append(new_neg_endtime)
-                q_labels.append("NEG")
-                # select new starttime for next negative
-                last_pos_end_time = row["Endtime"] + 0.1
-                # ensure neg starttime doesn't start after onset new pos
-                if sample_ind < 4:
-                    last_pos_end_time = (
-                        row["Endtime"]
-                        if last_pos_end_time > df["Starttime"][sample_ind + 1]
-                        else last_pos_end_time
-                    )
-                # append pos segment
-                duration = row["Endtime"] - row["Starttime"]
-                margin = min_segment_lengths["POS"] / 3
-                if duration + 2 * margin < tensor_length * frame_shift / 1000:
-                    margin = tensor_length * frame_shift / 1000 - duration
-
-                pos_start_time = (
-                    0 if row["Starttime"] - margin < 0 else row["Starttime"] - margin
+            neg_starttimes.append(pos_start_time)
+            neg_endtimes.append(row["Endtime"] + margin)
+            q_labels.append("POS")
+
+        df = pd.DataFrame(
+            {
+                "Audiofilename": [file_name] * len(neg_starttimes),
+                "Starttime": neg_starttimes,
+                "Endtime": neg_endtimes,
+                "Q": q_labels,
+            }
+        )
+        if first_pos_starts_at_zero:
+            max_neg_idx = (
+                df[df["Q"] == "NEG"]["Endtime"] - df[df["Q"] == "NEG"]["Starttime"]
+            ).idxmax()
+            df["Starttime"][0] = df["Starttime"][max_neg_idx]
+            df["Endtime"][0] = df["Endtime"][max_neg_idx]
+        cls_list = df["Q"].values
+        min_segment_lengths["NEG"] = min_segment_lengths["POS"]
+        assert np.all(df["Endtime"] - df["Starttime"] > 0)
+
+    preprocess_df(df)
+    if renderer is not None:
+        with profiler.stage("plot"):
+            renderer.close()
+    if status == "train":
+        record["num_features"] = len(labels)
+    stats = profiler.as_dict() if profile else None
+    return input_features, labels, record, outputs, stats
+
+
+def _init_worker():
+    # avoid oversubscription, each worker processes a single file at a time
+    torch.set_num_threads(1)
+
+
+def prepare_training_val_data(
+    status,
+    set_type,
+    overwrite,
+    tensor_length=128,
+    frame_length=25.0,
+    denoise=False,
+    normalize=False,
+    resample=False,
+    target_fs=16000,
+    workers=1,
+    file_fbank=False,
+    stream=False,
+    resampler=DEFAULT_RESAMPLER,
+    waveform_cache_dir=DEFAULT_CACHE_DIR,
+    batched_denoise=False,
+    plot_every=1,
+    root_dir="/data/DCASE/Development_Set",
+    target_root="/data/DCASEfewshot",
+    profile=False,
+    profile_files=False,
+    feature_dtype="float32",
+):
+    """Prepare the Training_Set
+
+    Training set is used for training *and* validating the encoder.
+
+    All positive samples are converted into mel features from which
+    a random tensor_length long window can be selected. If PLOT=True,
+    pngs are saved to separate folder showing the selected features (only
+    every plot_every-th feature of a file).
+
+    All input feature tensors and their labels are saved into a single
+    ragged feature store (data_utils/feature_store.py). Separate
+    directories are created for different params, so that they can be
+    found again during training.
+
+    With workers > 1 the audio files are processed in a pool of worker
+    processes. Results are merged in the order of the serial run, so the
+    saved features, labels and feature manifest are identical.
+
+    Processed files are recorded in a source manifest
+    (data_utils/manifest.py). Without overwrite, a rerun only processes new
+    or changed files, so that an interrupted run can be resumed and
+    corrected annotations only cost the files they belong to.
+
+    The set is read from root_dir/set_type and saved below target_root.
+    Returns the directory the prepared data was saved to.
+
+    With profile the time spent in every stage (load, resample, normalize,
+    denoise, fbank, label_windows, save, ...) and the number of events,
+    frames and bytes written are saved as <hash directory>_profile.json
+    next to the hash directory, with profile_files also per file. With
+    workers > 1 the stage times of all workers are added up.
+    """
+    run_start = time.perf_counter()
+    profiler = StageProfiler(enabled=profile)
+
+    # Create directories for saving
+    my_hash_dict = {
+        "resample": resample,
+        "denoise": denoise,
+        "normalize": normalize,
+        "frame_length": frame_length,
+        "tensor_length": tensor_length,
+        "set_type": set_type,
+    }
+    if resample:
+        my_hash_dict["tartget_fs"] = target_fs
+        if resampler != DEFAULT_RESAMPLER:
+            my_hash_dict["resampler"] = resampler
+    if denoise and batched_denoise:
+        my_hash_dict["batched_denoise"] = batched_denoise
+    if file_fbank:
+        my_hash_dict["file_fbank"] = file_fbank
+    if feature_dtype != "float32":
+        my_hash_dict["feature_dtype"] = feature_dtype
+    hash_dir_name = hashlib.sha1(
+        json.dumps(my_hash_dict, sort_keys=True).encode()
+    ).hexdigest()
+    target_path = os.path.join(target_root, status, hash_dir_name)
+    if overwrite:
+        if os.path.exists(target_path):
+            shutil.rmtree(target_path)
+
+    if not os.path.exists(os.path.join(target_path, "audio")):
+        os.makedirs(os.path.join(target_path, "audio"))
+
+    if not os.path.exists(os.path.join(target_path, "plots")):
+        os.makedirs(os.path.join(target_path, "plots"))
+
+    print("=== Processing data ===")
+    with profiler.stage("scan"):
+        # collect all meta files, one for each audio file
+        all_csv_files = [
+            file
+            for path_dir, _, _ in os.walk(os.path.join(root_dir, set_type))
+            for file in glob(os.path.join(path_dir, "*.csv"))
+        ]
+
+        # skip files that were processed before and did not change since
+        manifest = SourceManifest(target_path)
+        keys = [os.path.relpath(file, root_dir) for file in all_csv_files]
+        removed_keys = manifest.remove_stale(keys)
+        # NOTE: entries of runs before the feature manifest have no record
+        todo = [
+            (key, file)
+            for key, file in zip(keys, all_csv_files)
+            if not manifest.is_done(key, file, file.replace("csv", "wav"))
+            or "record" not in manifest.entries[key]
+        ]
+    print(
+        "{} of {} files up to date, {} removed".format(
+            len(all_csv_files) - len(todo), len(all_csv_files), len(removed_keys)
+        )
+    )
+    if status == "train" and not os.path.exists(os.path.join(target_path, "parts")):
+        os.makedirs(os.path.join(target_path, "parts"))
+
+    # loop through all meta files
+    worker = partial(
+        process_file,
+        status=status,
+        set_type=set_type,
+        target_path=target_path,
+        tensor_length=tensor_length,
+        frame_length=frame_length,
+        denoise=denoise,
+        normalize=normalize,
+        resample=resample,
+        target_fs=target_fs,
+        file_fbank=file_fbank,
+        stream=stream,
+        resampler=resampler,
+        waveform_cache_dir=waveform_cache_dir,
+        batched_denoise=batched_denoise,
+        plot_every=plot_every,
+        profile=profile,
+        feature_dtype=feature_dtype,
+    )
+    todo_files = [file for _, file in todo]
+    if workers > 1:
+        pool = Pool(workers, initializer=_init_worker)
+        results = pool.imap(worker, todo_files)
+    else:
+        pool = None
+        results = map(worker, todo_files)
+    file_stats = {}
+    # imap yields in submission order, independent of completion order
+    for (key, file), result in tqdm(zip(todo, results), total=len(todo)):
+        file_features, file_labels, record, outputs, stats = result
+        profiler.merge(stats)
+        if profile_files:
+            file_stats[key] = stats
+        if status == "train":
+            # keep the features of every file, so that the training set can
+            # be rebuilt without processing unchanged files again. They are
+            # kept in the encoding of the store, with the offset and scale
+            # of every uint8 feature
+            part = os.path.join("parts", key.replace(os.sep, "__") + ".npz")
+            with profiler.stage("save"):
+                encoded = [
+                    encode_features(feature, feature_dtype) for feature in file_features
+                ]
+                scales = {}
+                if feature_dtype == "uint8":
+                    scales["scales"] = np.array(
+                        [[offset, scale] for _, offset, scale in encoded]
+                    ).reshape(-1, 2)
+                atomic_savez(
+                    os.path.join(target_path, part),
+                    *[features for features, _, _ in encoded],
+                    labels=np.asarray(file_labels, dtype=str),
+                    **scales
+                )
+            if profile:
+                profiler.count(
+                    "bytes_written", os.path.getsize(os.path.join(target_path, part))
                 )
-                neg_starttimes.append(pos_start_time)
-                neg_endtimes.append(row["Endtime"] + margin)
-                q_labels.append("POS")
-
-            df = pd.DataFrame(
-                {
-                    "Audiofilename": [file_name] * len(neg_starttimes),
-                    "Starttime": neg_starttimes,
-                    "Endtime": neg_endtimes,
-                    "Q": q_labels,
-                }
+            outputs = outputs + [part]
+        with profiler.stage("manifest"):
+            manifest.update(
+                key, file, file.replace("csv", "wav"), outputs, record=record
             )
-            if first_pos_starts_at_zero:
-                max_neg_idx = (
-                    df[df["Q"] == "NEG"]["Endtime"] - df[df["Q"] == "NEG"]["Starttime"]
-                ).idxmax()
-                df["Starttime"][0] = df["Starttime"][max_neg_idx]
-                df["Endtime"][0] = df["Endtime"][max_neg_idx]
-            cls_list = df["Q"].values
-            min_segment_lengths["NEG"] = min_segment_lengths["POS"]
-            assert np.all(df["Endtime"] - df["Starttime"] > 0)
-
-        preprocess_df(df)
-    # save preprocessed data
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    # write the feature manifest of all files once, from the source manifest
+    records = [copy(manifest.entries[key]["record"]) for key in keys]
     if status == "train":
-        np.savez(os.path.join(target_path, "audio", "data"), *input_features)
-        np.save(os.path.join(target_path, "audio", "labels"), np.asarray(labels))
+        # rows of each file in the store, merged in the order of keys
+        store_row = 0
+        for record in records:
+            num_features = record.pop("num_features")
+            record["store_rows"] = [store_row, store_row + num_features]
+            store_row += num_features
+    with profiler.stage("manifest"):
+        write_feature_manifest(target_path, records)
+
+    if status == "train" and (
+        todo
+        or removed_keys
+        or not ragged_store_exists(os.path.join(target_path, "audio"))
+    ):
+        # save preprocessed data, merged in the order of all_csv_files
+        labels = []
+        input_features = []
+        scales = []
+        for key in keys:
+            part = [
+                output
+                for output in manifest.entries[key]["outputs"]
+                if output.startswith("parts")
+            ][0]
+            with np.load(os.path.join(target_path, part)) as file_data:
+                file_labels = file_data["labels"]
+                file_features = [
+                    file_data["arr_{}".format(i)] for i in range(len(file_labels))
+                ]
+                if feature_dtype == "uint8" and "scales" not in file_data:
+                    # NOTE: float32 parts of earlier runs are encoded here
+                    encoded = [
+                        encode_features(feature, feature_dtype)
+                        for feature in file_features
+                    ]
+                    file_features = [features for features, _, _ in encoded]
+                    file_scales = [[offset, scale] for _, offset, scale in encoded]
+                elif feature_dtype == "uint8":
+                    file_scales = file_data["scales"]
+                input_features.extend(file_features)
+                if feature_dtype == "uint8":
+                    scales.extend(file_scales)
+                labels.extend(file_labels)
+        with profiler.stage("store"):
+            write_ragged_store(
+                os.path.join(target_path, "audio"),
+                input_features,
+                labels,
+                feature_dtype,
+                np.asarray(scales).reshape(-1, 2) if feature_dtype == "uint8" else None,
+            )
+        if profile:
+            for store_file in [
+                FEATURES_FILE,
+                OFFSETS_FILE,
+                LABEL_IDS_FILE,
+                CLASSES_FILE,
+                SCALES_FILE,
+            ]:
+                store_path = os.path.join(target_path, "audio", store_file)
+                if os.path.exists(store_path):
+                    profiler.count("bytes_written", os.path.getsize(store_path))
+
+    if profile:
+        profiler.count("files", len(todo))
+        report = dict(
+            status=status,
+            set_type=set_type,
+            hash_dir=hash_dir_name,
+            workers=workers,
+            num_files=len(all_csv_files),
+            wall_seconds=time.perf_counter() - run_start,
+            **profiler.as_dict()
+        )
+        if profile_files:
+            report["files"] = file_stats
+        report_path = target_path + "_profile.json"
+
+        def write_report(tmp_path):
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=1)
+
+        atomic_replace(report_path, write_report)
+        print(" Profile saved to {}".format(report_path))
 
     print(" Feature extraction complete")
+    return target_path
 
 
 if __name__ == "__main__":
@@ -594,6 +1213,91 @@ if __name__ == "__main__":
         required=False,
         type=int,
     )
+    parser.add_argument(
+        "--workers",
+        help="Number of worker processes, each processing a single audio file",
+        default=1,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--file_fbank",
+        help="Compute the mel once for the entire file and slice the events from it",
+        default=False,
+        required=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--stream",
+        help="Read validate/test audio in blocks, with a bounded memory use",
+        default=False,
+        required=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--resampler",
+        help="librosa res_type (e.g. 'kaiser_best', 'kaiser_fast') or 'polyphase'",
+        default=DEFAULT_RESAMPLER,
+        required=False,
+        type=str,
+    )
+    parser.add_argument(
+        "--waveform_cache_dir",
+        help="Directory of the decoded waveform cache, '' disables the cache",
+        default=DEFAULT_CACHE_DIR,
+        required=False,
+        type=str,
+    )
+    parser.add_argument(
+        "--batched_denoise",
+        help="Estimate the noise once per file and denoise segments in batches",
+        default=False,
+        required=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--plot_every",
+        help="Only plot every n-th feature if plotting is enabled",
+        default=1,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--root_dir",
+        help="Directory containing the set_type directories",
+        default="/data/DCASE/Development_Set",
+        required=False,
+        type=str,
+    )
+    parser.add_argument(
+        "--target_root",
+        help="Directory to save the prepared data to",
+        default="/data/DCASEfewshot",
+        required=False,
+        type=str,
+    )
+    parser.add_argument(
+        "--profile",
+        help="Save the time spent per preprocessing stage as a json report",
+        default=False,
+        required=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--profile_files",
+        help="Add a per file breakdown to the --profile report",
+        default=False,
+        required=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--feature_dtype",
+        help="Encoding of the saved features: " + ", ".join(FEATURE_DTYPES),
+        default="float32",
+        required=False,
+        choices=FEATURE_DTYPES,
+        type=str,
+    )
     # check input
     cli_args = parser.parse_args()
     assert (
@@ -607,6 +1311,9 @@ if __name__ == "__main__":
         assert cli_args.set_type == "Training_Set"
     elif cli_args.status == "test":
         assert cli_args.set_type == "Evaluation_Set"
+    if cli_args.stream:
+        # NOTE: resampling and denoising need the entire waveform
+        assert not (cli_args.resample or cli_args.denoise)
 
     prepare_training_val_data(
         cli_args.status,
@@ -618,4 +1325,16 @@ if __name__ == "__main__":
         cli_args.normalize,
         cli_args.resample,
         cli_args.target_fs,
+        cli_args.workers,
+        cli_args.file_fbank,
+        cli_args.stream,
+        cli_args.resampler,
+        cli_args.waveform_cache_dir if cli_args.waveform_cache_dir else None,
+        cli_args.batched_denoise,
+        cli_args.plot_every,
+        cli_args.root_dir,
+        cli_args.target_root,
+        cli_args.profile,
+        cli_args.profile_files,
+        cli_args.feature_dtype,
     )
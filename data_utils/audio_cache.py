@@ -0,0 +1,157 @@
+"""
+Cache of decoded waveforms and log-mel features for the ESC-50 datasets.
+
+The datasets load every clip again in every epoch. An AudioCache keeps
+the 16 kHz mono waveforms and their log-mel features in two tiers:
+
+    memory  an LRU of arrays, up to max_memory_bytes per process (every
+            DataLoader worker has its own)
+    disk    .npy files in cache_dir: the waveforms of the content-addressed
+            WaveformCache (data_utils/waveform_cache.py), which are opened
+            as memmaps, and the features in cache_dir/fbank
+
+Entries are keyed by the path, size and mtime of the file (the disk tier
+by the sha1 of its content) and the preprocessing parameters, so changed
+files or parameters miss the cache.
+
+The log-mel features are those of BEATs.preprocess: kaldi fbank of the
+waveform scaled to 16 bit, normalized with the AudioSet mean and std.
+"""
+import collections
+import os
+
+import numpy as np
+import torch
+
+from BEATs.fbank import batched_fbank
+from data_utils.manifest import atomic_save
+from data_utils.waveform_cache import (
+    DEFAULT_CACHE_DIR,
+    DEFAULT_RESAMPLER,
+    WaveformCache,
+)
+
+# as in BEATs.preprocess
+FBANK_MEAN = 15.41663
+FBANK_STD = 6.55582
+
+
+def beats_fbank(
+    waveform,
+    sample_frequency=16000,
+    num_mel_bins=128,
+    frame_length=25.0,
+    frame_shift=10.0,
+):
+    """Normalized log-mel features of a waveform, size (frames, bins)"""
+    fbank, _ = batched_fbank(
+        torch.as_tensor(waveform)[None] * 2**15,
+        num_mel_bins=num_mel_bins,
+        sample_frequency=sample_frequency,
+        frame_length=frame_length,
+        frame_shift=frame_shift,
+    )
+    return ((fbank[0] - FBANK_MEAN) / (2 * FBANK_STD)).numpy()
+
+
+class AudioCache:
+    """Load waveforms and log-mel features through a memory and a disk tier
+
+    With cache_dir None there is no disk tier.
+    """
+
+    def __init__(
+        self,
+        cache_dir=DEFAULT_CACHE_DIR,
+        target_fs=16000,
+        max_memory_bytes=1 << 30,
+        resampler=DEFAULT_RESAMPLER,
+        num_mel_bins=128,
+        frame_length=25.0,
+        frame_shift=10.0,
+    ):
+        self.cache_dir = cache_dir
+        self.target_fs = target_fs
+        self.max_memory_bytes = max_memory_bytes
+        self.resampler = resampler
+        self.fbank_params = (num_mel_bins, frame_length, frame_shift)
+        self.waveform_cache = WaveformCache(cache_dir, resampler)
+        self.memory = collections.OrderedDict()
+        self.memory_bytes = 0
+
+    def memory_key(self, audio_path, *params):
+        stat = os.stat(audio_path)
+        return (os.path.realpath(audio_path), stat.st_size, stat.st_mtime_ns, *params)
+
+    def recall(self, key):
+        array = self.memory.get(key)
+        if array is not None:
+            self.memory.move_to_end(key)
+        return array
+
+    def remember(self, key, array):
+        # arrays larger than the budget are not kept
+        if array.nbytes <= self.max_memory_bytes:
+            self.memory[key] = array
+            self.memory_bytes += array.nbytes
+            while self.memory_bytes > self.max_memory_bytes:
+                _, evicted = self.memory.popitem(last=False)
+                self.memory_bytes -= evicted.nbytes
+        return array
+
+    def waveform(self, audio_path):
+        """float32 mono waveform at target_fs, size (samples,)"""
+        key = self.memory_key(audio_path, "waveform", self.target_fs, self.resampler)
+        waveform = self.recall(key)
+        if waveform is None:
+            waveform, _ = self.waveform_cache.load(audio_path, self.target_fs)
+            # read the memmap of the disk tier into memory
+            waveform = self.remember(key, np.array(waveform, dtype=np.float32))
+        return waveform
+
+    def fbank_path(self, audio_path):
+        return os.path.join(
+            self.cache_dir,
+            "fbank",
+            "_".join(
+                [
+                    self.waveform_cache.file_hash(audio_path),
+                    str(self.target_fs),
+                    self.resampler,
+                    *[str(param) for param in self.fbank_params],
+                ]
+            )
+            + ".npy",
+        )
+
+    def fbank(self, audio_path):
+        """float32 log-mel features, size (frames, bins)"""
+        key = self.memory_key(
+            audio_path, "fbank", self.target_fs, self.resampler, *self.fbank_params
+        )
+        fbank = self.recall(key)
+        if fbank is None:
+            path = None if self.cache_dir is None else self.fbank_path(audio_path)
+            if path is not None and os.path.exists(path):
+                fbank = np.load(path)
+            else:
+                num_mel_bins, frame_length, frame_shift = self.fbank_params
+                fbank = beats_fbank(
+                    self.waveform(audio_path),
+                    sample_frequency=self.target_fs,
+                    num_mel_bins=num_mel_bins,
+                    frame_length=frame_length,
+                    frame_shift=frame_shift,
+                )
+                if path is not None:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    atomic_save(path, fbank)
+            fbank = self.remember(key, fbank)
+        return fbank
+
+    def load(self, audio_path, features="waveform"):
+        """The waveform or log-mel features (features="fbank") of a file"""
+        assert features in ["waveform", "fbank"], "unknown features " + features
+        if features == "fbank":
+            return self.fbank(audio_path)
+        return self.waveform(audio_path)
@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+"""
+Tune the throughput settings of the loaders and of the evaluation on the
+current machine.
+
+Two sets of settings are measured:
+
+    training loader  the num_workers and prefetch_factor of the
+                     train_dataloader of a datamodule (DCASEDataModule,
+                     ECS50DataModule, miniECS50DataModule), built from the
+                     data section of a trainer config
+    evaluation       the batch size of the query embeddings of
+                     evaluateDCASE.py (with random windows), and the
+                     num_workers of its query loader (with a random mel)
+
+The best settings are written as yaml fragments: the data section is passed
+as a second --config to fine_tune/trainer.py or prototypicalbeats/trainer.py,
+and the evaluation settings as --tuned_config to evaluate/evaluateDCASE.py.
+
+Candidates whose peak memory exceeds the budget are skipped. Memory is the
+resident memory of the process and its workers, read from /proc (pages
+shared by copy-on-write are counted for every worker, so it is an upper
+bound), or the peak memory allocated by torch on cuda. Of the candidates
+within tolerance of the best throughput, the one with the fewest workers,
+smallest prefetch_factor or smallest batch is kept.
+"""
+import argparse
+import importlib
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+import yaml
+from yaml import FullLoader
+from torch.utils.data import DataLoader
+
+
+def process_rss(pid):
+    with open("/proc/{}/status".format(pid)) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def process_tree_rss(pid=None):
+    """Resident memory of a process and all its descendants, in bytes"""
+    pid = os.getpid() if pid is None else pid
+    try:
+        rss = process_rss(pid)
+        for task in os.listdir("/proc/{}/task".format(pid)):
+            with open("/proc/{}/task/{}/children".format(pid, task)) as f:
+                rss += sum(process_tree_rss(int(child)) for child in f.read().split())
+    except (FileNotFoundError, ProcessLookupError):
+        # the process exited while it was read
+        return 0
+    return rss
+
+
+def available_memory():
+    """MemAvailable of /proc/meminfo, in bytes"""
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("MemAvailable not in /proc/meminfo")
+
+
+def time_loader(loader, num_batches):
+    """Startup time, batches per second after the first batch and peak memory"""
+    start = time.perf_counter()
+    iterator = iter(loader)
+    next(iterator)
+    startup_time = time.perf_counter() - start
+    peak_rss = process_tree_rss()
+    count = 0
+    start = time.perf_counter()
+    for _ in range(num_batches):
+        try:
+            next(iterator)
+        except StopIteration:
+            break
+        count += 1
+        peak_rss = max(peak_rss, process_tree_rss())
+    elapsed = time.perf_counter() - start
+    # shuts the workers down
+    del iterator
+    return startup_time, count / max(elapsed, 1e-9), peak_rss
+
+
+def pick_best(results, tolerance):
+    """The cheapest result within tolerance of the best throughput
+
+    results are dicts with a "throughput", a "memory" and a "cost" (a
+    tuple, lower is cheaper), those over the memory budget have None.
+    """
+    results = [result for result in results if result["throughput"] is not None]
+    assert len(results) > 0, "no candidate fits into the memory budget"
+    best = max(result["throughput"] for result in results)
+    return min(
+        [
+            result
+            for result in results
+            if result["throughput"] >= (1 - tolerance) * best
+        ],
+        key=lambda result: result["cost"],
+    )
+
+
+def tune_loader(
+    make_loader,
+    worker_candidates,
+    prefetch_candidates,
+    num_batches,
+    memory_budget,
+    include_startup=False,
+):
+    """Measure make_loader(num_workers, prefetch_factor) for all candidates
+
+    With include_startup, the throughput is that of a single pass including
+    the startup of the workers, for loaders that are built for every pass.
+    """
+    results = []
+    for num_workers in worker_candidates:
+        # prefetch_factor only applies to workers
+        for prefetch_factor in prefetch_candidates if num_workers > 0 else [2]:
+            startup_time, throughput, memory = time_loader(
+                make_loader(num_workers, prefetch_factor), num_batches
+            )
+            if include_startup:
+                throughput = (num_batches + 1) / (
+                    startup_time + num_batches / throughput
+                )
+            print(
+                "{:>8} {:>9} {:>12.2f} {:>10.1f} {:>12.0f}".format(
+                    num_workers,
+                    prefetch_factor,
+                    startup_time,
+                    throughput,
+                    memory / 2**20,
+                )
+            )
+            results.append(
+                {
+                    "num_workers": num_workers,
+                    "prefetch_factor": prefetch_factor,
+                    "throughput": throughput if memory <= memory_budget else None,
+                    "memory": memory,
+                    "cost": (num_workers, prefetch_factor),
+                }
+            )
+    return results
+
+
+def time_embedding(model, batch_size, num_mel_bins, tensor_length, device, num_batches):
+    """Windows per second of model.get_embeddings and peak memory"""
+    windows = torch.randn((batch_size, num_mel_bins, tensor_length), device=device)
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    with torch.no_grad():
+        # the first batch sets up the kernels
+        model.get_embeddings(windows, padding_mask=None)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        for _ in range(num_batches):
+            model.get_embeddings(windows, padding_mask=None)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        elapsed = time.perf_counter() - start
+    if device.type == "cuda":
+        memory = torch.cuda.max_memory_allocated(device)
+    else:
+        memory = process_tree_rss()
+    return batch_size * num_batches / elapsed, memory
+
+
+def tune_batch_size(
+    model,
+    batch_candidates,
+    num_mel_bins,
+    tensor_length,
+    device,
+    num_batches,
+    memory_budget,
+):
+    """Measure the embeddings for increasing batch sizes, up to the budget"""
+    results = []
+    for batch_size in sorted(batch_candidates):
+        try:
+            throughput, memory = time_embedding(
+                model, batch_size, num_mel_bins, tensor_length, device, num_batches
+            )
+        except RuntimeError as error:
+            if "out of memory" not in str(error):
+                raise
+            print("{:>10} {:>12}".format(batch_size, "out of memory"))
+            break
+        print(
+            "{:>10} {:>12.1f} {:>12.0f}".format(
+                batch_size, throughput, memory / 2**20
+            )
+        )
+        if memory > memory_budget:
+            # larger batches need more
+            break
+        results.append(
+            {
+                "batch_size": batch_size,
+                "throughput": throughput,
+                "memory": memory,
+                "cost": (batch_size,),
+            }
+        )
+    return results
+
+
+def load_datamodule(data_config, datamodule):
+    """The datamodule of the data section of a trainer config
+
+    The class is the class_path of the section, or datamodule (a dotted
+    path) for configs of a fixed datamodule class.
+    """
+    with open(data_config) as f:
+        data_cfg = yaml.load(f, Loader=FullLoader)["data"] or {}
+    class_path = data_cfg.get("class_path", datamodule)
+    init_args = data_cfg.get("init_args", {}) if "class_path" in data_cfg else data_cfg
+    module_name, class_name = class_path.rsplit(".", 1)
+    datamodule_class = getattr(importlib.import_module(module_name), class_name)
+    return datamodule_class(**init_args), "class_path" in data_cfg, class_path
+
+
+def write_config(path, settings):
+    with open(path, "w") as f:
+        yaml.dump(settings, f, default_flow_style=False)
+    print("[INFO] Wrote {}".format(path))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--data_config",
+        help="Trainer config whose datamodule loader is tuned",
+        default=None,
+        required=False,
+        type=str,
+    )
+    parser.add_argument(
+        "--datamodule",
+        help="Datamodule class of a data config without class_path",
+        default="datamodules.ECS50DataModule.ECS50DataModule",
+        required=False,
+        type=str,
+    )
+    parser.add_argument(
+        "--data_output",
+        help="Path of the data section with the best loader settings",
+        default="./autotune_data.yaml",
+        required=False,
+        type=str,
+    )
+    parser.add_argument(
+        "--tune_evaluation",
+        help="Tune the batch size and workers of evaluateDCASE.py",
+        default=False,
+        required=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--model_path",
+        help="BEATs checkpoint of the evaluated ProtoBEATsModel",
+        default="/data/BEATs/BEATs_iter3_plus_AS2M.pt",
+        required=False,
+        type=str,
+    )
+    parser.add_argument(
+        "--tensor_length",
+        help="Number of frames of a query window",
+        default=128,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--num_mel_bins",
+        help="Number of mel bins of a query window",
+        default=128,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--evaluation_output",
+        help="Path of the config with the best evaluation settings",
+        default="./autotune_evaluation.yaml",
+        required=False,
+        type=str,
+    )
+    parser.add_argument(
+        "--worker_candidates",
+        help="Candidate num_workers, those above the number of CPUs are skipped",
+        default=[0, 1, 2, 4, 8, 16],
+        nargs="+",
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--prefetch_candidates",
+        help="Candidate prefetch_factor",
+        default=[2, 4, 8],
+        nargs="+",
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--batch_candidates",
+        help="Candidate batch sizes of the query embeddings",
+        default=[1, 2, 4, 8, 16, 32, 64, 128, 256],
+        nargs="+",
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--num_batches",
+        help="Number of batches timed per candidate",
+        default=20,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--memory_budget",
+        help="Memory budget in GiB, 80%% of the available memory by default",
+        default=None,
+        required=False,
+        type=float,
+    )
+    parser.add_argument(
+        "--tolerance",
+        help="Relative throughput traded for fewer workers or smaller batches",
+        default=0.05,
+        required=False,
+        type=float,
+    )
+    parser.add_argument(
+        "--device",
+        help="Device of the query embeddings",
+        default="cuda" if torch.cuda.is_available() else "cpu",
+        required=False,
+        type=str,
+    )
+
+    cli_args = parser.parse_args()
+    assert (
+        cli_args.data_config is not None or cli_args.tune_evaluation
+    ), "nothing to tune, give --data_config and/or --tune_evaluation"
+
+    if cli_args.memory_budget is None:
+        memory_budget = 0.8 * available_memory()
+    else:
+        memory_budget = cli_args.memory_budget * 2**30
+    worker_candidates = [
+        num_workers
+        for num_workers in cli_args.worker_candidates
+        if num_workers <= os.cpu_count()
+    ]
+    print("[INFO] Memory budget {:.0f} MiB".format(memory_budget / 2**20))
+
+    if cli_args.data_config is not None:
+        datamodule, has_class_path, class_path = load_datamodule(
+            cli_args.data_config, cli_args.datamodule
+        )
+
+        def make_train_loader(num_workers, prefetch_factor):
+            datamodule.num_workers = num_workers
+            datamodule.prefetch_factor = prefetch_factor
+            return datamodule.train_dataloader()
+
+        print("[INFO] Tuning the train loader of {}".format(class_path))
+        print(
+            "{:>8} {:>9} {:>12} {:>10} {:>12}".format(
+                "workers", "prefetch", "startup [s]", "batches/s", "memory [MiB]"
+            )
+        )
+        best = pick_best(
+            tune_loader(
+                make_train_loader,
+                worker_candidates,
+                cli_args.prefetch_candidates,
+                cli_args.num_batches,
+                memory_budget,
+            ),
+            cli_args.tolerance,
+        )
+        settings = {
+            "num_workers": best["num_workers"],
+            "prefetch_factor": best["prefetch_factor"],
+        }
+        if has_class_path:
+            settings = {"class_path": class_path, "init_args": settings}
+        write_config(cli_args.data_output, {"data": settings})
+
+    if cli_args.tune_evaluation:
+        # imported here, as it loads the training stack
+        from prototypicalbeats.prototraining import ProtoBEATsModel
+        from datamodules.TestDCASEDataModule import QueryDatasetDCASE
+
+        device = torch.device(cli_args.device)
+        model = ProtoBEATsModel(model_path=cli_args.model_path).to(device).eval()
+        print("[INFO] Tuning the batch size of the query embeddings")
+        print("{:>10} {:>12} {:>12}".format("batch", "windows/s", "memory [MiB]"))
+        best_batch = pick_best(
+            tune_batch_size(
+                model,
+                cli_args.batch_candidates,
+                cli_args.num_mel_bins,
+                cli_args.tensor_length,
+                device,
+                cli_args.num_batches,
+                memory_budget,
+            ),
+            cli_args.tolerance,
+        )
+        del model
+        batch_size = best_batch["batch_size"]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # a random mel of (frames, bins), as saved for a query file
+            num_windows = batch_size * (cli_args.num_batches + 1)
+            segment_hop = cli_args.tensor_length // 2
+            mel_path = os.path.join(tmp_dir, "query_mel.npy")
+            np.save(
+                mel_path,
+                np.random.default_rng(42).standard_normal(
+                    (
+                        (num_windows - 1) * segment_hop + cli_args.tensor_length,
+                        cli_args.num_mel_bins,
+                    ),
+                    dtype=np.float32,
+                ),
+            )
+            query_set = QueryDatasetDCASE(
+                mel_path,
+                ["NEG"] * num_windows,
+                tensor_length=cli_args.tensor_length,
+                segment_hop=segment_hop,
+                label_dict={"NEG": 0, "POS": 1},
+            )
+
+            def make_query_loader(num_workers, prefetch_factor):
+                # as in evaluateDCASE.py
+                return DataLoader(
+                    query_set,
+                    batch_size=batch_size,
+                    shuffle=False,
+                    num_workers=num_workers,
+                )
+
+            print("[INFO] Tuning the workers of the query loader")
+            print(
+                "{:>8} {:>9} {:>12} {:>10} {:>12}".format(
+                    "workers", "prefetch", "startup [s]", "batches/s", "memory [MiB]"
+                )
+            )
+            best_workers = pick_best(
+                tune_loader(
+                    make_query_loader,
+                    worker_candidates,
+                    [2],
+                    cli_args.num_batches,
+                    memory_budget,
+                    # evaluateDCASE.py builds a query loader per file
+                    include_startup=True,
+                ),
+                cli_args.tolerance,
+            )
+        write_config(
+            cli_args.evaluation_output,
+            {"batch_size": batch_size, "num_workers": best_workers["num_workers"]},
+        )
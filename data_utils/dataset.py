@@ -1,27 +1,55 @@
 from abc import abstractmethod
 
 import random
-import librosa
 import os
 
 from sklearn.preprocessing import LabelEncoder
 from typing import List, Tuple, Iterator
 
+import numpy as np
 import torch
 from torch import Tensor
 from torch.utils.data import Sampler, Dataset
 
+from data_utils.audio_cache import AudioCache
+
+
+def worker_kwargs(num_workers, prefetch_factor=2, persistent_workers=False):
+    """DataLoader arguments of its worker processes
+
+    prefetch_factor is only passed with workers, as DataLoader rejects it
+    when it loads in the main process.
+    """
+    kwargs = {"num_workers": num_workers}
+    if num_workers > 0:
+        kwargs["prefetch_factor"] = prefetch_factor
+        kwargs["persistent_workers"] = persistent_workers
+    return kwargs
+
 
 class AudioDataset(Dataset):
     """
     AudioDataset assumes that the audio files are stored in a specific folder
     and the list of labels is stored in a CSV file in the column "category"
+
+    The 16 kHz waveforms, or log-mel features with features="fbank", are
+    loaded through audio_cache (data_utils/audio_cache.py). The log-mel
+    features are of size (bins, frames), as those of WaveformCollate.
     """
 
-    def __init__(self, root_dir, data_frame, transform=None):
+    def __init__(
+        self,
+        root_dir,
+        data_frame,
+        transform=None,
+        audio_cache=None,
+        features="waveform",
+    ):
         self.root_dir = root_dir
         self.transform = transform
         self.data_frame = data_frame
+        self.audio_cache = AudioCache() if audio_cache is None else audio_cache
+        self.features = features
 
         self.label_encoder = LabelEncoder()
         self.label_encoder.fit(self.data_frame["category"])
@@ -30,22 +58,18 @@ class AudioDataset(Dataset):
         return len(self.data_frame)
 
     def get_labels(self):
-        labels = []
-
-        for i in range(0, len(self.data_frame)):
-            label = self.data_frame.iloc[i]["category"]
-            label = self.label_encoder.transform([label])[0]
-            labels.append(label)
-
-        return labels
+        return self.label_encoder.transform(self.data_frame["category"])
 
     def __getitem__(self, idx):
         audio_path = os.path.join(self.root_dir, self.data_frame.iloc[idx]["filename"])
         label = self.data_frame.iloc[idx]["category"]
 
         # Load audio data and perform any desired transformations
-        sig, sr = librosa.load(audio_path, sr=16000, mono=True)
+        sig = self.audio_cache.load(audio_path, self.features)
         sig_t = torch.tensor(sig)
+        if self.features == "fbank":
+            # episodic_collate_fn crops the frames, along dim 1
+            sig_t = sig_t.T
         # padding_mask = torch.zeros(1, sig_t.shape[0]).bool().squeeze(0)
         if self.transform:
             sig_t = self.transform(sig_t)
@@ -90,10 +114,34 @@ class FewShotDataset(Dataset):
         )
 
 
+def sample_without_replacement(
+    rng: np.random.Generator, population_sizes: np.ndarray, k: int
+) -> np.ndarray:
+    """
+    Draws k distinct positions in range(population_sizes[i]) for every row i at once, in
+    random order, with O(k**2) vectorized operations independent of the population sizes.
+    Position j is the r-th position not drawn before, for r uniform in [0, size - j).
+    """
+    population_sizes = np.asarray(population_sizes)
+    positions = np.empty((len(population_sizes), k), dtype=np.int64)
+    for j in range(k):
+        position = np.floor(rng.random(len(population_sizes)) * (population_sizes - j))
+        position = position.astype(np.int64)
+        # skip the positions drawn before, in increasing order
+        for drawn in np.sort(positions[:, :j], axis=1).T:
+            position += position >= drawn
+        positions[:, j] = position
+    return positions
+
+
 class TaskSampler(Sampler):
     """
     Samples batches in the shape of few-shot classification tasks. At each iteration, it will sample
     n_way classes, and then sample support and query images from these classes.
+
+    The items are indexed by class in flat arrays (class i owns the items
+    items[class_starts[i] : class_starts[i] + class_counts[i]]) and episodes are drawn in blocks
+    of block_size with a seeded numpy Generator, without python objects per item or class.
     """
 
     def __init__(
@@ -104,6 +152,8 @@ class TaskSampler(Sampler):
         n_query: int,
         n_tasks: int,
         tensor_length: int = 0,
+        seed: int = None,
+        block_size: int = 64,
     ):
         """
         Args:
@@ -113,6 +163,9 @@ class TaskSampler(Sampler):
             n_shot: number of support images for each class in one task
             n_query: number of query images for each class in one task
             n_tasks: number of tasks to sample
+            seed: seed of the random generator, by default drawn from the random module (which
+                seed_everything seeds)
+            block_size: number of tasks drawn at once
         """
         super().__init__(data_source=None)
         self.n_way = n_way
@@ -120,30 +173,53 @@ class TaskSampler(Sampler):
         self.n_query = n_query
         self.n_tasks = n_tasks
         self.tensor_length = tensor_length
+        self.block_size = block_size
+        self.rng = np.random.default_rng(
+            random.getrandbits(64) if seed is None else seed
+        )
 
-        self.items_per_label = {}
-        for item, label in enumerate(dataset.get_labels()):
-            if label in self.items_per_label.keys():
-                self.items_per_label[label].append(item)
-            else:
-                self.items_per_label[label] = [item]
+        labels = np.asarray(dataset.get_labels())
+        if labels.dtype.kind in "iu" and labels.min() >= 0 and labels.max() < 2**16:
+            # numpy sorts 16 bit integers with a radix sort
+            self.items = np.argsort(labels.astype(np.uint16), kind="stable")
+        else:
+            self.items = np.argsort(labels, kind="stable")
+        sorted_labels = labels[self.items]
+        class_starts = np.flatnonzero(
+            np.concatenate([[True], sorted_labels[1:] != sorted_labels[:-1]])
+        )
+        class_counts = np.diff(np.append(class_starts, len(labels)))
+        self.class_labels = sorted_labels[class_starts]
+        # only classes with enough items for a task can be drawn
+        enough_items = class_counts >= n_shot + n_query
+        self.class_starts = class_starts[enough_items]
+        self.class_counts = class_counts[enough_items]
+        self.class_labels = self.class_labels[enough_items]
+        assert len(self.class_labels) >= n_way, "not enough classes with enough items"
 
     def __len__(self) -> int:
         return self.n_tasks
 
+    def sample_tasks(self, num_tasks: int) -> np.ndarray:
+        """
+        Returns the item indices of num_tasks tasks, of size (num_tasks, n_way * (n_shot +
+        n_query)): n_shot + n_query items of the first class, then of the second class, ...
+        """
+        n_items = self.n_shot + self.n_query
+        classes = sample_without_replacement(
+            self.rng, np.full(num_tasks, len(self.class_labels)), self.n_way
+        ).flatten()
+        positions = sample_without_replacement(
+            self.rng, self.class_counts[classes], n_items
+        )
+        return self.items[self.class_starts[classes, None] + positions].reshape(
+            (num_tasks, self.n_way * n_items)
+        )
+
     def __iter__(self) -> Iterator[List[int]]:
-        for _ in range(self.n_tasks):
-            yield torch.cat(
-                [
-                    # pylint: disable=not-callable
-                    torch.tensor(
-                        random.sample(
-                            self.items_per_label[label], self.n_shot + self.n_query
-                        )
-                    )
-                    # pylint: enable=not-callable
-                    for label in random.sample(self.items_per_label.keys(), self.n_way)
-                ]
+        for start in range(0, self.n_tasks, self.block_size):
+            yield from self.sample_tasks(
+                min(self.block_size, self.n_tasks - start)
             ).tolist()
 
     def episodic_collate_fn(
@@ -166,31 +242,44 @@ class TaskSampler(Sampler):
         """
 
         true_class_ids = list({x[1] for x in input_data})
-        new_input = []
-        for x in input_data:
-            if x[0].shape[1] > self.tensor_length:
-                rand_start = torch.randint(0, x[0].shape[1] - self.tensor_length, (1,))
-                new_input.append(
-                    (x[0][:, rand_start : rand_start + self.tensor_length], x[1])
-                )
-            else:
-                new_input.append(x)
-        all_images = torch.cat([x[0].unsqueeze(0) for x in new_input])
-        all_images = all_images.reshape(
-            (self.n_way, self.n_shot + self.n_query, *all_images.shape[1:])
+        features = [x[0] for x in input_data]
+        lengths = torch.tensor([feature.shape[1] for feature in features])
+        # features longer than tensor_length are cropped at random
+        window_length = min(self.tensor_length, int(lengths.min()))
+        # all random crop offsets at once, in [0, length - window_length)
+        crop_starts = (torch.rand(len(features)) * (lengths - window_length)).long()
+        crop_starts = crop_starts.tolist()
+        # items come as (n_way, n_shot + n_query), stack the support items of
+        # all classes first, so that support and query are views of one copy
+        order = torch.arange(len(features)).reshape(
+            (self.n_way, self.n_shot + self.n_query)
+        )
+        order = torch.cat(
+            [order[:, : self.n_shot].flatten(), order[:, self.n_shot :].flatten()]
         )
+        all_images = torch.stack(
+            [
+                features[i].narrow(1, crop_starts[i], window_length)
+                for i in order.tolist()
+            ]
+        )
+        # index of the label of every item in true_class_ids
         # pylint: disable=not-callable
-        all_labels = torch.tensor(
-            [true_class_ids.index(x[1]) for x in input_data]
-        ).reshape((self.n_way, self.n_shot + self.n_query))
+        all_labels = (
+            (
+                torch.tensor([x[1] for x in input_data])[order, None]
+                == torch.tensor(true_class_ids)[None]
+            )
+            .int()
+            .argmax(1)
+        )
         # pylint: enable=not-callable
 
-        support_images = all_images[:, : self.n_shot].reshape(
-            (-1, *all_images.shape[2:])
-        )
-        query_images = all_images[:, self.n_shot :].reshape((-1, *all_images.shape[2:]))
-        support_labels = all_labels[:, : self.n_shot].flatten()
-        query_labels = all_labels[:, self.n_shot :].flatten()
+        n_support = self.n_way * self.n_shot
+        support_images = all_images[:n_support]
+        query_images = all_images[n_support:]
+        support_labels = all_labels[:n_support]
+        query_labels = all_labels[n_support:]
 
         return (
             support_images,
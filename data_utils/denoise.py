@@ -0,0 +1,206 @@
+"""
+Batched stationary spectral gating, following noisereduce.reduce_noise.
+
+noisereduce estimates the noise statistics of every signal it denoises. To
+denoise many segments of the same recording, the noise threshold is
+estimated once (estimate_noise_threshold) and all segments are gated in
+batches with torch (spectral_gate). The settings are those of
+denoise_signal in DCASEfewshot.py: stationary, n_fft 1024, hop 256,
+n_std_thresh 1.5, prop_decrease 0.95 and a mask smoothed over 25 ms and
+1000 Hz. Signals are cut into padded chunks as noisereduce does, so that
+spectral_gate([y], sr, estimate_noise_threshold(y, sr)) equals
+reduce_noise(y, sr, stationary=True, ...).
+"""
+from functools import lru_cache
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+N_FFT = 1024
+HOP_LENGTH = 256
+N_STD_THRESH = 1.5
+PROP_DECREASE = 0.95
+TIME_MASK_SMOOTH_MS = 25
+FREQ_MASK_SMOOTH_HZ = 1000
+TOP_DB = 80.0
+# noisereduce defaults
+CHUNK_SIZE = 600000
+PADDING = 30000
+
+
+@lru_cache(maxsize=None)
+def get_gate_kernels(sr, device=torch.device("cpu"), dtype=torch.float64):
+    """Return the stft window and the half widths of the mask smoothing
+
+    The mask is smoothed over 2 * n_grad_freq + 1 frequencies and
+    2 * n_grad_time + 1 frames.
+    """
+    window = torch.hann_window(N_FFT, periodic=True, device=device, dtype=dtype)
+    n_grad_freq = int(FREQ_MASK_SMOOTH_HZ / (sr / (N_FFT / 2)))
+    n_grad_time = int(TIME_MASK_SMOOTH_MS / ((HOP_LENGTH / sr) * 1000))
+    assert n_grad_freq >= 1 and n_grad_time >= 1, "sr {} too high".format(sr)
+    return window, n_grad_freq, n_grad_time
+
+
+def smooth_mask(mask, n_grad, dim):
+    """Correlate mask along dim with the ramp of noisereduce's smoothing filter
+
+    noisereduce smooths with the outer product of two normalized ramps
+    (1, 2, .., n_grad + 1, .., 2, 1) and zero padding (fftconvolve, "same").
+    A ramp is the convolution of two boxes of width n_grad + 1, so it is the
+    second difference (with a step of that width) of a double cumulative sum.
+    """
+    width = n_grad + 1
+    mask = mask.transpose(dim, -1)
+    length = mask.shape[-1]
+    cumsum = F.pad(mask, (2 * width, width)).cumsum_(dim=-1).cumsum_(dim=-1)
+    start = n_grad + 2 * width
+    mask = (
+        cumsum[..., start : start + length]
+        - 2 * cumsum[..., start - width : start - width + length]
+        + cumsum[..., start - 2 * width : start - 2 * width + length]
+    ) / width**2
+    return mask.transpose(dim, -1)
+
+
+def amplitude_db(signals, window):
+    """stft of a batch of signals in dB, as scipy.signal.stft and _amp_to_db
+
+    The dB values are clipped at TOP_DB below the maximum of each frequency.
+    """
+    stft = torch.stft(
+        signals,
+        N_FFT,
+        hop_length=HOP_LENGTH,
+        window=window,
+        center=True,
+        pad_mode="constant",
+        return_complex=True,
+    )
+    # scipy scales the spectrum by the sum of the window
+    stft = stft / window.sum()
+    stft_db = stft.abs().add_(np.finfo(np.float64).eps).log10_().mul_(20)
+    top = stft_db.max(dim=2, keepdim=True).values - TOP_DB
+    return stft, torch.maximum(stft_db, top)
+
+
+def estimate_noise_threshold(y, sr, dtype=torch.float64):
+    """Noise threshold per frequency, estimated from the start of y
+
+    As noisereduce with clip_noise_stationary, only the first CHUNK_SIZE
+    samples are used.
+    """
+    window, _, _ = get_gate_kernels(sr, dtype=dtype)
+    y_noise = torch.as_tensor(np.asarray(y[:CHUNK_SIZE]), dtype=dtype)
+    _, noise_db = amplitude_db(y_noise[None], window)
+    noise_db = noise_db[0]
+    return noise_db.mean(dim=1) + noise_db.std(dim=1, unbiased=False) * N_STD_THRESH
+
+
+def _chunks(y, min_padding):
+    """Chunks of CHUNK_SIZE, padded with PADDING samples on both sides
+
+    Padding beyond the signal is zero. Zero padding that cannot reach the
+    chunk through the stft window or the mask smoothing is left out: at the
+    start in whole hops, so that the frames stay aligned with those of
+    noisereduce, and at the end down to min_padding.
+
+    Yields the start and end of the chunk in y, the padded chunk and the
+    offset of start in the padded chunk.
+    """
+    num_samples = len(y)
+    for start in range(0, max(num_samples, 1), CHUNK_SIZE):
+        end = min(start + CHUNK_SIZE, num_samples)
+        read_start = max(start - PADDING, 0)
+        read_end = min(end + PADDING, num_samples)
+        zeros_start = PADDING - (start - read_start)
+        zeros_start -= max(0, zeros_start - min_padding) // HOP_LENGTH * HOP_LENGTH
+        zeros_end = min(PADDING - (read_end - end), min_padding)
+        chunk = np.zeros(zeros_start + read_end - read_start + zeros_end)
+        chunk[zeros_start : zeros_start + read_end - read_start] = y[
+            read_start:read_end
+        ]
+        yield start, end, chunk, zeros_start + start - read_start
+
+
+def _gate_chunks(chunks, sr, noise_threshold, db_offsets, dtype):
+    window, n_grad_freq, n_grad_time = get_gate_kernels(sr, dtype=dtype)
+    lengths = torch.tensor([len(chunk) for chunk in chunks])
+    signals = torch.zeros((len(chunks), int(lengths.max())), dtype=dtype)
+    for i, chunk in enumerate(chunks):
+        signals[i, : len(chunk)] = torch.as_tensor(chunk, dtype=dtype)
+    num_frames = 1 + torch.div(lengths, HOP_LENGTH, rounding_mode="floor")
+    # NOTE: frames beyond a chunk only cover its trailing zeros, so they do
+    # not change the maximum of amplitude_db
+    stft, stft_db = amplitude_db(signals, window)
+
+    # mask the bins above the threshold, shifted with the gain of the signal
+    threshold = noise_threshold[None, :, None] + db_offsets[:, None, None]
+    mask = (stft_db > threshold).to(dtype) * PROP_DECREASE + (1.0 - PROP_DECREASE)
+    # frames beyond a chunk are outside of its mask, as in fftconvolve
+    invalid = torch.arange(stft.shape[2]) >= num_frames[:, None]
+    mask.masked_fill_(invalid[:, None, :], 0.0)
+    mask = smooth_mask(mask, n_grad_freq, dim=1)
+    mask = smooth_mask(mask, n_grad_time, dim=2) * window.sum()
+
+    denoised = torch.istft(
+        stft * mask,
+        N_FFT,
+        hop_length=HOP_LENGTH,
+        window=window,
+        center=True,
+        length=signals.shape[1],
+    )
+    # noisereduce's istft drops the samples beyond the last full hop
+    istft_lengths = (num_frames - 1) * HOP_LENGTH
+    return [
+        denoised[i, : min(len(chunk), int(istft_lengths[i]))].numpy()
+        for i, chunk in enumerate(chunks)
+    ]
+
+
+def spectral_gate(
+    signals, sr, noise_threshold, db_offsets=None, batch_size=16, dtype=torch.float64
+):
+    """Denoise signals with a given noise threshold, in batches of chunks
+
+    db_offsets shift the threshold of each signal, e.g. by 20 * log10(scale)
+    for a signal that was multiplied by scale after the threshold was
+    estimated.
+
+    Returns the denoised signals as float32 arrays.
+    """
+    if db_offsets is None:
+        db_offsets = np.zeros(len(signals))
+    noise_threshold = torch.as_tensor(noise_threshold, dtype=dtype)
+    _, _, n_grad_time = get_gate_kernels(sr, dtype=dtype)
+    # zero padding that reaches the chunk through the stft window and the
+    # smoothing of the mask
+    min_padding = N_FFT + HOP_LENGTH * (n_grad_time + 1)
+    # all chunks of all signals, gated in batches of similar length
+    chunks = []
+    for i, y in enumerate(signals):
+        for start, end, chunk, offset in _chunks(np.asarray(y), min_padding):
+            chunks.append((i, start, end, chunk, offset))
+    order = sorted(range(len(chunks)), key=lambda j: len(chunks[j][3]))
+    denoised = [np.zeros(len(y), dtype=np.float32) for y in signals]
+    for batch_start in range(0, len(order), batch_size):
+        batch = [chunks[j] for j in order[batch_start : batch_start + batch_size]]
+        gated = _gate_chunks(
+            [chunk for _, _, _, chunk, _ in batch],
+            sr,
+            noise_threshold,
+            torch.tensor([db_offsets[i] for i, _, _, _, _ in batch], dtype=dtype),
+            dtype,
+        )
+        for (i, start, end, _, offset), gated_chunk in zip(batch, gated):
+            # istft output shorter than the chunk leaves zeros, as noisereduce
+            gated_chunk = gated_chunk[offset : offset + end - start]
+            denoised[i][start : start + len(gated_chunk)] = gated_chunk
+    return denoised
+
+
+def denoise_file(y, sr):
+    """Stationary spectral gating of an entire recording"""
+    return spectral_gate([y], sr, estimate_noise_threshold(y, sr))[0]
@@ -0,0 +1,336 @@
+"""
+Few-shot episodes drawn and assembled on the compute device.
+
+The features of a training subset are copied once into a flat bank on the
+device, grouped by class, with their offsets and lengths. An episode is
+then drawn as tensors (classes, distinct items per class, random crop
+offsets) and its windows are taken from the bank with a single gather,
+instead of a python list of indices, one __getitem__ per item and a crop
+and cat per item in episodic_collate_fn (data_utils/dataset.py).
+
+An EpisodePrefetcher builds the episodes of any episodic loader ahead on a
+background thread (into a ring of reused pinned buffers with pin_memory),
+and an EpisodeBank draws the episodes of a loader once and replays them.
+"""
+import collections
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+
+from data_utils.feature_encoding import decode_features
+
+
+class EpisodeGenerator:
+    """Iterable of n_tasks episodes of a subset of a ragged feature store
+
+    store is a RaggedFeatureStore or SharedFeatureArena and indices the
+    items of the subset, e.g. those of a RaggedDatasetDCASE. Every class
+    needs at least n_shot + n_query items.
+
+    Episodes are the tuples of TaskSampler.episodic_collate_fn: support
+    windows, support labels, query windows, query labels and the ids of the
+    classes, of size (bins, tensor_length) and on device. Windows are
+    random crops of the features, as in the collate function, and labels
+    index the classes of the episode. The class ids are a tensor instead
+    of a list, so that no episode waits for the device.
+
+    Features stored as float16 or uint8 stay encoded in the bank and only
+    the windows of an episode are decoded.
+    """
+
+    def __init__(
+        self,
+        store,
+        indices,
+        n_way,
+        n_shot,
+        n_query,
+        n_tasks,
+        tensor_length,
+        device="cpu",
+        seed=None,
+    ):
+        self.n_way = n_way
+        self.n_shot = n_shot
+        self.n_query = n_query
+        self.n_tasks = n_tasks
+        self.tensor_length = tensor_length
+        self.device = torch.device(device)
+
+        # group the items by class, the items of class c are the rows
+        # class_starts[c] : class_starts[c] + class_counts[c]
+        indices = np.asarray(indices)
+        indices = indices[np.argsort(store.label_ids[indices], kind="stable")]
+        class_ids, class_counts = np.unique(
+            store.label_ids[indices], return_counts=True
+        )
+        assert len(class_ids) >= n_way, "not enough classes for an episode"
+        assert class_counts.min() >= n_shot + n_query, "too few items of a class"
+        class_starts = np.concatenate([[0], np.cumsum(class_counts)[:-1]])
+        lengths = store.lengths()[indices]
+        assert lengths.min() >= tensor_length, "features shorter than tensor_length"
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+
+        # copy the features of the subset into one (frames, bins) bank
+        bank = torch.empty(
+            (int(lengths.sum()), store.features.shape[1]),
+            dtype=torch.as_tensor(store.features[:0]).dtype,
+        )
+        for index, offset, length in zip(indices, offsets, lengths):
+            start = store.offsets[index]
+            bank[offset : offset + length] = torch.as_tensor(
+                np.asarray(store.features[start : start + length])
+            )
+        self.bank = bank.to(self.device)
+        self.scales = None
+        if store.scales is not None:
+            self.scales = torch.as_tensor(
+                store.scales[indices], dtype=torch.float32, device=self.device
+            )
+
+        self.class_ids = torch.as_tensor(class_ids, device=self.device)
+        self.class_starts = torch.as_tensor(class_starts, device=self.device)
+        self.class_counts = torch.as_tensor(class_counts, device=self.device)
+        self.offsets = torch.as_tensor(offsets, device=self.device)
+        self.lengths = torch.as_tensor(lengths, device=self.device)
+        self.item_range = torch.arange(class_counts.max(), device=self.device)
+        self.frame_range = torch.arange(tensor_length, device=self.device)
+        self.labels = torch.arange(n_way, device=self.device)[:, None].expand(
+            n_way, n_shot + n_query
+        )
+
+        if seed is None:
+            # follows the global seed, e.g. of seed_everything
+            seed = int(torch.randint(0, 2**62, (1,)))
+        self.generator = torch.Generator(self.device).manual_seed(seed)
+
+    def __len__(self):
+        return self.n_tasks
+
+    def __iter__(self):
+        for _ in range(self.n_tasks):
+            yield self.episode()
+
+    def rand(self, *size):
+        return torch.rand(size, generator=self.generator, device=self.device)
+
+    def episode(self):
+        n_items = self.n_shot + self.n_query
+        # n_way distinct classes
+        classes = self.rand(len(self.class_ids)).argsort()[: self.n_way]
+        # n_items distinct items per class: the smallest random keys, where
+        # the keys beyond the number of items of a class are never drawn
+        keys = self.rand(self.n_way, len(self.item_range))
+        keys.masked_fill_(
+            self.item_range[None] >= self.class_counts[classes, None], 2.0
+        )
+        items = (
+            self.class_starts[classes, None]
+            + keys.topk(n_items, dim=1, largest=False).indices
+        )
+        # random crop offsets in [0, length - tensor_length)
+        crop_starts = (
+            self.rand(self.n_way, n_items) * (self.lengths[items] - self.tensor_length)
+        ).long()
+        # a single gather of size (n_way, n_items, tensor_length, bins)
+        frames = (self.offsets[items] + crop_starts)[..., None] + self.frame_range
+        windows = self.bank[frames]
+        if self.scales is None:
+            windows = decode_features(windows)
+        else:
+            scales = self.scales[items]
+            windows = windows.float() * scales[..., 1, None, None]
+            windows += scales[..., 0, None, None]
+        windows = windows.transpose(2, 3)
+
+        support_images = windows[:, : self.n_shot].reshape(-1, *windows.shape[2:])
+        query_images = windows[:, self.n_shot :].reshape(-1, *windows.shape[2:])
+        support_labels = self.labels[:, : self.n_shot].flatten()
+        query_labels = self.labels[:, self.n_shot :].flatten()
+        return (
+            support_images,
+            support_labels,
+            query_images,
+            query_labels,
+            self.class_ids[classes],
+        )
+
+
+class EpisodePrefetcher:
+    """Iterable building the episodes of loader ahead on a background thread
+
+    loader is an episodic loader (few_shot_dataloader or EpisodeGenerator).
+    Up to num_prefetch episodes are built while the model runs and handed
+    on as the loader returns them, without a copy. With pin_memory, the
+    episodes on the CPU are copied into a ring of preallocated pinned
+    buffers instead, so that they are copied to a GPU asynchronously; such
+    an episode stays valid until num_held more episodes are taken, the
+    default of 2 covers the one batch the Lightning fit loop fetches ahead.
+
+    The thread mainly runs torch operations that release the GIL. For
+    loaders with worker processes it adds a queue deeper than their
+    prefetch_factor (and the reuse of pinned buffers).
+
+    The time spent waiting for episodes is summed in wait_time (over all
+    passes, with num_episodes) and reported after every pass.
+    """
+
+    def __init__(self, loader, num_prefetch=2, pin_memory=False, num_held=2):
+        self.loader = loader
+        self.num_prefetch = num_prefetch
+        self.pin_memory = pin_memory
+        self.num_held = num_held
+        # support images, support labels, query images, query labels
+        self.buffers = [None] * (num_prefetch + num_held)
+        self.wait_time = 0.0
+        self.num_episodes = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def fill(self, slot, episode):
+        tensors = episode[:4]
+        if not self.pin_memory or any(
+            tensor.device.type != "cpu" for tensor in tensors
+        ):
+            # nothing to pin, e.g. episodes of an EpisodeGenerator on a GPU
+            return episode
+        buffers = self.buffers[slot]
+        if buffers is None or any(
+            buffer.shape != tensor.shape or buffer.dtype != tensor.dtype
+            for buffer, tensor in zip(buffers, tensors)
+        ):
+            buffers = [
+                torch.empty(
+                    tensor.shape,
+                    dtype=tensor.dtype,
+                    device=tensor.device,
+                    pin_memory=True,
+                )
+                for tensor in tensors
+            ]
+            self.buffers[slot] = buffers
+        for buffer, tensor in zip(buffers, tensors):
+            buffer.copy_(tensor)
+        return (*buffers, *episode[4:])
+
+    def produce(self, free_slots, ready, stop):
+        try:
+            for episode in self.loader:
+                slot = free_slots.get()
+                if stop.is_set():
+                    return
+                ready.put((slot, self.fill(slot, episode)))
+            ready.put((None, None))
+        except Exception as error:
+            # raised again in the iterating thread
+            ready.put((None, error))
+
+    def __iter__(self):
+        free_slots = queue.Queue()
+        for slot in range(len(self.buffers)):
+            free_slots.put(slot)
+        ready = queue.Queue()
+        stop = threading.Event()
+        threading.Thread(
+            target=self.produce, args=(free_slots, ready, stop), daemon=True
+        ).start()
+        held_slots = collections.deque()
+        wait_time = 0.0
+        num_episodes = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                slot, episode = ready.get()
+                wait_time += time.perf_counter() - start
+                if slot is None:
+                    if episode is not None:
+                        raise episode
+                    break
+                held_slots.append(slot)
+                if len(held_slots) > self.num_held:
+                    free_slots.put(held_slots.popleft())
+                num_episodes += 1
+                yield episode
+        finally:
+            # wakes the thread if it waits for a slot
+            stop.set()
+            free_slots.put(None)
+            self.wait_time += wait_time
+            self.num_episodes += num_episodes
+            print(
+                "Waited {:.2f} s for {} episodes ({:.1f} ms per episode)".format(
+                    wait_time,
+                    num_episodes,
+                    1000 * wait_time / max(num_episodes, 1),
+                )
+            )
+
+
+class EpisodeBank:
+    """Episodes drawn once with a fixed seed and replayed on every pass
+
+    The windows of all episodes are materialized into a single contiguous
+    tensor of size (episodes, items, bins, tensor_length), with the support
+    items of an episode before its query items, so that replaying an
+    episode only takes views. This fixes e.g. the validation episodes, so
+    that val_loss and val_acc are comparable between epochs and runs.
+    """
+
+    def __init__(self, images, support_labels, query_labels, class_ids):
+        self.images = images
+        self.support_labels = support_labels
+        self.query_labels = query_labels
+        self.class_ids = class_ids
+        self.n_support = support_labels.shape[1]
+
+    @classmethod
+    def materialize(cls, loader, seed=42):
+        """Draw all episodes of loader, with the torch random state seeded
+
+        The task draws of the loader should be seeded as well (seed of the
+        TaskSampler or EpisodeGenerator).
+        """
+        with torch.random.fork_rng(devices=[]):
+            # the random crops of episodic_collate_fn
+            torch.manual_seed(seed)
+            images = None
+            support_labels, query_labels, class_ids = [], [], []
+            for i, episode in enumerate(loader):
+                support_images, support_label, query_images, query_label = episode[:4]
+                if images is None:
+                    images = torch.empty(
+                        (
+                            len(loader),
+                            len(support_images) + len(query_images),
+                            *support_images.shape[1:],
+                        ),
+                        dtype=support_images.dtype,
+                        device=support_images.device,
+                    )
+                images[i, : len(support_images)] = support_images
+                images[i, len(support_images) :] = query_images
+                support_labels.append(support_label)
+                query_labels.append(query_label)
+                class_ids.append(episode[4])
+        return cls(
+            images, torch.stack(support_labels), torch.stack(query_labels), class_ids
+        )
+
+    def __len__(self):
+        return len(self.images)
+
+    def __iter__(self):
+        for images, support_labels, query_labels, class_ids in zip(
+            self.images, self.support_labels, self.query_labels, self.class_ids
+        ):
+            yield (
+                images[: self.n_support],
+                support_labels,
+                images[self.n_support :],
+                query_labels,
+                class_ids,
+            )
@@ -0,0 +1,105 @@
+"""
+Batched log-mel stage between padded waveform batches and BEATs.
+
+BEATs.extract_features takes pre-computed fbanks (the FBG note in
+BEATs/BEATs.py). The ESC-50 datasets return 16 kHz waveforms, so the
+features of a batch are computed here in one batched_fbank call: either
+in the collate function of a DataLoader (WaveformCollate, on the CPU of
+the workers) or as a module of the model (FbankTransform, on its device).
+"""
+import torch
+from torch import nn
+
+from BEATs.fbank import batched_fbank
+from data_utils.audio_cache import FBANK_MEAN, FBANK_STD
+
+
+class FbankTransform(nn.Module):
+    """Normalized log-mel features of a padded batch of waveforms
+
+    The features of BEATs.preprocess: kaldi fbank of the waveforms scaled
+    to 16 bit, normalized with the AudioSet mean and std. Waveforms are of
+    size (batch, samples), with padding_mask True at the padded samples.
+
+    Returns the features of size (batch, frames, num_mel_bins), zero at
+    the padded frames, and the padding mask of the frames.
+    """
+
+    def __init__(
+        self,
+        num_mel_bins=128,
+        sample_frequency=16000,
+        frame_length=25.0,
+        frame_shift=10.0,
+        fbank_mean=FBANK_MEAN,
+        fbank_std=FBANK_STD,
+    ):
+        super().__init__()
+        self.num_mel_bins = num_mel_bins
+        self.sample_frequency = sample_frequency
+        self.frame_length = frame_length
+        self.frame_shift = frame_shift
+        self.fbank_mean = fbank_mean
+        self.fbank_std = fbank_std
+
+    def forward(self, waveforms, padding_mask=None):
+        lengths = None if padding_mask is None else (~padding_mask).sum(1)
+        fbank, num_frames = batched_fbank(
+            waveforms * 2**15,
+            lengths,
+            num_mel_bins=self.num_mel_bins,
+            sample_frequency=self.sample_frequency,
+            frame_length=self.frame_length,
+            frame_shift=self.frame_shift,
+        )
+        fbank = (fbank - self.fbank_mean) / (2 * self.fbank_std)
+        frame_padding_mask = (
+            torch.arange(fbank.shape[1], device=fbank.device)[None]
+            >= num_frames[:, None]
+        )
+        fbank.masked_fill_(frame_padding_mask[..., None], 0.0)
+        return fbank, frame_padding_mask
+
+
+def pad_waveforms(waveforms):
+    """Padded batch of a list of 1-d waveforms, and its padding mask"""
+    lengths = torch.tensor([len(waveform) for waveform in waveforms])
+    batch = torch.zeros((len(waveforms), int(lengths.max())))
+    for row, waveform in zip(batch, waveforms):
+        row[: len(waveform)] = waveform
+    padding_mask = torch.arange(batch.shape[1])[None] >= lengths[:, None]
+    return batch, padding_mask
+
+
+class WaveformCollate:
+    """collate_fn of datasets of waveforms, with an optional FbankTransform
+
+    Items are (waveform, padding_mask, label) (ECS50DataModule.py) or
+    (waveform, label) (data_utils/dataset.py). The waveforms are padded to
+    a batch, which fbank_transform turns into features in one call.
+
+    Without collate_fn, returns the batch, its padding mask and the
+    labels, as the default collate of ECS50DataModule. Otherwise, the
+    items are passed on to collate_fn (e.g. TaskSampler.episodic_collate_fn)
+    with their waveform replaced by the valid frames of its features, of
+    size (num_mel_bins, frames) as the features of the DCASE datasets.
+    """
+
+    def __init__(self, fbank_transform=None, collate_fn=None):
+        self.fbank_transform = fbank_transform
+        self.collate_fn = collate_fn
+
+    def __call__(self, input_data):
+        batch, padding_mask = pad_waveforms([x[0] for x in input_data])
+        if self.fbank_transform is not None:
+            batch, padding_mask = self.fbank_transform(batch, padding_mask)
+        if self.collate_fn is not None:
+            lengths = (~padding_mask).sum(1).tolist()
+            return self.collate_fn(
+                [
+                    (features[:length].T, *x[1:])
+                    for features, length, x in zip(batch, lengths, input_data)
+                ]
+            )
+        labels = torch.tensor([x[-1] for x in input_data])
+        return batch, padding_mask, labels
@@ -0,0 +1,87 @@
+"""
+Compact encodings of the mel features saved by DCASEfewshot.py.
+
+    float32  as computed (default)
+    float16  half precision, 2x smaller
+    uint8    affine scaled to 0..255 with an offset and scale per feature
+             (training events) or per file (query mel), 4x smaller
+
+The normalized log-mel values span a limited range, so the rounding error
+of float16 (relative 2**-11) and uint8 (half a step, (max - min) / 510) is
+small compared to the differences between features. Encoded features are
+decoded to float32 only when accessed (decode_features).
+"""
+import numpy as np
+import torch
+
+FEATURE_DTYPES = ("float32", "float16", "uint8")
+UINT8_LEVELS = 255
+
+
+def affine_params(min_value, max_value):
+    """offset and scale mapping [min_value, max_value] onto 0..255"""
+    scale = (float(max_value) - float(min_value)) / UINT8_LEVELS
+    # a constant feature is encoded as all zeros
+    return float(min_value), scale if scale > 0 else 1.0
+
+
+def encode_features(features, feature_dtype, offset=None, scale=None):
+    """Encode a float32 array, returns (encoded, offset, scale)
+
+    offset and scale are only used for uint8 and computed from the range
+    of features unless given. They are None for the float encodings.
+    """
+    features = np.asarray(features)
+    if feature_dtype == "float32":
+        return features.astype(np.float32, copy=False), None, None
+    if feature_dtype == "float16":
+        return features.astype(np.float16), None, None
+    assert feature_dtype == "uint8", "unknown feature dtype " + feature_dtype
+    if offset is None:
+        offset, scale = affine_params(features.min(), features.max())
+    encoded = np.rint((features - offset) / scale)
+    return np.clip(encoded, 0, UINT8_LEVELS).astype(np.uint8), offset, scale
+
+
+def decode_features(encoded, affine=None):
+    """Decode an encoded array (numpy or torch) to a float32 torch tensor
+
+    affine is the (offset, scale) of a uint8 array. float32 arrays are
+    wrapped without copying.
+    """
+    encoded = torch.as_tensor(encoded)
+    if encoded.dtype == torch.float32:
+        return encoded
+    if encoded.dtype == torch.uint8:
+        offset, scale = affine
+        return encoded.float().mul_(scale).add_(offset)
+    return encoded.float()
+
+
+def save_encoded_npy(path, features, feature_dtype, block_rows=1 << 16):
+    """Encode a (possibly memory-mapped) array into a .npy file at path
+
+    The range for uint8 is found and the array encoded block by block, so
+    that features need not fit into memory. Returns (offset, scale).
+    """
+    offset = scale = None
+    if feature_dtype == "uint8":
+        min_value, max_value = np.inf, -np.inf
+        for start in range(0, len(features), block_rows):
+            block = np.asarray(features[start : start + block_rows])
+            if block.size:
+                min_value = min(min_value, block.min())
+                max_value = max(max_value, block.max())
+        if np.isinf(min_value):
+            min_value = max_value = 0.0
+        offset, scale = affine_params(min_value, max_value)
+    encoded = np.lib.format.open_memmap(
+        path, mode="w+", dtype=np.dtype(feature_dtype), shape=features.shape
+    )
+    for start in range(0, len(features), block_rows):
+        encoded[start : start + block_rows] = encode_features(
+            features[start : start + block_rows], feature_dtype, offset, scale
+        )[0]
+    encoded.flush()
+    del encoded
+    return offset, scale
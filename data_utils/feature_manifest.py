@@ -0,0 +1,70 @@
+"""
+Manifest of the features prepared for every audio file of a data set.
+
+feature_manifest.jsonl in a prepared data directory holds one json record
+per file, in the order the files were processed:
+
+    filename      name of the audio file without extension
+    class         directory (class) the file belongs to
+    sample_rate   sampling frequency the features were computed at
+    duration      duration of the audio file in seconds
+
+For validate/test the record locates the query and support sets of the
+file, with paths relative to the data directory:
+
+    frame_shift, segment_hop, num_windows, num_frames
+    query_mel         (frames, bins) .npy of the query windows, encoded as
+                      feature_dtype (data_utils/feature_encoding.py)
+    query_mel_offset  byte offset of the data in query_mel, so the mel can
+                      be mapped with np.memmap(..., offset=query_mel_offset)
+    feature_dtype     float32, float16 or uint8
+    query_mel_affine  [offset, scale] of a uint8 query_mel (None otherwise),
+                      decoded with decode_features(query_mel, affine)
+    query_labels      .npy of the window labels
+    support_data      .npz of the support features (None if not saved)
+    support_labels    .npy of the support labels (None if not saved)
+
+For the Training_Set, store_rows = [start, stop) are the rows of the
+file's features in the ragged feature store (data_utils/feature_store.py).
+
+The manifest is written once at the end of a preparation run, so that
+evaluation can index files directly instead of globbing and sorting.
+"""
+import json
+import os
+
+import numpy as np
+
+from data_utils.manifest import atomic_replace
+
+FEATURE_MANIFEST_FILE = "feature_manifest.jsonl"
+
+
+def npy_data_offset(path):
+    """Byte offset of the array data in a .npy file"""
+    with open(path, "rb") as f:
+        if np.lib.format.read_magic(f) == (1, 0):
+            np.lib.format.read_array_header_1_0(f)
+        else:
+            np.lib.format.read_array_header_2_0(f)
+        return f.tell()
+
+
+def write_feature_manifest(target_path, records):
+    def write(tmp_path):
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, sort_keys=True) + "\n")
+
+    atomic_replace(os.path.join(target_path, FEATURE_MANIFEST_FILE), write)
+
+
+def read_feature_manifest(target_path, filenames=None):
+    """Records of a prepared data directory, optionally only of filenames"""
+    with open(os.path.join(target_path, FEATURE_MANIFEST_FILE), encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if filenames is not None:
+        missing = set(filenames) - set(record["filename"] for record in records)
+        assert not missing, "files not in the manifest: {}".format(sorted(missing))
+        records = [record for record in records if record["filename"] in filenames]
+    return records
@@ -0,0 +1,198 @@
+"""
+Ragged on-disk store for variable length mel features.
+
+All features of a set are concatenated along time into a single
+(total_frames, bins) float32 array, so that feature i is the block
+features[offsets[i]:offsets[i + 1]]. Labels are stored as integer ids into
+classes. Every array is a separate .npy file, so that the store is opened
+with np.load(..., mmap_mode=...) instead of being read into memory, and the
+pages are shared through the page cache by all processes reading it.
+
+Features can be stored as float16 or uint8 (data_utils/feature_encoding.py)
+to reduce disk and page cache traffic. For uint8 the offset and scale of
+every feature are stored in feature_scales.npy.
+
+A SharedFeatureArena holds the same layout in RAM, in a single torch tensor
+in shared memory, for DataLoader workers that should not depend on the
+page cache (e.g. a store on network storage) or for features that are not
+in a store at all (the support sets of evaluateDCASE.py).
+"""
+import os
+
+import numpy as np
+import torch
+
+from data_utils.feature_encoding import decode_features, encode_features
+
+FEATURES_FILE = "features.npy"
+OFFSETS_FILE = "offsets.npy"
+LABEL_IDS_FILE = "label_ids.npy"
+CLASSES_FILE = "classes.npy"
+SCALES_FILE = "feature_scales.npy"
+
+
+def ragged_store_exists(path):
+    return all(
+        os.path.exists(os.path.join(path, file_name))
+        for file_name in [FEATURES_FILE, OFFSETS_FILE, LABEL_IDS_FILE, CLASSES_FILE]
+    )
+
+
+def write_ragged_store(path, features, labels, feature_dtype="float32", scales=None):
+    """Write features of size (bins, frames) and their labels to path
+
+    Features are encoded as feature_dtype, see FEATURE_DTYPES. With scales,
+    the uint8 features are encoded already, with the (offset, scale) of
+    every feature in scales, and are stored as they are.
+    """
+    assert len(features) == len(labels)
+    assert len(features) > 0, "no features to store"
+    lengths = np.array([feature.shape[1] for feature in features], dtype=np.int64)
+    offsets = np.zeros(len(features) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    classes, label_ids = np.unique(np.asarray(labels), return_inverse=True)
+
+    # remove an earlier store first and move the features in place last, so
+    # that an interrupted write never leaves a store that appears complete
+    for file_name in [
+        FEATURES_FILE,
+        OFFSETS_FILE,
+        LABEL_IDS_FILE,
+        CLASSES_FILE,
+        SCALES_FILE,
+    ]:
+        if os.path.exists(os.path.join(path, file_name)):
+            os.remove(os.path.join(path, file_name))
+    np.save(os.path.join(path, OFFSETS_FILE), offsets)
+    np.save(os.path.join(path, LABEL_IDS_FILE), label_ids.astype(np.int64))
+    np.save(os.path.join(path, CLASSES_FILE), classes)
+
+    tmp_path = os.path.join(path, ".tmp_" + FEATURES_FILE)
+    flat_features = np.lib.format.open_memmap(
+        tmp_path,
+        mode="w+",
+        dtype=np.dtype(feature_dtype),
+        shape=(int(offsets[-1]), features[0].shape[0]),
+    )
+    if scales is None:
+        # offset and scale of every uint8 feature
+        scales = np.zeros((len(features), 2))
+        for i, (feature, start, end) in enumerate(
+            zip(features, offsets[:-1], offsets[1:])
+        ):
+            encoded, offset, scale = encode_features(feature.T, feature_dtype)
+            flat_features[start:end] = encoded
+            if feature_dtype == "uint8":
+                scales[i] = offset, scale
+    else:
+        assert feature_dtype == "uint8", "scales are only used for uint8"
+        for feature, start, end in zip(features, offsets[:-1], offsets[1:]):
+            flat_features[start:end] = feature.T
+    if feature_dtype == "uint8":
+        np.save(os.path.join(path, SCALES_FILE), scales)
+    flat_features.flush()
+    del flat_features
+    os.replace(tmp_path, os.path.join(path, FEATURES_FILE))
+
+
+def convert_npz_to_ragged_store(path):
+    """Convert the data.npz/labels.npy of an earlier preparation run"""
+    input_features = np.load(os.path.join(path, "data.npz"))
+    labels = np.load(os.path.join(path, "labels.npy"))
+    write_ragged_store(
+        path, [input_features[key] for key in input_features.files], labels
+    )
+
+
+class RaggedFeatureStore:
+    """Memory-mapped view of a store written by write_ragged_store
+
+    The features are mapped copy-on-write, so that float32 features can be
+    wrapped with torch.from_numpy without copying while the pages stay
+    shared. float16 and uint8 features are decoded to float32 on access.
+    """
+
+    def __init__(self, path, mmap_mode="c"):
+        self.path = path
+        self.features = np.load(os.path.join(path, FEATURES_FILE), mmap_mode=mmap_mode)
+        self.offsets = np.load(os.path.join(path, OFFSETS_FILE))
+        self.label_ids = np.load(os.path.join(path, LABEL_IDS_FILE))
+        self.classes = np.load(os.path.join(path, CLASSES_FILE))
+        self.scales = None
+        if self.features.dtype == np.uint8:
+            self.scales = np.load(os.path.join(path, SCALES_FILE))
+
+    def __len__(self):
+        return len(self.label_ids)
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __getitem__(self, idx):
+        """float32 tensor of size (bins, frames), a view if stored as float32"""
+        encoded = self.features[self.offsets[idx] : self.offsets[idx + 1]].T
+        if self.scales is None:
+            return decode_features(encoded)
+        return decode_features(encoded, self.scales[idx])
+
+
+class SharedFeatureArena:
+    """Features of a ragged store, loaded once into shared memory
+
+    The features keep their encoding and are stored as one flat tensor, the
+    offsets, label ids and scales as plain numpy arrays. None of them holds
+    a python object per feature, so reading items in forked DataLoader
+    workers updates no reference counts in the shared pages, and the
+    tensor is passed to spawned workers as a handle to the same memory.
+    Items are returned like RaggedFeatureStore items.
+    """
+
+    def __init__(self, features, offsets, label_ids, classes, scales=None):
+        self.features = features
+        self.offsets = np.asarray(offsets)
+        self.label_ids = np.asarray(label_ids)
+        self.classes = np.asarray(classes)
+        self.scales = scales
+
+    @classmethod
+    def from_store(cls, store, block_rows=1 << 16):
+        """Copy a RaggedFeatureStore into shared memory, block by block"""
+        features = torch.empty(
+            store.features.shape, dtype=torch.from_numpy(store.features[:0]).dtype
+        ).share_memory_()
+        for start in range(0, len(store.features), block_rows):
+            features[start : start + block_rows] = torch.from_numpy(
+                np.asarray(store.features[start : start + block_rows])
+            )
+        return cls(
+            features, store.offsets, store.label_ids, store.classes, store.scales
+        )
+
+    @classmethod
+    def from_features(cls, features, labels):
+        """Concatenate float32 features of size (bins, frames) into an arena"""
+        assert len(features) == len(labels)
+        assert len(features) > 0, "no features to store"
+        lengths = np.array([feature.shape[1] for feature in features], dtype=np.int64)
+        offsets = np.zeros(len(features) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        classes, label_ids = np.unique(np.asarray(labels), return_inverse=True)
+        flat_features = torch.empty(
+            (int(offsets[-1]), features[0].shape[0]), dtype=torch.float32
+        ).share_memory_()
+        for feature, start, end in zip(features, offsets[:-1], offsets[1:]):
+            flat_features[start:end] = torch.as_tensor(feature).T
+        return cls(flat_features, offsets, label_ids.astype(np.int64), classes)
+
+    def __len__(self):
+        return len(self.label_ids)
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __getitem__(self, idx):
+        """float32 tensor of size (bins, frames), a view if stored as float32"""
+        encoded = self.features[self.offsets[idx] : self.offsets[idx + 1]].T
+        if self.scales is None:
+            return decode_features(encoded)
+        return decode_features(encoded, self.scales[idx])
@@ -0,0 +1,148 @@
+"""
+Manifest of the source files processed into a prepared data directory.
+
+For every annotation file the manifest records the size, mtime and sha1 of
+the csv and its wav, and the outputs that were produced from them. A rerun
+of the preparation only processes files that are new or changed since they
+were recorded, and removes the outputs of files that no longer exist.
+
+All writes go to a temporary file in the same directory which is then
+renamed, so that an interrupted run never leaves a truncated output or
+manifest behind.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+MANIFEST_FILE = "source_manifest.json"
+
+
+def atomic_replace(path, write):
+    """Call write(tmp_path) and rename the result to path"""
+    directory, file_name = os.path.split(path)
+    # the pid keeps concurrent writers of the same path apart
+    tmp_path = os.path.join(directory, ".tmp{}_{}".format(os.getpid(), file_name))
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def atomic_save(path, array):
+    """np.save to path, which includes the .npy extension"""
+
+    def write(tmp_path):
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+
+    atomic_replace(path, write)
+
+
+def atomic_savez(path, *args, **kwds):
+    """np.savez to path, which includes the .npz extension"""
+
+    def write(tmp_path):
+        with open(tmp_path, "wb") as f:
+            np.savez(f, *args, **kwds)
+
+    atomic_replace(path, write)
+
+
+def file_sha1(path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def file_signature(path, with_sha1=True):
+    stat = os.stat(path)
+    signature = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if with_sha1:
+        signature["sha1"] = file_sha1(path)
+    return signature
+
+
+def is_unchanged(path, signature):
+    """Compare a file with its recorded signature
+
+    Size and mtime are checked first. Only if the size matches but the mtime
+    differs (e.g. the file was copied or touched), the sha1 is computed.
+    """
+    if signature is None or not os.path.exists(path):
+        return False
+    current = file_signature(path, with_sha1=False)
+    if current["size"] != signature["size"]:
+        return False
+    if current["mtime_ns"] == signature["mtime_ns"]:
+        return True
+    return file_sha1(path) == signature["sha1"]
+
+
+class SourceManifest:
+    """source_manifest.json of a prepared data directory
+
+    Entries are keyed by the path of the annotation file relative to the
+    root directory of the data set.
+    """
+
+    def __init__(self, target_path):
+        self.target_path = target_path
+        self.path = os.path.join(target_path, MANIFEST_FILE)
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+
+    def save(self):
+        def write(tmp_path):
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+
+        atomic_replace(self.path, write)
+
+    def is_done(self, key, csv_path, wav_path):
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+        if not all(
+            os.path.exists(os.path.join(self.target_path, output))
+            for output in entry["outputs"]
+        ):
+            return False
+        return is_unchanged(csv_path, entry["csv"]) and is_unchanged(
+            wav_path, entry["wav"]
+        )
+
+    def update(self, key, csv_path, wav_path, outputs, **extra):
+        """Record the outputs (relative to target_path) of a processed file"""
+        old_entry = self.entries.get(key)
+        if old_entry is not None:
+            self._remove_outputs(set(old_entry["outputs"]) - set(outputs))
+        self.entries[key] = dict(
+            csv=file_signature(csv_path),
+            wav=file_signature(wav_path),
+            outputs=list(outputs),
+            **extra
+        )
+        self.save()
+
+    def remove_stale(self, keys):
+        """Remove the entries and outputs of files not in keys"""
+        stale_keys = set(self.entries) - set(keys)
+        for key in stale_keys:
+            self._remove_outputs(self.entries.pop(key)["outputs"])
+        if stale_keys:
+            self.save()
+        return sorted(stale_keys)
+
+    def _remove_outputs(self, outputs):
+        for output in outputs:
+            output_path = os.path.join(self.target_path, output)
+            if os.path.exists(output_path):
+                os.remove(output_path)
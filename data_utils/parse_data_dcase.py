@@ -5,19 +5,21 @@ import os
 import glob
 import pandas as pd
 
-import librosa
 import soundfile
 
-def main(audio_path, annotation_path, save_dir):
+from data_utils.waveform_cache import DEFAULT_CACHE_DIR, WaveformCache
+
+def main(audio_path, annotation_path, save_dir, waveform_cache_dir=DEFAULT_CACHE_DIR):
 
     data = glob.glob(audio_path + "/**/*.wav", recursive=True)
     annotations = glob.glob(annotation_path + "/**/*.csv", recursive=True)
 
+    waveform_cache = WaveformCache(waveform_cache_dir)
     for txt_file, wav in zip(annotations, data):
         print(txt_file)
         # Use some example data
         df = pd.read_csv(txt_file)
-        sig, sr = librosa.load(wav, sr=16000, mono=True)
+        sig, sr = waveform_cache.load(wav, 16000)
 
         # Get background noise only
         column_names = df.iloc[: , 3:].columns
@@ -77,6 +79,19 @@ if __name__ == "__main__":
         type=str,
     )   
 
+    parser.add_argument(
+        "--waveform_cache_dir",
+        help="Directory of the decoded waveform cache, '' disables the cache",
+        default=DEFAULT_CACHE_DIR,
+        required=False,
+        type=str,
+    )
+
     cli_args = parser.parse_args()
 
-    main(cli_args.audio_path, cli_args.annotation_path, cli_args.save_dir)
\ No newline at end of file
+    main(
+        cli_args.audio_path,
+        cli_args.annotation_path,
+        cli_args.save_dir,
+        cli_args.waveform_cache_dir if cli_args.waveform_cache_dir else None,
+    )
\ No newline at end of file
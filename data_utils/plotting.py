@@ -0,0 +1,72 @@
+"""
+Background rendering of the diagnostic spectrogram plots of DCASEfewshot.py.
+
+Features are put on a bounded queue and rendered by a few worker threads,
+each with a single reusable matplotlib figure (object oriented Agg API, no
+pyplot state), so that extraction does not wait for png encoding and no
+figures accumulate in memory.
+"""
+import queue
+import threading
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+
+class PlotRenderer:
+    """Render (bins, frames) features to png in background threads
+
+    Only every plot_every-th submitted feature is rendered. submit blocks
+    once max_queued features are waiting, which bounds the memory held by
+    the queue.
+    """
+
+    def __init__(self, num_workers=2, max_queued=64, plot_every=1):
+        self.plot_every = plot_every
+        self.num_submitted = 0
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.workers = [
+            threading.Thread(target=self._render_loop, daemon=True)
+            for _ in range(num_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, feature, title, path):
+        self.num_submitted += 1
+        if (self.num_submitted - 1) % self.plot_every != 0:
+            return
+        self.queue.put((np.asarray(feature), title, path))
+
+    def close(self):
+        """Wait until all queued features are rendered"""
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def _render_loop(self):
+        figure = Figure()
+        FigureCanvasAgg(figure)
+        ax = figure.add_subplot()
+        image = None
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            feature, title, path = item
+            try:
+                if image is None:
+                    image = ax.imshow(feature, cmap="hot", interpolation="nearest")
+                else:
+                    # reuse the image, a new imshow per feature would stack up
+                    height, width = feature.shape
+                    image.set_data(feature)
+                    image.set_extent((-0.5, width - 0.5, height - 0.5, -0.5))
+                    image.set_clim(feature.min(), feature.max())
+                ax.set_title(title)
+                figure.savefig(path)
+            except Exception as error:
+                # a failing plot should not stop the extraction
+                print("Plotting {} failed: {}".format(path, error))
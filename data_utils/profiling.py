@@ -0,0 +1,70 @@
+"""
+Stage timers and counters for the preprocessing of DCASEfewshot.py.
+
+A StageProfiler adds up the wall time and number of calls of named stages
+(with profiler.stage("fbank"): ...) and named counters (events, frames,
+bytes written). A disabled profiler returns a shared no-op context and
+ignores counts, so the instrumentation can stay in place at no real cost.
+"""
+import contextlib
+import time
+
+_NULL_STAGE = contextlib.nullcontext()
+
+
+class _Stage:
+    __slots__ = ("stages", "name", "start")
+
+    def __init__(self, stages, name):
+        self.stages = stages
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        stage = self.stages.setdefault(self.name, [0.0, 0])
+        stage[0] += time.perf_counter() - self.start
+        stage[1] += 1
+
+
+class StageProfiler:
+    """Wall time and calls per stage, and counters
+
+    Stages should not be nested, so that the stage times add up to the
+    time spent in all of them.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = {}
+        self.counters = {}
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self.stages, name)
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    def as_dict(self):
+        return {
+            "stages": {
+                name: {"seconds": seconds, "calls": calls}
+                for name, (seconds, calls) in sorted(self.stages.items())
+            },
+            "counters": dict(sorted(self.counters.items())),
+        }
+
+    def merge(self, stats):
+        """Add the as_dict() of another profiler, e.g. of a worker process"""
+        if not self.enabled or stats is None:
+            return
+        for name, stage in stats["stages"].items():
+            totals = self.stages.setdefault(name, [0.0, 0])
+            totals[0] += stage["seconds"]
+            totals[1] += stage["calls"]
+        for name, value in stats["counters"].items():
+            self.count(name, value)
@@ -0,0 +1,215 @@
+"""
+Write a synthetic data set with the layout of the DCASE few-shot
+Development_Set, for profiling without the real recordings.
+
+root/<set_type>/<class>/<name>.wav holds noise with short tones at the
+annotated events and root/<set_type>/<class>/<name>.csv the annotations, in
+one of the styles handled by DCASEfewshot.py:
+
+    CALL     a single CALL column, every event is of the directory class
+    classes  a POS/NEG/UNK column per class, one class POS per event
+    Q        a single Q column, as in the Validation_Set
+
+Every class of a file has at least five events, so that all files are used
+by DCASEfewshot.py.
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+import soundfile as sf
+
+SET_TYPES = {
+    "train": "Training_Set",
+    "validate": "Validation_Set",
+    "test": "Evaluation_Set",
+}
+DEFAULT_STYLES = {
+    "Training_Set": ["CALL", "classes"],
+    "Validation_Set": ["Q"],
+    "Evaluation_Set": ["Q"],
+}
+# samples generated at once, so that long recordings are never in memory
+BLOCK_DURATION = 60
+
+
+def event_times(duration, num_events, rng, min_gap=0.3):
+    """Sorted, non-overlapping events of 0.05 to 0.5 s"""
+    lengths = rng.uniform(0.05, 0.5, num_events)
+    free = duration - 1.0 - lengths.sum() - min_gap * num_events
+    assert free > 0, "too many events for a {} s recording".format(duration)
+    gaps = rng.dirichlet(np.ones(num_events + 1))[:num_events] * free + min_gap
+    starts = 0.5 + np.cumsum(gaps) + np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    return starts, starts + lengths
+
+
+def write_recording(audio_path, duration, sample_rate, starts, ends, tones, rng):
+    num_samples = int(duration * sample_rate)
+    block_size = BLOCK_DURATION * sample_rate
+    with sf.SoundFile(
+        audio_path, "w", samplerate=sample_rate, channels=1, subtype="PCM_16"
+    ) as f:
+        for block_start in range(0, num_samples, block_size):
+            block_end = min(block_start + block_size, num_samples)
+            block = 0.05 * rng.standard_normal(block_end - block_start)
+            t = np.arange(block_start, block_end) / sample_rate
+            for start, end, tone in zip(starts, ends, tones):
+                event = (t >= start) & (t < end)
+                if event.any():
+                    block[event] += 0.5 * np.sin(2 * np.pi * tone * t[event])
+            f.write(block.astype(np.float32))
+
+
+def annotations(file_name, starts, ends, style, class_names, event_classes):
+    df = pd.DataFrame(
+        {
+            "Audiofilename": [file_name] * len(starts),
+            "Starttime": starts,
+            "Endtime": ends,
+        }
+    )
+    if style == "CALL":
+        df["CALL"] = "POS"
+    elif style == "Q":
+        df["Q"] = "POS"
+    else:
+        for class_ind, class_name in enumerate(class_names):
+            # events of other classes are NEG or UNK for this class
+            df[class_name] = np.where(
+                event_classes == class_ind,
+                "POS",
+                np.where(np.arange(len(starts)) % 3 == 0, "UNK", "NEG"),
+            )
+    return df
+
+
+def write_synthetic_set(
+    root_dir,
+    set_type,
+    num_files=4,
+    duration=60.0,
+    sample_rates=(16000, 22050, 44100),
+    events_per_class=10,
+    styles=None,
+    num_classes=3,
+    seed=42,
+):
+    """Write num_files recordings and annotations to root_dir/set_type
+
+    Sample rates and annotation styles are assigned to the files in turn.
+    Files in the classes style have num_classes classes.
+
+    Returns the paths of the csv files.
+    """
+    rng = np.random.default_rng(seed)
+    styles = DEFAULT_STYLES[set_type] if styles is None else styles
+    csv_files = []
+    for file_ind in range(num_files):
+        style = styles[file_ind % len(styles)]
+        sample_rate = sample_rates[file_ind % len(sample_rates)]
+        # a few recordings per class directory
+        class_dir = "C{}".format(file_ind // 2)
+        file_name = "{}_{:03d}.wav".format(set_type.split("_")[0].lower(), file_ind)
+        if style == "classes":
+            class_names = [
+                "{}_{}".format(class_dir, class_ind) for class_ind in range(num_classes)
+            ]
+        else:
+            class_names = [class_dir]
+        event_classes = rng.permutation(
+            np.repeat(np.arange(len(class_names)), events_per_class)
+        )
+        starts, ends = event_times(duration, len(event_classes), rng)
+        # a tone per class, below the nyquist frequency of every rate
+        tones = 1000 + 1000 * event_classes
+
+        os.makedirs(os.path.join(root_dir, set_type, class_dir), exist_ok=True)
+        audio_path = os.path.join(root_dir, set_type, class_dir, file_name)
+        write_recording(audio_path, duration, sample_rate, starts, ends, tones, rng)
+        csv_path = os.path.splitext(audio_path)[0] + ".csv"
+        annotations(file_name, starts, ends, style, class_names, event_classes).to_csv(
+            csv_path, index=False
+        )
+        csv_files.append(csv_path)
+    return csv_files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--root_dir",
+        help="Directory to write the set_type directories to",
+        required=True,
+        type=str,
+    )
+    parser.add_argument(
+        "--status",
+        help="Sets to write: 'train', 'validate' and/or 'test'",
+        default=["train", "validate"],
+        nargs="+",
+        required=False,
+        type=str,
+    )
+    parser.add_argument(
+        "--num_files",
+        help="Number of recordings per set",
+        default=4,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--duration",
+        help="Duration of every recording in seconds",
+        default=60.0,
+        required=False,
+        type=float,
+    )
+    parser.add_argument(
+        "--sample_rates",
+        help="Sampling frequencies, assigned to the recordings in turn",
+        default=[16000, 22050, 44100],
+        nargs="+",
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--events_per_class",
+        help="Number of events of every class in a recording",
+        default=10,
+        required=False,
+        type=int,
+    )
+    parser.add_argument(
+        "--styles",
+        help="Annotation styles ('CALL', 'classes', 'Q'), by default CALL and "
+        "classes for the Training_Set and Q otherwise",
+        default=None,
+        nargs="+",
+        required=False,
+        type=str,
+    )
+    parser.add_argument(
+        "--seed",
+        help="Seed of the random generator",
+        default=42,
+        required=False,
+        type=int,
+    )
+
+    cli_args = parser.parse_args()
+    assert cli_args.styles is None or set(cli_args.styles) <= {"CALL", "classes", "Q"}
+
+    for set_ind, status in enumerate(cli_args.status):
+        csv_files = write_synthetic_set(
+            cli_args.root_dir,
+            SET_TYPES[status],
+            num_files=cli_args.num_files,
+            duration=cli_args.duration,
+            sample_rates=cli_args.sample_rates,
+            events_per_class=cli_args.events_per_class,
+            styles=cli_args.styles,
+            seed=cli_args.seed + set_ind,
+        )
+        print("{}: {} files".format(SET_TYPES[status], len(csv_files)))
@@ -0,0 +1,125 @@
+"""
+Content-addressed cache of decoded (and resampled) waveforms.
+
+Every preprocessing variant decodes and resamples the same source audio.
+The cache stores the float32 mono waveform of a file once per
+(sha1 of the file, sampling frequency, resampler) as a .npy file, which is
+opened as a memmap on later loads. Since the key is the content of the
+file, renamed or copied files hit the cache and changed files miss it.
+
+The sha1 of a file is remembered per (path, size, mtime), so that it is
+only computed once.
+"""
+import hashlib
+import json
+import os
+from math import gcd
+
+import librosa
+import numpy as np
+import scipy.signal
+
+from data_utils.manifest import atomic_replace, atomic_save, file_sha1
+
+DEFAULT_CACHE_DIR = "/data/DCASEfewshot/waveform_cache"
+# default res_type of the librosa 0.9 of poetry.lock (resampy), so that the
+# hash directories without a resampler key keep their features
+DEFAULT_RESAMPLER = "kaiser_best"
+
+
+def resample_waveform(y, orig_sr, target_sr, resampler=DEFAULT_RESAMPLER):
+    """Resample y with librosa (resampler is its res_type) or polyphase
+
+    polyphase uses scipy.signal.resample_poly with its default Kaiser
+    window. benchmarks/resample_benchmark.py compares the speed and
+    accuracy of the resamplers.
+    """
+    if orig_sr == target_sr:
+        return y
+    if resampler == "polyphase":
+        divisor = gcd(int(orig_sr), int(target_sr))
+        return scipy.signal.resample_poly(
+            y, int(target_sr) // divisor, int(orig_sr) // divisor
+        ).astype(np.float32)
+    return librosa.resample(y, orig_sr=orig_sr, target_sr=target_sr, res_type=resampler)
+
+
+class WaveformCache:
+    """Load mono float32 waveforms through the cache in cache_dir
+
+    With cache_dir None every load decodes (and resamples) the file again.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, resampler=DEFAULT_RESAMPLER):
+        self.cache_dir = cache_dir
+        self.resampler = resampler
+        if cache_dir is not None:
+            os.makedirs(os.path.join(cache_dir, "index"), exist_ok=True)
+
+    def file_hash(self, audio_path):
+        # sha1 of the file, remembered per path, size and mtime
+        stat = os.stat(audio_path)
+        real_path = os.path.realpath(audio_path)
+        index_path = os.path.join(
+            self.cache_dir,
+            "index",
+            hashlib.sha1(real_path.encode()).hexdigest() + ".json",
+        )
+        if os.path.exists(index_path):
+            with open(index_path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            if entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+                return entry["sha1"]
+        entry = {
+            "path": real_path,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha1": file_sha1(audio_path),
+        }
+
+        def write(tmp_path):
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+
+        atomic_replace(index_path, write)
+        return entry["sha1"]
+
+    def cache_path(self, sha1, target_fs):
+        if target_fs is None:
+            key = sha1 + "_native"
+        else:
+            key = "_".join([sha1, str(target_fs), self.resampler])
+        return os.path.join(self.cache_dir, sha1[:2], key + ".npy")
+
+    def load(self, audio_path, target_fs=None):
+        """Return the waveform of audio_path and its sampling frequency
+
+        The waveform is resampled to target_fs, or kept at the sampling
+        frequency of the file if target_fs is None. Cached waveforms are
+        returned as copy-on-write memmaps.
+        """
+        if self.cache_dir is None:
+            return self._decode(audio_path, target_fs)
+        if target_fs == self.native_fs(audio_path):
+            target_fs = None
+        path = self.cache_path(self.file_hash(audio_path), target_fs)
+        if not os.path.exists(path):
+            if target_fs is None:
+                y, fs = self._decode(audio_path, None)
+            else:
+                # resample from the cached waveform at the native rate
+                y, fs = self.load(audio_path)
+                y, fs = resample_waveform(y, fs, target_fs, self.resampler), target_fs
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            atomic_save(path, np.asarray(y, dtype=np.float32))
+        y = np.load(path, mmap_mode="c")
+        return y, (target_fs if target_fs is not None else self.native_fs(audio_path))
+
+    def native_fs(self, audio_path):
+        return librosa.get_samplerate(audio_path)
+
+    def _decode(self, audio_path, target_fs):
+        y, fs = librosa.load(audio_path, sr=None, mono=True)
+        if target_fs is not None:
+            y, fs = resample_waveform(y, fs, target_fs, self.resampler), target_fs
+        return y, fs
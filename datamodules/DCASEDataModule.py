@@ -4,13 +4,20 @@ import os
 import hashlib
 import json
 
-import pandas as pd
 from torch.utils.data import Dataset, DataLoader
 from sklearn.preprocessing import LabelEncoder
 from sklearn.model_selection import train_test_split
 from pytorch_lightning import LightningDataModule
 import torch
-from data_utils.dataset import TaskSampler
+from data_utils.dataset import TaskSampler, worker_kwargs
+from data_utils.episodes import EpisodeBank, EpisodeGenerator, EpisodePrefetcher
+from data_utils.feature_store import (
+    RaggedFeatureStore,
+    SharedFeatureArena,
+    convert_npz_to_ragged_store,
+    ragged_store_exists,
+)
+from data_utils.waveform_cache import DEFAULT_RESAMPLER
 import numpy as np
 
 
@@ -29,14 +36,7 @@ class AudioDatasetDCASE(Dataset):
         return len(self.data_frame)
 
     def get_labels(self):
-        labels = []
-
-        for i in range(0, len(self.data_frame)):
-            label = self.data_frame.iloc[i]["category"]
-            label = self.label_encoder.transform([label])[0]
-            labels.append(label)
-
-        return labels
+        return self.label_encoder.transform(self.data_frame["category"])
 
     def __getitem__(self, idx):
         # obtain
@@ -49,7 +49,45 @@ class AudioDatasetDCASE(Dataset):
         return input_feature, label
 
 
-def few_shot_dataloader(df, n_way, n_shot, n_query, n_tasks, tensor_length):
+class RaggedDatasetDCASE(Dataset):
+    """Subset of a RaggedFeatureStore or SharedFeatureArena
+
+    Items are returned as float32 tensors (views of the memory-mapped store
+    if it is not encoded), with the integer label id of the store.
+    """
+
+    def __init__(
+        self,
+        store,
+        indices,
+    ):
+        self.store = store
+        self.indices = np.asarray(indices)
+        self.labels = store.label_ids[self.indices]
+
+    def __len__(self):
+        return len(self.indices)
+
+    def get_labels(self):
+        return self.labels
+
+    def __getitem__(self, idx):
+        input_feature = self.store[self.indices[idx]]
+        return input_feature, self.labels[idx]
+
+
+def few_shot_dataloader(
+    df,
+    n_way,
+    n_shot,
+    n_query,
+    n_tasks,
+    tensor_length,
+    num_workers=0,
+    persistent_workers=False,
+    seed=None,
+    prefetch_factor=2,
+):
     """
     root_dir: directory where the audio data is stored
     data_frame: path to the label file
@@ -57,6 +95,10 @@ def few_shot_dataloader(df, n_way, n_shot, n_query, n_tasks, tensor_length):
     n_shot: number of images PER CLASS in the support set
     n_query: number of images PER CLASSS in the query set
     n_tasks: number of episodes (number of times the loader gives the data during a training step)
+    num_workers: number of DataLoader worker processes (0 loads in the main process)
+    persistent_workers: keep the workers alive between epochs
+    seed: seed of the task draws, see TaskSampler
+    prefetch_factor: number of batches loaded ahead by each worker
     """
 
     # df = AudioDataset(root_dir=root_dir, data_frame=data_frame, transform=transform)
@@ -68,6 +110,7 @@ def few_shot_dataloader(df, n_way, n_shot, n_query, n_tasks, tensor_length):
         n_query=n_query,  # Number of images PER CLASSS in the query set
         n_tasks=n_tasks,  # Not sure
         tensor_length=tensor_length,  # length of model input tensor
+        seed=seed,
     )
 
     loader = DataLoader(
@@ -75,6 +118,7 @@ def few_shot_dataloader(df, n_way, n_shot, n_query, n_tasks, tensor_length):
         batch_sampler=sampler,
         pin_memory=False,
         collate_fn=sampler.episodic_collate_fn,
+        **worker_kwargs(num_workers, prefetch_factor, persistent_workers),
     )
 
     return loader
@@ -97,6 +141,20 @@ class DCASEDataModule(LightningDataModule):
         set_type: str = "Training_Set",
         n_shot: int = 5,
         n_query: int = 10,
+        file_fbank: bool = False,
+        resampler: str = DEFAULT_RESAMPLER,
+        batched_denoise: bool = False,
+        feature_dtype: str = "float32",
+        num_workers: int = 0,
+        persistent_workers: bool = False,
+        prefetch_factor: int = 2,
+        shared_memory: bool = False,
+        episode_mode: bool = False,
+        episode_device: str = None,
+        prefetch_episodes: int = 0,
+        pin_memory: bool = False,
+        fixed_val_episodes: bool = False,
+        val_seed: int = 42,
         **kwargs
     ):
         super().__init__(**kwargs)
@@ -113,6 +171,23 @@ class DCASEDataModule(LightningDataModule):
         self.set_type = set_type
         self.n_shot = n_shot
         self.n_query = n_query
+        self.file_fbank = file_fbank
+        self.resampler = resampler
+        self.batched_denoise = batched_denoise
+        self.feature_dtype = feature_dtype
+        self.num_workers = num_workers
+        self.persistent_workers = persistent_workers
+        self.prefetch_factor = prefetch_factor
+        self.shared_memory = shared_memory
+        self.episode_mode = episode_mode
+        if episode_device is None:
+            episode_device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.episode_device = episode_device
+        self.prefetch_episodes = prefetch_episodes
+        self.pin_memory = pin_memory
+        self.fixed_val_episodes = fixed_val_episodes
+        self.val_seed = val_seed
+        self.val_episodes = None
         self.setup()
 
     def setup(self, stage=None):
@@ -127,69 +202,112 @@ class DCASEDataModule(LightningDataModule):
         }
         if self.resample:
             my_hash_dict["tartget_fs"] = self.target_fs
+            if self.resampler != DEFAULT_RESAMPLER:
+                my_hash_dict["resampler"] = self.resampler
+        if self.denoise and self.batched_denoise:
+            my_hash_dict["batched_denoise"] = self.batched_denoise
+        if self.file_fbank:
+            my_hash_dict["file_fbank"] = self.file_fbank
+        if self.feature_dtype != "float32":
+            my_hash_dict["feature_dtype"] = self.feature_dtype
         hash_dir_name = hashlib.sha1(
             json.dumps(my_hash_dict, sort_keys=True).encode()
         ).hexdigest()
         target_path = os.path.join(
             "/data/DCASEfewshot", self.status, hash_dir_name, "audio"
         )
-        # load data
-        input_features = np.load(os.path.join(target_path, "data.npz"))
-        labels = np.load(os.path.join(target_path, "labels.npy"))
-        list_input_features = [input_features[key] for key in input_features.files]
-        data_frame = pd.DataFrame({"feature": list_input_features, "category": labels})
-
-        complete_dataset = AudioDatasetDCASE(
-            data_frame=data_frame,
-        )
+        # open the ragged feature store, converting data.npz of earlier runs
+        if not ragged_store_exists(target_path):
+            convert_npz_to_ragged_store(target_path)
+        store = RaggedFeatureStore(target_path)
+        if self.shared_memory:
+            # NOTE: the memory-mapped store is already shared by the workers
+            # through the page cache, the arena keeps it in RAM instead
+            store = SharedFeatureArena.from_store(store)
+
         # Separate into training and validation set
         train_indices, validation_indices, _, _ = train_test_split(
-            range(len(complete_dataset)),
-            complete_dataset.get_labels(),
+            range(len(store)),
+            store.label_ids,
             test_size=0.2,
             random_state=42,
         )
-        data_frame_train = data_frame.loc[train_indices]
-        # remove classes with too few samples
-        value_counts = data_frame_train["category"].value_counts()
-        to_remove = value_counts[value_counts <= (self.n_shot + self.n_query)].index
-        data_frame_train = data_frame_train[~data_frame_train.category.isin(to_remove)]
-        data_frame_train.reset_index(drop=True, inplace=True)
-
-        data_frame_validation = data_frame.loc[validation_indices]
-        # remove classes with too few samples
-        value_counts = data_frame_validation["category"].value_counts()
-        to_remove = value_counts[value_counts <= (self.n_shot + self.n_query)].index
-        data_frame_validation = data_frame_validation[
-            ~data_frame_validation.category.isin(to_remove)
-        ]
-        data_frame_validation.reset_index(drop=True, inplace=True)
-        # generate subset based on indices
-        self.train_set = AudioDatasetDCASE(
-            data_frame=data_frame_train,
+        # generate subsets, without classes with too few samples
+        self.train_set = RaggedDatasetDCASE(
+            store,
+            self.remove_rare_classes(store.label_ids, train_indices),
         )
-        self.val_set = AudioDatasetDCASE(
-            data_frame=data_frame_validation,
+        self.val_set = RaggedDatasetDCASE(
+            store,
+            self.remove_rare_classes(store.label_ids, validation_indices),
         )
 
-    def train_dataloader(self):
-        train_loader = few_shot_dataloader(
-            self.train_set,
+    def remove_rare_classes(self, label_ids, indices):
+        indices = np.asarray(indices)
+        value_counts = np.bincount(label_ids[indices], minlength=label_ids.max() + 1)
+        to_keep = value_counts[label_ids[indices]] > (self.n_shot + self.n_query)
+        return indices[to_keep]
+
+    def episode_generator(self, dataset, n_tasks, seed=None):
+        # episodes assembled on episode_device, without DataLoader
+        return EpisodeGenerator(
+            dataset.store,
+            dataset.indices,
             n_way=5,
             n_shot=5,
             n_query=10,
-            n_tasks=self.n_task_train,
+            n_tasks=n_tasks,
             tensor_length=self.tensor_length,
+            device=self.episode_device,
+            seed=seed,
         )
-        return train_loader
 
-    def val_dataloader(self):
-        val_loader = few_shot_dataloader(
-            self.val_set,
+    def prefetch(self, loader):
+        # build episodes ahead on a background thread
+        if self.prefetch_episodes > 0:
+            return EpisodePrefetcher(
+                loader, self.prefetch_episodes, pin_memory=self.pin_memory
+            )
+        return loader
+
+    def train_dataloader(self):
+        if self.episode_mode:
+            return self.prefetch(
+                self.episode_generator(self.train_set, self.n_task_train)
+            )
+        train_loader = few_shot_dataloader(
+            self.train_set,
             n_way=5,
             n_shot=5,
             n_query=10,
-            n_tasks=self.n_task_val,
+            n_tasks=self.n_task_train,
             tensor_length=self.tensor_length,
+            num_workers=self.num_workers,
+            persistent_workers=self.persistent_workers,
+            prefetch_factor=self.prefetch_factor,
         )
-        return val_loader
+        return self.prefetch(train_loader)
+
+    def val_dataloader(self):
+        seed = self.val_seed if self.fixed_val_episodes else None
+        if self.episode_mode:
+            val_loader = self.episode_generator(self.val_set, self.n_task_val, seed)
+        else:
+            val_loader = few_shot_dataloader(
+                self.val_set,
+                n_way=5,
+                n_shot=5,
+                n_query=10,
+                n_tasks=self.n_task_val,
+                tensor_length=self.tensor_length,
+                num_workers=self.num_workers,
+                persistent_workers=self.persistent_workers,
+                prefetch_factor=self.prefetch_factor,
+                seed=seed,
+            )
+        if self.fixed_val_episodes:
+            # drawn once, replayed every epoch without collation
+            if self.val_episodes is None:
+                self.val_episodes = EpisodeBank.materialize(val_loader, seed)
+            return self.val_episodes
+        return self.prefetch(val_loader)
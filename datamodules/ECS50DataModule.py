@@ -1,5 +1,4 @@
 import glob
-import librosa
 import torch
 import pandas as pd
 import os
@@ -10,12 +9,32 @@ from sklearn.preprocessing import LabelEncoder
 
 from pytorch_lightning import LightningDataModule
 
+from data_utils.audio_cache import AudioCache
+from data_utils.dataset import worker_kwargs
+from data_utils.fbank_transform import FbankTransform, WaveformCollate
+from data_utils.waveform_cache import DEFAULT_CACHE_DIR
+
 
 class AudioDataset(Dataset):
-    def __init__(self, root_dir, data_frame, transform=None):
+    """Clips of a data frame, loaded through audio_cache
+
+    The 16 kHz waveforms, or log-mel features with features="fbank", are
+    cached in memory and on disk (data_utils/audio_cache.py).
+    """
+
+    def __init__(
+        self,
+        root_dir,
+        data_frame,
+        transform=None,
+        audio_cache=None,
+        features="waveform",
+    ):
         self.root_dir = root_dir
         self.transform = transform
         self.data_frame = data_frame
+        self.audio_cache = AudioCache() if audio_cache is None else audio_cache
+        self.features = features
 
         self.label_encoder = LabelEncoder()
         self.label_encoder.fit(self.data_frame["category"])
@@ -28,7 +47,7 @@ class AudioDataset(Dataset):
         label = self.data_frame.iloc[idx]["category"]
 
         # Load audio data and perform any desired transformations
-        sig, sr = librosa.load(audio_path, sr=16000, mono=True)
+        sig = self.audio_cache.load(audio_path, self.features)
         sig_t = torch.tensor(sig)
         padding_mask = torch.zeros(1, sig_t.shape[0]).bool().squeeze(0)
         if self.transform:
@@ -48,6 +67,12 @@ class ECS50DataModule(LightningDataModule):
         batch_size: int = 8,
         split_ratio=0.8,
         transform=None,
+        cache_dir: str = DEFAULT_CACHE_DIR,
+        cache_memory_bytes: int = 1 << 30,
+        features: str = "waveform",
+        fbank_collate: bool = False,
+        num_workers: int = 0,
+        prefetch_factor: int = 2,
         **kwargs
     ):
         super().__init__(**kwargs)
@@ -56,9 +81,22 @@ class ECS50DataModule(LightningDataModule):
         self.batch_size = batch_size
         self.split_ratio = split_ratio
         self.transform = transform
+        self.features = features
+        # compute the fbanks of a batch in the collate function, instead of
+        # the FbankTransform of the model
+        self.fbank_collate = fbank_collate
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        # shared by the train and val sets, and by the epochs
+        self.audio_cache = AudioCache(cache_dir, max_memory_bytes=cache_memory_bytes)
 
         self.setup()
 
+    def collate_fn(self):
+        if self.features != "waveform":
+            return None
+        return WaveformCollate(FbankTransform() if self.fbank_collate else None)
+
     def prepare_data(self):
         pass
 
@@ -73,14 +111,34 @@ class ECS50DataModule(LightningDataModule):
 
     def train_dataloader(self):
         train_df = AudioDataset(
-            root_dir=self.root_dir, data_frame=self.train_set, transform=self.transform
+            root_dir=self.root_dir,
+            data_frame=self.train_set,
+            transform=self.transform,
+            audio_cache=self.audio_cache,
+            features=self.features,
         )
 
-        return DataLoader(train_df, batch_size=self.batch_size, shuffle=True)
+        return DataLoader(
+            train_df,
+            batch_size=self.batch_size,
+            shuffle=True,
+            collate_fn=self.collate_fn(),
+            **worker_kwargs(self.num_workers, self.prefetch_factor),
+        )
 
     def val_dataloader(self):
         val_df = AudioDataset(
-            root_dir=self.root_dir, data_frame=self.val_set, transform=self.transform
+            root_dir=self.root_dir,
+            data_frame=self.val_set,
+            transform=self.transform,
+            audio_cache=self.audio_cache,
+            features=self.features,
         )
 
-        return DataLoader(val_df, batch_size=self.batch_size, shuffle=False)
+        return DataLoader(
+            val_df,
+            batch_size=self.batch_size,
+            shuffle=False,
+            collate_fn=self.collate_fn(),
+            **worker_kwargs(self.num_workers, self.prefetch_factor),
+        )
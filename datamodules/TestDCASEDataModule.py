@@ -10,59 +10,94 @@ from sklearn.preprocessing import LabelEncoder
 from sklearn.model_selection import train_test_split
 from pytorch_lightning import LightningDataModule
 import torch
-from data_utils.dataset import TaskSampler
+from data_utils.dataset import TaskSampler, worker_kwargs
+from data_utils.feature_encoding import decode_features
+from data_utils.feature_store import SharedFeatureArena
 import numpy as np
 
 
 class AudioDatasetDCASE(Dataset):
+    """Features and categories of a data frame, served from shared memory
+
+    The features are copied once into a SharedFeatureArena and the labels
+    encoded once, so that DataLoader workers do not copy the data frame.
+    """
+
     def __init__(
         self,
         data_frame,
         label_dict=None,
     ):
-        self.data_frame = data_frame
         self.label_encoder = LabelEncoder()
         if label_dict is not None:
             self.label_encoder.fit(list(label_dict.keys()))
             self.label_dict = label_dict
         else:
-            self.label_encoder.fit(self.data_frame["category"])
+            self.label_encoder.fit(data_frame["category"])
             self.label_dict = dict(zip(self.label_encoder.classes_, self.label_encoder.transform(self.label_encoder.classes_)))
+        self.labels = self.label_encoder.transform(data_frame["category"])
+        self.arena = SharedFeatureArena.from_features(
+            list(data_frame["feature"]), self.labels
+        )
 
     def __len__(self):
-        return len(self.data_frame)
+        return len(self.labels)
 
     def get_labels(self):
-        labels = []
-
-        for i in range(0, len(self.data_frame)):
-            label = self.data_frame.iloc[i]["category"]
-            label = self.label_encoder.transform([label])[0]
-            labels.append(label)
-
-        return labels
+        return self.labels
 
     def __getitem__(self, idx):
-        # obtain
-        input_feature = torch.Tensor(self.data_frame.iloc[idx]["feature"])
-        label = self.data_frame.iloc[idx]["category"]
-
-        # Encode label as integer
-        label = self.label_encoder.transform([label])[0]
-
-        return input_feature, label
+        return self.arena[idx], self.labels[idx]
     
     def get_label_dict(self):
         return self.label_dict
 
 
-def few_shot_dataloader(df, n_way, n_shot, n_query, n_tasks, tensor_length, num_workers):
+class QueryDatasetDCASE(Dataset):
+    """Query windows of a single file, served as views of its mel
+
+    The mel is stored as (frames, bins) and memory-mapped copy-on-write, so
+    it is writable for torch without being read into memory. Window i is
+    mel[i * segment_hop : i * segment_hop + tensor_length].T, of size
+    (bins, tensor_length), as in the Training_Set features. A mel saved as
+    float16 or uint8 (with affine = [offset, scale]) is decoded per window.
+    """
+
+    def __init__(
+        self,
+        mel_path,
+        labels,
+        tensor_length,
+        segment_hop,
+        label_dict,
+        affine=None,
+    ):
+        mel = torch.from_numpy(np.load(mel_path, mmap_mode="c"))
+        self.affine = affine
+        # size (windows, bins, tensor_length), without copying
+        self.windows = mel.unfold(0, tensor_length, segment_hop)
+        self.label_encoder = LabelEncoder()
+        self.label_encoder.fit(list(label_dict.keys()))
+        self.labels = self.label_encoder.transform(labels)
+        assert len(self.labels) == len(self.windows)
+
+    def __len__(self):
+        return len(self.windows)
+
+    def __getitem__(self, idx):
+        return decode_features(self.windows[idx], self.affine), self.labels[idx]
+
+
+def few_shot_dataloader(df, n_way, n_shot, n_query, n_tasks, tensor_length, num_workers, persistent_workers=False, prefetch_factor=2):
     """
     df: path to the label file
     n_way: number of classes
     n_shot: number of images PER CLASS in the support set
     n_query: number of images PER CLASSS in the query set
     n_tasks: number of episodes (number of times the loader gives the data during a training step)
+    num_workers: number of DataLoader worker processes (0 loads in the main process)
+    persistent_workers: keep the workers alive between epochs
+    prefetch_factor: number of batches loaded ahead by each worker
     """
 
     #audiodatasetdcase = AudioDatasetDCASE(data_frame=df)
@@ -78,10 +113,10 @@ def few_shot_dataloader(df, n_way, n_shot, n_query, n_tasks, tensor_length, num_
 
     loader = DataLoader(
         df,
-        num_workers = num_workers,
         batch_sampler=sampler,
         pin_memory=False,
         collate_fn=sampler.episodic_collate_fn,
+        **worker_kwargs(num_workers, prefetch_factor, persistent_workers),
     )
 
     return loader
@@ -104,6 +139,9 @@ class DCASEDataModule(LightningDataModule):
         set_type: str = "Training_Set",
         n_shot: int = 2,
         n_query: int = 3,
+        num_workers: int = 4,
+        persistent_workers: bool = False,
+        prefetch_factor: int = 2,
         **kwargs
     ):
         super().__init__(**kwargs)
@@ -120,6 +158,9 @@ class DCASEDataModule(LightningDataModule):
         self.set_type = set_type
         self.n_shot = n_shot
         self.n_query = n_query
+        self.num_workers = num_workers
+        self.persistent_workers = persistent_workers
+        self.prefetch_factor = prefetch_factor
         self.setup()
 
     def setup(self, stage=None):
@@ -137,7 +178,9 @@ class DCASEDataModule(LightningDataModule):
             n_query=3,
             n_tasks=self.n_task_train,
             tensor_length=self.tensor_length,
-            num_workers=4
+            num_workers=self.num_workers,
+            persistent_workers=self.persistent_workers,
+            prefetch_factor=self.prefetch_factor,
         )
         return train_loader
     
@@ -150,7 +193,9 @@ class DCASEDataModule(LightningDataModule):
             n_query=0,
             n_tasks=self.n_task_train,
             tensor_length=self.tensor_length,
-            num_workers=4
+            num_workers=self.num_workers,
+            persistent_workers=self.persistent_workers,
+            prefetch_factor=self.prefetch_factor,
         )
         return next(iter(test_loader))
     
@@ -7,9 +7,12 @@ import os
 from torch.utils.data import DataLoader
 
 from pytorch_lightning import LightningDataModule
-from data_utils.dataset import TaskSampler, AudioDataset
+from data_utils.dataset import TaskSampler, AudioDataset, worker_kwargs
+from data_utils.audio_cache import AudioCache
+from data_utils.waveform_cache import DEFAULT_CACHE_DIR
+from data_utils.fbank_transform import FbankTransform, WaveformCollate
 
-def few_shot_dataloader(root_dir, data_frame, n_way, n_shot, n_query, n_tasks, transform = None): 
+def few_shot_dataloader(root_dir, data_frame, n_way, n_shot, n_query, n_tasks, transform = None, audio_cache = None, features = "waveform", fbank_transform = None, tensor_length = 0, num_workers = 0, prefetch_factor = 2): 
     """
     root_dir: directory where the audio data is stored
     data_frame: path to the label file
@@ -17,10 +20,16 @@ def few_shot_dataloader(root_dir, data_frame, n_way, n_shot, n_query, n_tasks, t
     n_shot: number of images PER CLASS in the support set
     n_query: number of images PER CLASSS in the query set
     n_tasks: number of episodes (number of times the loader gives the data during a training step)
+    audio_cache: AudioCache of the waveforms and log-mel features (data_utils/audio_cache.py)
+    features: "waveform" or "fbank"
+    fbank_transform: FbankTransform computing the fbanks of all waveforms of an episode in one call
+    tensor_length: number of frames of the cropped fbanks
+    num_workers: number of DataLoader worker processes (0 loads in the main process)
+    prefetch_factor: number of batches loaded ahead by each worker
     """       
     
     df = AudioDataset(
-        root_dir=root_dir, data_frame=data_frame, transform=transform
+        root_dir=root_dir, data_frame=data_frame, transform=transform, audio_cache=audio_cache, features=features
     )
 
     sampler = TaskSampler(
@@ -28,14 +37,20 @@ def few_shot_dataloader(root_dir, data_frame, n_way, n_shot, n_query, n_tasks, t
         n_way=n_way, # number of classes
         n_shot=n_shot, # Number of images PER CLASS in the support set
         n_query=n_query, # Number of images PER CLASSS in the query set
-        n_tasks=n_tasks # Not sure
+        n_tasks=n_tasks, # Not sure
+        tensor_length=tensor_length
     )
 
+    collate_fn = sampler.episodic_collate_fn
+    if fbank_transform is not None:
+        collate_fn = WaveformCollate(fbank_transform, collate_fn)
+
     loader = DataLoader(
         df,
         batch_sampler=sampler,
         pin_memory=False,
-        collate_fn=sampler.episodic_collate_fn
+        collate_fn=collate_fn,
+        **worker_kwargs(num_workers, prefetch_factor)
     )
 
     return loader
@@ -54,6 +69,13 @@ class miniECS50DataModule(LightningDataModule):
         n_task_val: int = 100,
         n_task_test: int = 10 ,
         transform=None,
+        cache_dir: str = DEFAULT_CACHE_DIR,
+        cache_memory_bytes: int = 1 << 30,
+        features: str = "waveform",
+        fbank_collate: bool = False,
+        tensor_length: int = 498,
+        num_workers: int = 0,
+        prefetch_factor: int = 2,
         **kwargs
     ):
         super().__init__(**kwargs)
@@ -67,6 +89,14 @@ class miniECS50DataModule(LightningDataModule):
         self.n_task_val = n_task_val
         self.n_task_test = n_task_test
         self.transform = transform
+        self.features = features
+        # NOTE: 498 frames are the fbank of a whole 5 s clip
+        self.fbank_collate = fbank_collate
+        self.tensor_length = tensor_length
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        # shared by the train, val and test sets, and by the epochs
+        self.audio_cache = AudioCache(cache_dir, max_memory_bytes=cache_memory_bytes)
 
         self.setup()
 
@@ -86,7 +116,13 @@ class miniECS50DataModule(LightningDataModule):
                                            n_shot=5, 
                                            n_query=5, 
                                            n_tasks=self.n_task_train, 
-                                           transform=self.transform)
+                                           transform=self.transform, 
+                                           audio_cache=self.audio_cache, 
+                                           features=self.features, 
+                                           fbank_transform=FbankTransform() if self.fbank_collate else None, 
+                                           tensor_length=self.tensor_length, 
+                                           num_workers=self.num_workers, 
+                                           prefetch_factor=self.prefetch_factor)
         return train_loader
 
     def val_dataloader(self):
@@ -97,7 +133,13 @@ class miniECS50DataModule(LightningDataModule):
                                            n_shot=3, 
                                            n_query=2, 
                                            n_tasks=self.n_task_val, 
-                                           transform=self.transform)
+                                           transform=self.transform, 
+                                           audio_cache=self.audio_cache, 
+                                           features=self.features, 
+                                           fbank_transform=FbankTransform() if self.fbank_collate else None, 
+                                           tensor_length=self.tensor_length, 
+                                           num_workers=self.num_workers, 
+                                           prefetch_factor=self.prefetch_factor)
         return val_loader
     
     def test_dataloader(self):
@@ -108,7 +150,13 @@ class miniECS50DataModule(LightningDataModule):
                                            n_shot=5, 
                                            n_query=20, 
                                            n_tasks=self.n_task_test, 
-                                           transform=self.transform)
+                                           transform=self.transform, 
+                                           audio_cache=self.audio_cache, 
+                                           features=self.features, 
+                                           fbank_transform=FbankTransform() if self.fbank_collate else None, 
+                                           tensor_length=self.tensor_length, 
+                                           num_workers=self.num_workers, 
+                                           prefetch_factor=self.prefetch_factor)
         return test_loader
     
 
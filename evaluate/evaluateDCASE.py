@@ -3,7 +3,6 @@
 import argparse
 import numpy as np
 import pandas as pd
-import glob
 import os
 import hashlib
 import yaml
@@ -18,8 +17,14 @@ from torch.utils.data import DataLoader
 from tqdm import tqdm
 
 from prototypicalbeats.prototraining import ProtoBEATsModel
-from datamodules.TestDCASEDataModule import DCASEDataModule, AudioDatasetDCASE
+from datamodules.TestDCASEDataModule import (
+    DCASEDataModule,
+    QueryDatasetDCASE,
+)
 from datamodules.audiolist import AudioList
+from data_utils.feature_encoding import decode_features
+from data_utils.feature_manifest import read_feature_manifest
+from data_utils.waveform_cache import DEFAULT_RESAMPLER
 
 import pytorch_lightning as pl
 
@@ -105,6 +110,9 @@ def predict_labels_query(
     """
     - l_segment to know the length of the segment
     - offset is the position of the end of the last support sample
+
+    The queryloader gives the windows of the file in order, in batches of
+    any size.
     """
 
     model = model.to("cuda")
@@ -117,40 +125,41 @@ def predict_labels_query(
     ends = []
     d_to_pos = []
 
-    for i, data in enumerate(tqdm(queryloader)):
+    i = 0
+    for data in tqdm(queryloader):
         # Get the embeddings for the query
         feature, label = data
         feature = feature.to("cuda")
         q_embedding, _ = model.get_embeddings(feature, padding_mask=None)
 
-        # Calculate beginTime and endTime for each segment
-        # We multiply by 100 to get the time in seconds
-        if i == 0:
-            begin = i / 1000
-            end = tensor_length * frame_shift / 1000
-        else:
-            begin = i * tensor_length * frame_shift * overlap / 1000
-            end = begin + tensor_length * frame_shift / 1000
-
-        # Get the scores:
-        classification_scores = calculate_distance(q_embedding, prototypes)
+        # Get the scores, size (batch, n_way):
+        classification_scores = calculate_distance(q_embedding, prototypes).reshape(
+            len(feature), -1
+        )
 
         # Get the labels (either POS or NEG):
-        predicted_labels = torch.max(classification_scores, 0)[
+        predicted_labels = torch.max(classification_scores, 1)[
             1
         ]  # The dim where the distance to prototype is stored is 1
 
         # To numpy array
-        distance_to_pos = classification_scores[pos_index].detach().to("cpu").numpy()
+        distance_to_pos = classification_scores[:, pos_index].detach().to("cpu").numpy()
         predicted_labels = predicted_labels.detach().to("cpu").numpy()
         label = label.detach().to("cpu").numpy()
 
-        # Return the labels, begin and end of the detection
-        pred_labels.append(predicted_labels)
-        labels.append(label)
-        begins.append(begin)
-        ends.append(end)
-        d_to_pos.append(distance_to_pos)
+        for j in range(len(feature)):
+            # Calculate beginTime and endTime for each segment
+            # We multiply by 100 to get the time in seconds
+            begin = i * tensor_length * frame_shift * overlap / 1000
+            end = begin + tensor_length * frame_shift / 1000
+
+            # Return the labels, begin and end of the detection
+            pred_labels.append(predicted_labels[j])
+            labels.append(label[j : j + 1])
+            begins.append(begin)
+            ends.append(end)
+            d_to_pos.append(distance_to_pos[j])
+            i += 1
 
     pred_labels = np.array(pred_labels)
     labels = np.array(labels)
@@ -214,20 +223,19 @@ def merge_preds(df, tolerence, tensor_length):
 
 
 def main(
-    cfg, meta_df, support_spectrograms, support_labels, query_spectrograms, query_labels
+    cfg, record, support_spectrograms, support_labels, query_spectrograms, query_labels
 ):
     # Get the filename and the frame_shift for the particular file
-    filename = os.path.basename(support_spectrograms).split("data_")[1].split(".")[0]
-    frame_shift = meta_df.loc[filename, "frame_shift"]
+    filename = record["filename"]
+    frame_shift = record["frame_shift"]
+    segment_hop = record["segment_hop"]
 
     print("[INFO] PROCESSING {}".format(filename))
-    # check labels and spectograms all from same file
-    assert filename in support_labels
-    assert filename in query_spectrograms
-    assert filename in query_labels
 
     df_support = to_dataframe(support_spectrograms, support_labels)
-    custom_dcasedatamodule = DCASEDataModule(data_frame=df_support)
+    custom_dcasedatamodule = DCASEDataModule(
+        data_frame=df_support, num_workers=cfg["num_workers"]
+    )
     label_dic = custom_dcasedatamodule.get_label_dic()
     pos_index = label_dic["POS"]
 
@@ -242,11 +250,21 @@ def main(
     prototypes = get_proto_coordinates(model, s, sl, n_way=len(ways))
 
     ### Get the query dataset ###
-    df_query = to_dataframe(query_spectrograms, query_labels)
-    queryLoader = AudioDatasetDCASE(df_query, label_dict=label_dic)
+    queryLoader = QueryDatasetDCASE(
+        query_spectrograms,
+        np.load(query_labels),
+        tensor_length=cfg["tensor_length"],
+        segment_hop=segment_hop,
+        label_dict=label_dic,
+        affine=record.get("query_mel_affine"),
+    )
+    # KEEP THE WINDOWS IN ORDER TO GET BEGIN AND END OF SEGMENT
     queryLoader = DataLoader(
-        queryLoader, batch_size=1
-    )  # KEEP BATCH SIZE OF 1 TO GET BEGIN AND END OF SEGMENT
+        queryLoader,
+        batch_size=cfg["batch_size"],
+        shuffle=False,
+        num_workers=cfg["num_workers"],
+    )
 
     # Get the results
     print("[INFO] DOING THE PREDICTION FOR {}".format(filename))
@@ -300,12 +318,16 @@ def main(
 
 def write_wav(
     cfg,
+    filename,
     query_spectrograms,
     query_labels,
     gt_labels,
     pred_labels,
     distances_to_pos,
+    tensor_length,
+    segment_hop,
     target_fs=16000,
+    affine=None,
 ):
     from scipy.io import wavfile
     import shutil
@@ -319,14 +341,15 @@ def write_wav(
     if not os.path.exists(os.path.join(target_path, "audio")):
         os.makedirs(os.path.join(target_path, "audio"))
 
-    filename = (
-        os.path.basename(support_spectrograms).split("data_")[1].split(".")[0] + ".wav"
-    )
-    output = os.path.join(target_path, filename)
+    # filename of the manifest record, without extension
+    output = os.path.join(target_path, filename + ".wav")
 
     # Read the files
-    df = to_dataframe(query_spectrograms, query_labels)
-    concatenated_array = np.concatenate(df["feature"].values, axis=1)
+    query_mel = torch.from_numpy(np.load(query_spectrograms, mmap_mode="c"))
+    query_mel = decode_features(query_mel, affine)
+    windows = query_mel.unfold(0, tensor_length, segment_hop)
+    concatenated_array = windows.permute(1, 0, 2).reshape(windows.shape[1], -1)
+    concatenated_array = concatenated_array.numpy()
 
     # Expand the dimensions
     gt_labels = np.expand_dims(np.squeeze(gt_labels, axis=1), axis=0)
@@ -362,6 +385,14 @@ if __name__ == "__main__":
         type=str,
     )
 
+    parser.add_argument(
+        "--tuned_config",
+        help="Config written by data_utils/autotune.py, overriding batch_size and num_workers",
+        required=False,
+        default=None,
+        type=str,
+    )
+
     parser.add_argument(
         "--wav_save",
         help="Should the results be also saved as a .wav file?",
@@ -370,11 +401,40 @@ if __name__ == "__main__":
         action="store_true",
     )
 
+    parser.add_argument(
+        "--files",
+        help="Only evaluate these files (names without extension)",
+        default=None,
+        nargs="+",
+        required=False,
+        type=str,
+    )
+
+    parser.add_argument(
+        "--num_shards",
+        help="Split the files into this many shards, evaluated separately",
+        default=1,
+        required=False,
+        type=int,
+    )
+
+    parser.add_argument(
+        "--shard",
+        help="Index of the shard to evaluate",
+        default=0,
+        required=False,
+        type=int,
+    )
+
     cli_args = parser.parse_args()
+    assert 0 <= cli_args.shard < cli_args.num_shards
 
     # Get evalution config
     with open(cli_args.config) as f:
         cfg = yaml.load(f, Loader=FullLoader)
+    if cli_args.tuned_config is not None:
+        with open(cli_args.tuned_config) as f:
+            cfg.update(yaml.load(f, Loader=FullLoader))
 
     # Get training config
     training_config_path = os.path.join(
@@ -398,6 +458,14 @@ if __name__ == "__main__":
     )
     if data_hp["resample"]:
         my_hash_dict["tartget_fs"] = data_hp["target_fs"]
+        if data_hp.get("resampler", DEFAULT_RESAMPLER) != DEFAULT_RESAMPLER:
+            my_hash_dict["resampler"] = data_hp["resampler"]
+    if data_hp["denoise"] and data_hp.get("batched_denoise", False):
+        my_hash_dict["batched_denoise"] = data_hp["batched_denoise"]
+    if data_hp.get("file_fbank", False):
+        my_hash_dict["file_fbank"] = data_hp["file_fbank"]
+    if data_hp.get("feature_dtype", "float32") != "float32":
+        my_hash_dict["feature_dtype"] = data_hp["feature_dtype"]
     hash_dir_name = hashlib.sha1(
         json.dumps(my_hash_dict, sort_keys=True).encode()
     ).hexdigest()
@@ -405,68 +473,24 @@ if __name__ == "__main__":
     # ensure cfg of evaluation knows preprocessing tensor_length
     cfg["tensor_length"] = data_hp["tensor_length"]
 
-    # get meta, support and query paths
-    support_data_path = os.path.join(
-        "/data/DCASEfewshot",
-        cfg["status"],
-        hash_dir_name,
-        "audio",
-        "support_data_*.npz",
-    )
-    support_labels_path = os.path.join(
-        "/data/DCASEfewshot",
-        cfg["status"],
-        hash_dir_name,
-        "audio",
-        "support_labels_*.npy",
-    )
-    query_data_path = os.path.join(
-        "/data/DCASEfewshot", cfg["status"], hash_dir_name, "audio", "query_data_*.npz"
-    )
-    query_labels_path = os.path.join(
-        "/data/DCASEfewshot",
-        cfg["status"],
-        hash_dir_name,
-        "audio",
-        "query_labels_*.npy",
-    )
-    meta_df_path = os.path.join(
-        "/data/DCASEfewshot", cfg["status"], hash_dir_name, "audio", "meta.csv"
-    )
-
-    # List all the SUPPORT files (both labels and spectrograms)
-    support_all_spectrograms = glob.glob(support_data_path, recursive=True)
-    support_all_labels = glob.glob(support_labels_path, recursive=True)
-
-    # List all the QUERY files
-    query_all_spectrograms = glob.glob(query_data_path, recursive=True)
-    query_all_labels = glob.glob(query_labels_path, recursive=True)
-
-    # ensure lists are ordered the same
-    support_all_spectrograms.sort()
-    support_all_labels.sort()
-    query_all_spectrograms.sort()
-    query_all_labels.sort()
-
-    # Open the meta.csv containing the frame_shift for each file
-    meta_df = pd.read_csv(meta_df_path, names=["frame_shift", "filename"]).set_index(
-        "filename"
-    )
+    # index the files of the prepared data through its feature manifest
+    data_path = os.path.join("/data/DCASEfewshot", cfg["status"], hash_dir_name)
+    records = read_feature_manifest(data_path, cli_args.files)
+    records = records[cli_args.shard :: cli_args.num_shards]
 
     # Dataset to store all the results
     results = pd.DataFrame()
 
     # Run the main script
-    for support_spectrograms, support_labels, query_spectrograms, query_labels in zip(
-        support_all_spectrograms,
-        support_all_labels,
-        query_all_spectrograms,
-        query_all_labels,
-    ):
-        print(support_all_spectrograms)
+    for record in records:
+        assert record["support_data"] is not None, "no support set saved"
+        support_spectrograms = os.path.join(data_path, record["support_data"])
+        support_labels = os.path.join(data_path, record["support_labels"])
+        query_spectrograms = os.path.join(data_path, record["query_mel"])
+        query_labels = os.path.join(data_path, record["query_labels"])
         result, pred_labels, gt_labels, distances_to_pos = main(
             cfg,
-            meta_df,
+            record,
             support_spectrograms,
             support_labels,
             query_spectrograms,
@@ -478,14 +502,23 @@ if __name__ == "__main__":
         if cli_args.wav_save:
             write_wav(
                 cfg,
+                record["filename"],
                 query_spectrograms,
                 query_labels,
                 gt_labels,
                 pred_labels,
                 distances_to_pos,
+                tensor_length=cfg["tensor_length"],
+                segment_hop=record["segment_hop"],
                 target_fs=data_hp["target_fs"],
+                affine=record.get("query_mel_affine"),
             )
 
     # Return the final product
-    csv_path = os.path.join(cfg["save_dir"], "eval_out.csv")
+    if cli_args.num_shards > 1:
+        csv_path = os.path.join(
+            cfg["save_dir"], "eval_out_{}.csv".format(cli_args.shard)
+        )
+    else:
+        csv_path = os.path.join(cfg["save_dir"], "eval_out.csv")
     results.to_csv(csv_path, index=False)
@@ -11,6 +11,7 @@ import pytorch_lightning as pl
 from pytorch_lightning.utilities.rank_zero import rank_zero_info
 
 from BEATs.BEATs import BEATs, BEATsConfig
+from data_utils.fbank_transform import FbankTransform
 
 
 class BEATsTransferLearningModel(pl.LightningModule):
@@ -62,12 +63,19 @@ class BEATsTransferLearningModel(pl.LightningModule):
         self.beats = BEATs(self.cfg)
         self.beats.load_state_dict(self.checkpoint["model"])
 
+        # fbanks of the waveform batches, on the device of the model
+        self.fbank = FbankTransform()
+
         # 2. Classifier
         self.fc = nn.Linear(self.cfg.encoder_embed_dim, self.cfg.predictor_class)
 
     def forward(self, x, padding_mask=None):
         """Forward pass. Return x"""
 
+        # x are waveforms (batch, samples) or fbanks (batch, frames, bins)
+        if x.dim() == 2:
+            x, padding_mask = self.fbank(x, padding_mask)
+
         # Get the representation
         if padding_mask != None:
             x, _ = self.beats.extract_features(x, padding_mask)